@@ -0,0 +1,140 @@
+"""
+Compare initramfs compression methods on a built rootfs: archive size, compression
+time, host decompression time and, when a kernel is given, guest unpack time.
+
+Usage:
+    python benchmarks/initramfs_compression.py --rootfs PostgreSQLMicroVM-build/workspace/rootfs
+    python benchmarks/initramfs_compression.py --rootfs ... --kernel .../output_vms/Image --arch aarch64
+
+Guest unpack time is read from the kernel's printk timestamps between
+"Trying to unpack rootfs image as initramfs" and "Freeing initrd memory".
+QEMU falls back to TCG without KVM, which inflates the absolute numbers
+but keeps the comparison between methods meaningful.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from msmv.builders.compression import InitramfsCompressor
+from msmv.builders.rootfs import RootFSBuilder
+from msmv.vm.packer import VMBooter
+
+PRINTK_RE = re.compile(r"^\[\s*(\d+\.\d+)\]\s*(.*)$")
+UNPACK_START = "Trying to unpack rootfs image as initramfs"
+UNPACK_END = "Freeing initrd memory"
+
+CONSOLES = {
+    "aarch64": "ttyAMA0",
+    "x86_64": "ttyS0",
+}
+
+
+def measure_decompression(compressor, archive_path):
+    if compressor.method == "none":
+        return 0.0
+    start = time.perf_counter()
+    with open(archive_path, "rb") as archive:
+        subprocess.run(
+            compressor.decompress_command(),
+            stdin=archive,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+    return time.perf_counter() - start
+
+
+def measure_guest_unpack(arch, kernel_path, archive_path, timeout):
+    cmdline = f"console={CONSOLES.get(arch, 'ttyS0')} printk.time=1 initramfs_async=0"
+    command = VMBooter.build_boot_command(arch, kernel_path, archive_path, cmdline)
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    start = None
+    deadline = time.monotonic() + timeout
+    try:
+        for line in process.stdout:
+            match = PRINTK_RE.match(line.strip())
+            if match:
+                if UNPACK_START in match.group(2):
+                    start = float(match.group(1))
+                elif UNPACK_END in match.group(2) and start is not None:
+                    return float(match.group(1)) - start
+            if time.monotonic() > deadline:
+                break
+    finally:
+        process.kill()
+        process.wait()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rootfs", required=True, help="Populated rootfs directory")
+    parser.add_argument("--kernel", help="Kernel image for guest unpack timing")
+    parser.add_argument("--arch", default="aarch64", help="QEMU target architecture")
+    parser.add_argument(
+        "--methods",
+        default=",".join(InitramfsCompressor.METHODS),
+        help="Comma separated compression methods",
+    )
+    parser.add_argument("--timeout", type=int, default=120, help="Guest boot timeout")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    rootfs_builder = RootFSBuilder(args.rootfs)
+    results = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for method in args.methods.split(","):
+            compressor = InitramfsCompressor(method)
+            method_dir = os.path.join(output_dir, method)
+
+            start = time.perf_counter()
+            archive_path = rootfs_builder.make_compressed_cpio(
+                args.rootfs, method_dir, method
+            )
+            compress_time = time.perf_counter() - start
+
+            result = {
+                "method": method,
+                "size": os.path.getsize(archive_path),
+                "compress_s": compress_time,
+                "decompress_s": measure_decompression(compressor, archive_path),
+                "guest_unpack_s": None,
+            }
+            if args.kernel:
+                result["guest_unpack_s"] = measure_guest_unpack(
+                    args.arch, args.kernel, archive_path, args.timeout
+                )
+            results.append(result)
+
+    print(
+        f"{'METHOD':<8} {'SIZE':>12} {'COMPRESS':>10} {'DECOMPRESS':>11} {'GUEST UNPACK':>13}"
+    )
+    for result in results:
+        guest = result["guest_unpack_s"]
+        print(
+            f"{result['method']:<8} {result['size']:>12} "
+            f"{result['compress_s']:>9.2f}s {result['decompress_s']:>10.2f}s "
+            f"{(f'{guest:.3f}s' if guest is not None else '-'):>13}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare applying a recipe's kernel.options with one scripts/config call per option
+against the in-memory KConfig writer.
+
+Usage:
+    python benchmarks/kconfig_apply.py --kernel-dir linux-6.9.7 --recipe recipes/postgres.toml
+
+The kernel directory needs scripts/config and a .config (e.g. after `make tinyconfig`).
+Both methods run on temporary copies of the .config, the kernel tree is left untouched.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from msmv.config.parser import ConfigParser
+from msmv.util.kconfig import KConfig
+
+
+def apply_with_scripts_config(scripts_config, config_path, options):
+    for option, raw_value in options.items():
+        value = str(raw_value).strip("'\"")
+        subprocess.run(
+            [scripts_config, "--file", config_path, "--set-val", option, value],
+            check=True,
+        )
+
+
+def apply_with_kconfig(config_path, options):
+    kconfig = KConfig(config_path)
+    kconfig.apply_options(options)
+    kconfig.write()
+
+
+def time_runs(func, base_config, runs):
+    timings = []
+    result = None
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_path = os.path.join(tmp_dir, ".config")
+            shutil.copy(base_config, config_path)
+            start = time.perf_counter()
+            func(config_path)
+            timings.append(time.perf_counter() - start)
+            with open(config_path, "r") as f:
+                result = f.read()
+    return timings, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--kernel-dir", required=True, help="Configured kernel tree")
+    parser.add_argument("--recipe", required=True, help="Recipe with kernel.options")
+    parser.add_argument("--runs", type=int, default=5, help="Iterations per method")
+    args = parser.parse_args()
+
+    options = ConfigParser.parse_config(args.recipe)["kernel"]["options"]
+    scripts_config = os.path.join(os.path.abspath(args.kernel_dir), "scripts", "config")
+    base_config = os.path.join(args.kernel_dir, ".config")
+
+    loop_timings, loop_result = time_runs(
+        lambda path: apply_with_scripts_config(scripts_config, path, options),
+        base_config,
+        args.runs,
+    )
+    native_timings, native_result = time_runs(
+        lambda path: apply_with_kconfig(path, options), base_config, args.runs
+    )
+
+    loop_best = min(loop_timings)
+    native_best = min(native_timings)
+    print(f"{len(options)} options, best of {args.runs} runs")
+    print(f"{'scripts/config loop':<22} {loop_best * 1000:>10.2f} ms")
+    print(f"{'KConfig (in memory)':<22} {native_best * 1000:>10.2f} ms")
+    print(f"{'speedup':<22} {loop_best / native_best:>10.1f}x")
+    print(f"{'identical .config':<22} {str(loop_result == native_result):>10}")
+
+
+if __name__ == "__main__":
+    main()
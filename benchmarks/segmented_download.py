@@ -0,0 +1,152 @@
+"""
+Exercise the segmented downloader against a local stand-in for a slow, unreliable
+mirror: an http.server that supports Range, throttles every connection and drops
+connections part way through a response.
+
+Usage:
+    python benchmarks/segmented_download.py
+    python benchmarks/segmented_download.py --size-mb 64 --rate-kb 2048 --drop-after-kb 4096
+
+Each run downloads the same random file with 1 and with N segments and checks its
+sha256. The first URL handed to the downloader is a dead mirror, so mirror fallback
+is part of every run. A final run gives up after the first dropped connection (so
+--drop-after-kb must be below --size-mb) and is then restarted, to check that the second attempt resumes from the state file
+instead of starting over.
+"""
+
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from msmv.util.downloader import SegmentedDownloader
+
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+def make_handler(payload, rate, drop_after):
+    class FlakyHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        served = [0]
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/file.bin":
+                self.send_error(404)
+                return
+            start, end = 0, len(payload) - 1
+            match = RANGE_RE.match(self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", '"bench"')
+            self.end_headers()
+
+            sent = 0
+            position = start
+            chunk = 64 * 1024
+            began = time.monotonic()
+            while position <= end:
+                if drop_after and sent >= drop_after:
+                    # Hang up mid-response, as an overloaded mirror would
+                    self.close_connection = True
+                    return
+                data = payload[position : min(position + chunk, end + 1)]
+                self.wfile.write(data)
+                position += len(data)
+                sent += len(data)
+                self.served[0] += len(data)
+                # Throttle each connection independently, like a per-client rate limit
+                ahead = sent / rate - (time.monotonic() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    return FlakyHandler
+
+
+def start_server(payload, rate, drop_after):
+    handler = make_handler(payload, rate, drop_after)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler
+
+
+def timed_download(downloader, urls, dest_path, sha256):
+    start = time.perf_counter()
+    actual = downloader.download(urls, dest_path, sha256)
+    elapsed = time.perf_counter() - start
+    assert actual == sha256, "sha256 mismatch"
+    os.remove(dest_path)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the segmented downloader")
+    parser.add_argument("--size-mb", type=int, default=16)
+    parser.add_argument("--rate-kb", type=int, default=2048, help="per connection")
+    parser.add_argument("--drop-after-kb", type=int, default=3072)
+    parser.add_argument("--segments", type=int, default=4)
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    sha256 = hashlib.sha256(payload).hexdigest()
+    server, handler = start_server(
+        payload, args.rate_kb * 1024, args.drop_after_kb * 1024
+    )
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = [f"{base}/missing.bin", f"{base}/file.bin"]
+
+    print(f"{'SEGMENTS':>8} {'TIME':>9} {'THROUGHPUT':>12} {'SERVED':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dest_path = os.path.join(tmp_dir, "file.bin")
+        for segments in (1, args.segments):
+            handler.served[0] = 0
+            downloader = SegmentedDownloader(
+                segments=segments, min_segment_size=1024 * 1024, chunk_size=64 * 1024
+            )
+            elapsed = timed_download(downloader, urls, dest_path, sha256)
+            print(
+                f"{segments:>8} {elapsed:>8.2f}s "
+                f"{args.size_mb / elapsed:>8.2f}MB/s {handler.served[0] / 2**20:>8.1f}MB"
+            )
+
+        # Give up at the first drop, then check the next attempt picks up from there.
+        # A single segment spans the whole file, so it is always cut off
+        handler.served[0] = 0
+        impatient = SegmentedDownloader(segments=1, chunk_size=64 * 1024, retries=0)
+        try:
+            impatient.download(urls[1:], dest_path, sha256)
+        except Exception:
+            pass
+        partial = handler.served[0]
+        handler.served[0] = 0
+        timed_download(
+            SegmentedDownloader(chunk_size=64 * 1024), urls[1:], dest_path, sha256
+        )
+        resumed = handler.served[0]
+        print(
+            f"Interrupted after {partial / 2**20:.1f}MB, resume fetched "
+            f"{resumed / 2**20:.1f}MB of {args.size_mb}MB"
+        )
+        assert partial + resumed <= len(payload) + 2, "resume refetched data"
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
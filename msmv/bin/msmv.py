@@ -1,17 +1,35 @@
 import argparse
 import asyncio
+import contextvars
+import glob
+import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from qemu.qmp import QMPClient
 
 
 from msmv.builders.application import ApplicationBuilder
+from msmv.builders.compression import InitramfsCompressor
+from msmv.builders.fetch import SourceFetcher
 from msmv.builders.kernel import KernelBuilder
+from msmv.builders.remote import BuildWorker, WorkerPool
 from msmv.builders.rootfs import RootFSBuilder
 from msmv.config.parser import ConfigParser
 from msmv.util.application_helpers import ApplicationHelpers
+from msmv.util.build_cache import BuildCache
+from msmv.util.build_state import BuildState
+from msmv.util.ccache import CCache
+from msmv.util.cpu_budget import CpuBudget
+from msmv.util.host_command import CommandError
+from msmv.util.jobserver import Jobserver
+from msmv.util.kconfig import KConfig
+from msmv.util.scheduler import BuildScheduler
+from msmv.util.tracer import Tracer, current_tracer
 from msmv.util.workspace_helpers import WorkspaceHelpers
+from msmv.vm.boot_bench import BootBenchmark
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -19,10 +37,46 @@ logging.basicConfig(level=logging.INFO)
 # Stub: run target software with a non-root user
 RUN_WITH_UNPRIV_USER_DEBUG = False
 
+# Environment that changes what the compile phases produce
+BUILD_ENV_VARS = [
+    "CC",
+    "CXX",
+    "LD",
+    "CROSS_COMPILE",
+    "LLVM",
+    "KERNEL_CC",
+    "MAKE_COMMAND",
+    "CFLAGS",
+    "CXXFLAGS",
+    "LDFLAGS",
+]
+# Application settings only read after the application is installed
+APP_RUNTIME_KEYS = {"output_executable_path", "include_net"}
+
 
 class VMManager:
-    def __init__(self, config_file="config.toml", build_dir="./"):
+    # Phases that are skipped while their inputs are unchanged, with one app:<name>
+    # per application
+    PHASES = ["kernel", "rootfs", "init", "net", "terminfo", "cpio"]
+
+    def __init__(
+        self,
+        config_file="config.toml",
+        build_dir="./",
+        ccache_dir=None,
+        force=(),
+        jobserver=None,
+        workers=None,
+    ):
         self.build_dir = build_dir
+        # None disables ccache, an empty string uses the default ccache directory
+        self.ccache_dir = ccache_dir
+        # Phases to rerun even if their inputs did not change
+        self.force = force
+        # A make jobserver shared with other builds, by default each build starts its own
+        self.jobserver = jobserver
+        # A WorkerPool the kernel and application builds are offloaded to, if any
+        self.workers = workers
         self.config_file = config_file
         self.config = ConfigParser.parse_config(self.config_file)
         self.workspace = os.path.join(
@@ -94,91 +148,356 @@ class VMManager:
         status = await self.qmp_client.execute("query-status")
         print("Current VM status:", status["status"])
 
+    """Boot the built kernel and initramfs repeatedly and report serial console timings"""
+
+    def bench_boot(
+        self, runs=10, ready_regex=None, json_path=None, baseline_path=None, timeout=120
+    ):
+        output_dir = os.path.join(self.workspace, "workspace", "output_vms")
+        # The architecture the kernel was built for, with the same default
+        kernel_builder = KernelBuilder(self.config)
+        kernel_path = os.path.join(output_dir, kernel_builder.kernel_image)
+        compression = self.config.get("output", {}).get("compression", "none")
+        initrd_path = os.path.join(
+            output_dir, "rootfs.cpio" + InitramfsCompressor(compression).suffix
+        )
+        if not os.path.exists(kernel_path) or not os.path.exists(initrd_path):
+            print(
+                "Error: VM not built. Please build the VM first using 'build' command."
+            )
+            exit(1)
+
+        boot_config = self.config.get("boot", {})
+        benchmark = BootBenchmark(
+            kernel_builder.target_arch,
+            kernel_path,
+            initrd_path,
+            boot_config.get("cmdline", ""),
+            ready_regex=ready_regex,
+            enable_network=bool(boot_config.get("network")),
+            timeout=timeout,
+        )
+        report = benchmark.report(benchmark.run(runs))
+
+        baseline = None
+        if baseline_path:
+            with open(baseline_path) as f:
+                baseline = json.load(f)
+        BootBenchmark.print_report(report, baseline)
+        if json_path:
+            BootBenchmark.write_report(report, json_path)
+
+    """The phases --force accepts for a recipe"""
+
+    @staticmethod
+    def phases(config):
+        apps = [f"app:{name}" for name, _ in ConfigParser.get_applications(config)]
+        return VMManager.PHASES + apps + [BuildState.ALL]
+
+    """The recipe table of an application without the settings only used after install"""
+
+    @staticmethod
+    def app_build_inputs(app_details):
+        return {
+            key: value
+            for key, value in app_details.items()
+            if key not in APP_RUNTIME_KEYS
+        }
+
     def build(self):
         config = ConfigParser.parse_config(self.config_file)
         vm_name = config["general"]["name"]
+        # Absolute paths keep concurrent build phases independent of the cwd
         workspace = WorkspaceHelpers.setup_workspace(
-            os.path.join(self.build_dir, f"{vm_name}-build")
+            os.path.abspath(os.path.join(self.build_dir, f"{vm_name}-build"))
         )
 
-        self.perform_build(config, workspace)
-
-    def perform_build(self, config, workspace):
+        # Every make of this build, kernel and applications alike, shares one job budget
+        jobserver = self.jobserver
+        if jobserver is None:
+            jobserver = Jobserver.start(CpuBudget.jobs())
+        try:
+            with Tracer.trace(vm_name, "build"):
+                return self.perform_build(config, workspace, jobserver)
+        finally:
+            if jobserver is not None and jobserver is not self.jobserver:
+                jobserver.close()
+
+    def perform_build(self, config, workspace, jobserver=None):
         dir_paths = {
             "kernel_dir": os.path.join(workspace, "kernel"),
             "apps_dir": os.path.join(workspace, "applications"),
             "rootfs_dir": os.path.join(workspace, "rootfs"),
             "output_dir": os.path.join(workspace, "output_vms"),
+            "logs_dir": os.path.join(workspace, "logs"),
+            "config_layer_dir": os.path.join(workspace, "layers", "config"),
         }
 
         for dir_name, dir_path in dir_paths.items():
             os.makedirs(dir_path, exist_ok=True)
 
-        kernel_builder = KernelBuilder(config)
-        kernel_path = kernel_builder.setup_and_build_kernel(workspace)
-        logger.info(
-            f"Kernel built successfully. Build directory: {kernel_path['kernel_build']}"
+        ccache = None
+        if self.ccache_dir is not None:
+            ccache = CCache(
+                self.ccache_dir or None,
+                stats_dir=os.path.join(dir_paths["logs_dir"], "ccache"),
+            )
+            logger.info(f"Compiling through ccache in {ccache.cache_dir}")
+
+        # One cache for every builder, so they all see the same source index
+        cache = BuildCache()
+        kernel_builder = KernelBuilder(
+            config,
+            cache=cache,
+            log_dir=os.path.join(dir_paths["logs_dir"], "kernel"),
+            ccache=ccache,
+            jobserver=jobserver,
         )
 
-        # TODO: do something better than grabbing the first application
+        # Every application gets its own source directory, build log and DESTDIR,
+        # the DESTDIR becomes the application's initramfs layer
+        applications = ConfigParser.get_applications(config)
+        app_builders = {
+            app_name: ApplicationBuilder(
+                app_details,
+                os.path.join(dir_paths["apps_dir"], app_name, "destdir"),
+                log_dir=os.path.join(dir_paths["logs_dir"], app_name),
+                ccache=ccache,
+                name=app_name,
+                jobserver=jobserver,
+                target_arch=config["general"].get("target_arch"),
+                cache=cache,
+            )
+            for app_name, app_details in applications
+        }
+        # The first application is the one init starts
         first_app_details = ConfigParser.get_first_application(config)
-        app_builder = ApplicationBuilder(first_app_details, dir_paths["rootfs_dir"])
-        # Download and extract the application
-        # app_source_dir = app_builder.download_and_extract_app(
-        #     first_app_details, dir_paths["apps_dir"]
-        # )
+        rootfs_builder = RootFSBuilder(dir_paths["rootfs_dir"], cache=cache)
 
         # image_name = config["output"].get("image_name", "output_image")
         # image_path = os.path.join(output_dir, f"{image_name}.qcow2")
         # create_qemu_image(image_path)
-        # kernel_path = os.path.join(dir_paths["kernel_dir"], "arch/arm64/boot/Image")
-        initrd_path = os.path.join(dir_paths["output_dir"], "rootfs.cpio")
+        compression = config.get("output", {}).get("compression", "none")
+        compressor = InitramfsCompressor(compression)
+        initrd_path = os.path.join(
+            dir_paths["output_dir"], "rootfs.cpio" + compressor.suffix
+        )
 
-        logger.info(f'Setting up rootfs in {dir_paths["rootfs_dir"]}')
-        rootfs_builder = RootFSBuilder(dir_paths["rootfs_dir"])
-        rootfs_builder.setup_rootfs()
+        # Independent phases run concurrently, the cpio only waits on the rootfs contents.
+        # Phases whose inputs are unchanged since the last build of this workspace are skipped
+        scheduler = BuildScheduler(
+            cpu_budget=jobserver.jobs if jobserver else None,
+            state=BuildState(workspace, self.force),
+        )
+        build_env = {var: os.getenv(var) for var in BUILD_ENV_VARS}
+
+        def fetch_sources():
+            # Fetch all sources up front so the downloads overlap. Phases sent to a
+            # build worker fetch there, phases built here fetch when they start
+            if self.workers is not None:
+                return {}
+            fetcher = SourceFetcher()
+            if not scheduler.up_to_date("kernel"):
+                fetcher.add_kernel(kernel_builder, workspace)
+            for app_name, app_builder in app_builders.items():
+                # An application that is up to date, or restored from the install
+                # cache, needs no source
+                if scheduler.up_to_date(f"app:{app_name}"):
+                    continue
+                if app_builder.cached_install():
+                    continue
+                fetcher.add_application(
+                    app_name, app_builder, os.path.join(dir_paths["apps_dir"], app_name)
+                )
+            return fetcher.fetch_all()
+
+        def build_kernel():
+            if self.workers is not None and not kernel_builder.cached_kernel():
+                self.workers.build_kernel(kernel_builder)
+            kernel_path = kernel_builder.setup_and_build_kernel(
+                workspace, kernel_dir=scheduler.tasks["fetch"].result.get("kernel")
+            )
+            logger.info(
+                f"Kernel built successfully. Build directory: {kernel_path['kernel_build']}"
+            )
+            return kernel_path
+
+        def setup_rootfs():
+            logger.info(f'Setting up rootfs in {dir_paths["rootfs_dir"]}')
+            rootfs_builder.setup_rootfs()
+            if RUN_WITH_UNPRIV_USER_DEBUG:
+                ApplicationHelpers.create_etc_files(dir_paths["config_layer_dir"])
+
+        def build_app(app_name):
+            # Configure, compile and install into the app's own DESTDIR,
+            # output goes to the app's logs
+            app_builder = app_builders[app_name]
+            # Recipes building the same application wait for one build and reuse its
+            # installed tree from the cache
+            with app_builder.install_lock():
+                if app_builder.restore_cached_install():
+                    return app_builder.rootfs_path
+                if self.workers is not None and self.workers.build_app(app_builder):
+                    return app_builder.rootfs_path
+                logger.info(f"Building {app_name}, logs: {app_builder.log_dir}")
+                app_source_dir = app_builder.setup_and_build_app(
+                    os.path.join(dir_paths["apps_dir"], app_name),
+                    scheduler.tasks["fetch"].result.get(app_name),
+                )
+                app_builder.store_install()
+                return app_source_dir
+
+        def compile_init():
+            # Write a simple init executable and have it run out app's output executable upon VM start
+            logger.info(
+                f"Compiling init.c with start program {first_app_details['output_executable_path']}"
+            )
+            ApplicationHelpers.compile_init_c(
+                dir_paths["rootfs_dir"],
+                first_app_details["output_executable_path"],
+                target_arch=config["general"].get("target_arch"),
+            )
 
-        # Configure and build the application using the actual source directory path
-        app_builder.setup_and_build_app(
-            dir_paths["apps_dir"],
+        def compile_net_utility():
+            # compile_network_config_utility(rootfs_dir)
+            ApplicationHelpers.compile_and_setup_net_route_utility(
+                dir_paths["rootfs_dir"],
+                ip_address=config["boot"]["network"]["ip_address"],
+                netmask=config["boot"]["network"]["netmask"],
+                gateway=config["boot"]["network"]["gateway"],
+                target_arch=config["general"].get("target_arch"),
+            )
+            ApplicationHelpers.setup_resolv_conf(dir_paths["config_layer_dir"])
+
+        def make_cpio():
+            # Base layer first, then one layer per application in recipe order, then
+            # the config layer; later layers override earlier ones at unpack time
+            layers = [("base", dir_paths["rootfs_dir"])]
+            layers += [
+                (app_name, app_builder.rootfs_path)
+                for app_name, app_builder in app_builders.items()
+            ]
+            layers.append(("config", dir_paths["config_layer_dir"]))
+            logger.info(f"Creating layered cpio ({compression})")
+            rootfs_builder.make_layered_cpio(
+                layers, dir_paths["output_dir"], compression
+            )
+
+        def app_inputs(app_name):
+            app_details = app_builders[app_name].config
+            return {
+                "app": self.app_build_inputs(app_details),
+                "sha256": app_builders[app_name].source_sha256(),
+                "compiler": ApplicationHelpers.compiler_identity(
+                    app_builders[app_name].compiler
+                ),
+                "cxx": ApplicationHelpers.compiler_identity(os.getenv("CXX", "c++")),
+                "target_arch": config["general"].get("target_arch"),
+                "env": build_env,
+            }
+
+        def check_initramfs_support():
+            # The kernel can only unpack the initramfs if the matching RD_* decompressor is built in
+            kernel_config = KConfig(scheduler.tasks["kernel"].result["kernel_config"])
+            if not compressor.check_kernel_support(kernel_config):
+                raise Exception(
+                    f"Kernel cannot decompress a {compression} initramfs, see CONFIG_{compressor.kconfig_symbol}"
+                )
+
+        # Network and file copying phases take no share of the CPU budget. With build
+        # workers neither do compiles, so all of them can be handed out at once; those
+        # that end up building here still only run as many jobs as the jobserver allows
+        def compile_cpus(make_command):
+            return 0 if self.workers else BuildScheduler.make_jobs(make_command)
+
+        scheduler.add_task("fetch", fetch_sources, cpus=0)
+        scheduler.add_task(
+            "kernel",
+            build_kernel,
+            deps=["fetch"],
+            cpus=compile_cpus(kernel_builder.make_command),
+            inputs=lambda: {"kernel": kernel_builder.kernel_cache_key()},
+            outputs=lambda result: [result["kernel_image"], result["kernel_config"]],
         )
-        # Write a simple init executable and have it run out app's output executable upon VM start
-        logger.info(
-            f"Compiling init.c with start program {first_app_details['output_executable_path']}"
+        scheduler.add_task(
+            "rootfs",
+            setup_rootfs,
+            cpus=0,
+            inputs=lambda: {"rootfs_dir": dir_paths["rootfs_dir"]},
+            outputs=lambda result: [dir_paths["rootfs_dir"]],
         )
-        ApplicationHelpers.compile_init_c(
-            dir_paths["rootfs_dir"], first_app_details["output_executable_path"]
+        for app_name, app_builder in app_builders.items():
+            scheduler.add_task(
+                f"app:{app_name}",
+                lambda app_name=app_name: build_app(app_name),
+                deps=["fetch"],
+                cpus=compile_cpus(app_builder.build_command),
+                inputs=lambda app_name=app_name: app_inputs(app_name),
+                outputs=lambda result, app_builder=app_builder: [
+                    result,
+                    app_builder.rootfs_path,
+                ],
+            )
+        scheduler.add_task(
+            "init",
+            compile_init,
+            deps=["rootfs"],
+            inputs=lambda: {
+                "start_program": first_app_details["output_executable_path"],
+                "target_arch": config["general"].get("target_arch"),
+                "env": build_env,
+            },
+            outputs=lambda result: [os.path.join(dir_paths["rootfs_dir"], "init")],
         )
+        cpio_deps = [f"app:{app_name}" for app_name in app_builders]
+        cpio_deps += ["init", "terminfo"]
 
-        if RUN_WITH_UNPRIV_USER_DEBUG:
-            ApplicationHelpers.create_etc_files(dir_paths["rootfs_dir"])
         # Compile and include an 'ifconfig' replacement in C
         #
         # This negates us from having to include additional common utils
         # in the target VM at the expense of having to...write C code
-        if (
-            "include_net" in first_app_details
-            and first_app_details["include_net"]
-            and config["boot"].get("network")
-        ):
-            # compile_network_config_utility(rootfs_dir)
-            ApplicationHelpers.compile_and_setup_net_route_utility(
-                dir_paths["rootfs_dir"],
-                ip_address=config["boot"]["network"]["ip_address"],
-                netmask=config["boot"]["network"]["netmask"],
-                gateway=config["boot"]["network"]["gateway"],
+        if any(
+            app_details.get("include_net") for _, app_details in applications
+        ) and config["boot"].get("network"):
+            scheduler.add_task(
+                "net",
+                compile_net_utility,
+                deps=["rootfs"],
+                inputs=lambda: {
+                    "network": config["boot"]["network"],
+                    "target_arch": config["general"].get("target_arch"),
+                    "env": build_env,
+                },
+                outputs=lambda result: [
+                    os.path.join(dir_paths["rootfs_dir"], "setnet_r"),
+                    os.path.join(dir_paths["config_layer_dir"], "etc", "resolv.conf"),
+                ],
             )
-            ApplicationHelpers.setup_resolv_conf(dir_paths["rootfs_dir"])
+            cpio_deps.append("net")
 
         # Copy a vt100 compile terminfo entry to the build system
         #   Needed for any program needed to emulate a terminal
         # TODO: this is mostly a hack and subverts us from having to compile ncurses
-        ApplicationHelpers.find_and_copy_vt(dir_paths["rootfs_dir"])
-
-        logger.info("Creating uncompressed cpio")
-        rootfs_builder.make_uncompressed_cpio(
-            dir_paths["rootfs_dir"], dir_paths["output_dir"]
+        scheduler.add_task(
+            "terminfo",
+            lambda: ApplicationHelpers.find_and_copy_vt(dir_paths["rootfs_dir"]),
+            deps=["rootfs"],
+            cpus=0,
+            inputs=lambda: {},
         )
+        scheduler.add_task(
+            "cpio",
+            make_cpio,
+            deps=cpio_deps,
+            inputs=lambda: {"compression": compression, "apps": list(app_builders)},
+            outputs=lambda result: [initrd_path],
+        )
+        scheduler.add_task(
+            "check-initramfs", check_initramfs_support, deps=["kernel"], cpus=0
+        )
+
+        results = scheduler.run()
+        kernel_path = results["kernel"]
         # logger.info("Setting up boot params")
         # setup_boot_parameters("aarch64",
         #     kernel_path=kernel_path,
@@ -187,12 +506,171 @@ class VMManager:
         #     output_path=output_dir, enable_network=True
         # )
         logger.info("Built image! Done!")
+        if ccache:
+            ccache.print_stats()
 
         logger.info(f"Kernel build path {kernel_path['kernel_build']}")
         logger.info(f"Kernel output path {kernel_path['kernel_image']}")
         logger.info(f"Initrd output path {initrd_path}")
         # Use script args to optionally clear the workspace after building
         # clean_workspace(workspace)
+        return {"kernel_image": kernel_path["kernel_image"], "initrd": initrd_path}
+
+
+"""
+Build every recipe in a directory. The recipes build concurrently and share one make
+jobserver, so kernels and applications of all of them stay within a single job budget.
+Recipes whose kernels have identical inputs form a group: the first of them to reach
+the kernel phase builds it, the others wait on its lock and copy the cached image.
+"""
+
+
+class BatchBuilder:
+    SUMMARY_FILE = "build-all-summary.json"
+
+    def __init__(
+        self, recipe_dir, build_dir="./", ccache_dir=None, force=(), workers=None
+    ):
+        self.recipe_dir = recipe_dir
+        self.build_dir = build_dir
+        self.ccache_dir = ccache_dir
+        self.force = force
+        self.workers = workers
+
+    def recipes(self):
+        return sorted(glob.glob(os.path.join(self.recipe_dir, "*.toml")))
+
+    """
+    Map each kernel cache key to the recipes that use that kernel, and each recipe that
+    cannot be built to the reason why
+    """
+
+    def group_kernels(self, recipes, jobserver=None):
+        groups = {}
+        errors = {}
+        names = {}
+        for recipe in recipes:
+            try:
+                config = ConfigParser.parse_config(recipe)
+                name = config["general"]["name"]
+                key = KernelBuilder(config, jobserver=jobserver).kernel_cache_key()
+            except Exception as e:
+                errors[recipe] = f"Invalid recipe: {e}"
+                continue
+            # Recipes with the same name would build in the same workspace
+            if name in names:
+                errors[recipe] = f"Same name '{name}' as {names[name]}"
+                continue
+            names[name] = recipe
+            groups.setdefault(key, []).append(recipe)
+        return groups, errors
+
+    @staticmethod
+    def recipe_result(recipe, kernel_key="", error=None):
+        return {
+            "recipe": recipe,
+            "kernel": kernel_key[:12],
+            "status": "failed" if error else "ok",
+            "error": error,
+            "duration": 0.0,
+            "kernel_size": None,
+            "initrd_size": None,
+        }
+
+    def build_recipe(self, recipe, kernel_key, jobserver):
+        start = time.monotonic()
+        result = self.recipe_result(recipe, kernel_key)
+        try:
+            artifacts = VMManager(
+                recipe,
+                self.build_dir,
+                ccache_dir=self.ccache_dir,
+                force=self.force,
+                jobserver=jobserver,
+                workers=self.workers,
+            ).build()
+            result["kernel_size"] = os.path.getsize(artifacts["kernel_image"])
+            result["initrd_size"] = os.path.getsize(artifacts["initrd"])
+        # One failed recipe must not stop the others
+        except (Exception, SystemExit) as e:
+            logger.error(f"Building {recipe} failed: {e}")
+            result["status"] = "failed"
+            result["error"] = str(e) or type(e).__name__
+        result["duration"] = round(time.monotonic() - start, 3)
+        return result
+
+    """Build all recipes and return one result per recipe, in recipe order"""
+
+    def build_all(self):
+        recipes = self.recipes()
+        if not recipes:
+            raise Exception(f"No recipes (*.toml) found in {self.recipe_dir}")
+
+        jobserver = Jobserver.start(CpuBudget.jobs())
+        try:
+            groups, errors = self.group_kernels(recipes, jobserver)
+            logger.info(
+                f"Building {len(recipes) - len(errors)} recipes with "
+                f"{len(groups)} unique kernels"
+            )
+            # Submitting the first recipe of every group first only makes it likely to
+            # compile that kernel. Whichever recipe of a group takes the kernel lock
+            # first builds it, and the others wait on the lock and copy the cached image
+            ordered = [(group[0], key) for key, group in groups.items()]
+            ordered += [
+                (recipe, key) for key, group in groups.items() for recipe in group[1:]
+            ]
+            results = {
+                recipe: self.recipe_result(recipe, error=error)
+                for recipe, error in errors.items()
+            }
+            with ThreadPoolExecutor(max_workers=max(len(ordered), 1)) as executor:
+                futures = {
+                    recipe: executor.submit(
+                        contextvars.copy_context().run,
+                        self.build_recipe,
+                        recipe,
+                        key,
+                        jobserver,
+                    )
+                    for recipe, key in ordered
+                }
+                for recipe, future in futures.items():
+                    results[recipe] = future.result()
+        finally:
+            if jobserver is not None:
+                jobserver.close()
+        return [results[recipe] for recipe in recipes]
+
+    @staticmethod
+    def print_summary(results, duration):
+        def size(value):
+            return BuildCache.format_size(value) if value is not None else "-"
+
+        print(
+            f"{'RECIPE':<28} {'KERNEL':<13} {'STATUS':<7} {'TIME':>9} "
+            f"{'KERNEL':>8} {'INITRD':>8}"
+        )
+        for result in results:
+            print(
+                f"{os.path.basename(result['recipe'])[:28]:<28} {result['kernel']:<13} "
+                f"{result['status']:<7} {result['duration']:>8.1f}s "
+                f"{size(result['kernel_size']):>8} {size(result['initrd_size']):>8}"
+            )
+        failed = [result for result in results if result["status"] != "ok"]
+        kernels = {result["kernel"] for result in results if result["kernel"]}
+        print(
+            f"{len(results) - len(failed)} of {len(results)} recipes built with "
+            f"{len(kernels)} unique kernels in {duration:.1f}s"
+        )
+        for result in failed:
+            print(f"{result['recipe']}: {result['error']}")
+
+    @staticmethod
+    def write_summary(results, duration, path):
+        with open(path, "w") as f:
+            json.dump({"duration": round(duration, 3), "recipes": results}, f, indent=2)
+        logger.info(f"Wrote build summary to {path}")
 
 
 def main():
@@ -204,14 +682,192 @@ def main():
         "-b", "--build-dir", default="./", help="Directory to build VMs in"
     )
     parser.add_argument(
-        "command", choices=["build", "start", "stop", "pause", "resume", "status"]
+        "--max-size",
+        help="Cache size limit for 'cache prune', e.g. 10G (defaults to MSMV_CACHE_MAX_SIZE)",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="OUT_JSON",
+        help="Write a Chrome trace of the build phases and commands to this file and print a summary",
+    )
+    parser.add_argument(
+        "--ccache",
+        nargs="?",
+        const="",
+        metavar="DIR",
+        help="Compile the kernel and applications through ccache, optionally with its cache directory",
+    )
+    parser.add_argument(
+        "--force",
+        action="append",
+        default=[],
+        metavar="PHASE",
+        help="Rerun a build phase even if its inputs are unchanged, e.g. kernel, app:<name>, init, cpio or all; repeatable",
+    )
+    parser.add_argument(
+        "--listen",
+        default=BuildWorker.DEFAULT_ADDRESS,
+        metavar="HOST:PORT",
+        help=f"Address 'worker' serves builds on (default {BuildWorker.DEFAULT_ADDRESS})",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="HOST:PORT,...",
+        help="Send kernel and application builds to these 'msmv worker' processes",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=10, help="Number of boots for 'bench boot'"
+    )
+    parser.add_argument(
+        "--ready-regex",
+        help="Serial console regex marking the application as ready for 'bench boot'",
+    )
+    parser.add_argument(
+        "--boot-timeout",
+        type=int,
+        default=120,
+        help="Seconds to wait for each boot in 'bench boot'",
+    )
+    parser.add_argument(
+        "--json",
+        help="Write 'bench boot' results or the 'build-all' summary to this JSON file",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Results JSON of a previous 'bench boot' run to compare against",
+    )
+    parser.add_argument(
+        "command",
+        choices=[
+            "build",
+            "build-all",
+            "start",
+            "stop",
+            "pause",
+            "resume",
+            "status",
+            "cache",
+            "bench",
+            "worker",
+        ],
+    )
+    parser.add_argument(
+        "action",
+        nargs="?",
+        help="Subcommand for 'cache': ls (default) or prune; for 'bench': boot; "
+        "for 'build-all': the recipe directory",
     )
     args = parser.parse_args()
 
-    manager = VMManager(args.config_file, args.build_dir)
+    if args.command == "cache":
+        cache = BuildCache()
+        if args.action == "prune":
+            evicted = cache.prune(args.max_size)
+            print(f"Evicted {len(evicted)} cache entries.")
+        elif args.action in (None, "ls"):
+            cache.print_entries()
+        else:
+            parser.error(f"Unknown cache action: {args.action}")
+        return
+
+    if args.command == "worker":
+        BuildWorker(
+            args.listen,
+            os.path.join(args.build_dir, "msmv-worker"),
+            ccache_dir=args.ccache,
+        ).serve()
+        return
+
+    def check_force(configs):
+        phases = []
+        for config in configs:
+            phases += [
+                phase for phase in VMManager.phases(config) if phase not in phases
+            ]
+        unknown = set(args.force) - set(phases)
+        if unknown:
+            parser.error(
+                f"Unknown phase(s) for --force: {', '.join(sorted(unknown))}, "
+                f"phases are: {', '.join(phases)}"
+            )
+
+    workers = WorkerPool(args.workers.split(",")) if args.workers else None
+
+    if args.command == "build-all":
+        if not args.action:
+            parser.error("Usage: msmv build-all <recipe directory>")
+        configs = []
+        for recipe in BatchBuilder(args.action).recipes():
+            # Invalid recipes are reported in the summary
+            try:
+                configs.append(ConfigParser.parse_config(recipe))
+            except Exception:
+                continue
+        check_force(configs)
+        tracer = Tracer() if args.trace else None
+        current_tracer.set(tracer)
+        batch = BatchBuilder(
+            args.action,
+            args.build_dir,
+            ccache_dir=args.ccache,
+            force=args.force,
+            workers=workers,
+        )
+        start = time.monotonic()
+        try:
+            results = batch.build_all()
+        finally:
+            if tracer is not None:
+                tracer.write_chrome_trace(args.trace)
+                tracer.print_summary()
+        duration = time.monotonic() - start
+        BatchBuilder.print_summary(results, duration)
+        BatchBuilder.write_summary(
+            results,
+            duration,
+            args.json or os.path.join(args.build_dir, BatchBuilder.SUMMARY_FILE),
+        )
+        if any(result["status"] != "ok" for result in results):
+            exit(1)
+        return
+
+    manager = VMManager(
+        args.config_file,
+        args.build_dir,
+        ccache_dir=args.ccache,
+        force=args.force,
+        workers=workers,
+    )
+
+    if args.command == "bench":
+        if args.action != "boot":
+            parser.error("Usage: msmv bench boot")
+        manager.bench_boot(
+            runs=args.runs,
+            ready_regex=args.ready_regex,
+            json_path=args.json,
+            baseline_path=args.baseline,
+            timeout=args.boot_timeout,
+        )
+        return
 
     if args.command == "build":
-        manager.build()
+        check_force([manager.config])
+        tracer = Tracer() if args.trace else None
+        current_tracer.set(tracer)
+        try:
+            manager.build()
+        except CommandError as e:
+            logger.error(f"Build failed: {e}")
+            if e.log_tail:
+                print(f"Last {len(e.log_tail)} lines of output:")
+                print("\n".join(e.log_tail))
+            exit(1)
+        finally:
+            # Failed builds are traced too, that is often when the trace is wanted
+            if tracer is not None:
+                tracer.write_chrome_trace(args.trace)
+                tracer.print_summary()
     else:
         asyncio.run(getattr(manager, args.command)())
 
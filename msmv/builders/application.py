@@ -1,19 +1,71 @@
+import contextlib
 import logging
 import os
 import shlex
+import shutil
 import tarfile
 
-from msmv.util.host_command import HostCommand
+from msmv.util.application_helpers import ApplicationHelpers
+from msmv.util.archive import Archive
+from msmv.util.build_cache import BuildCache
+from msmv.util.cpu_budget import CpuBudget
+from msmv.util.host_command import CommandError, HostCommand
+from msmv.util.jobserver import Jobserver
+from msmv.util.source_cache import SourceCache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+"""Raised when an application's install step did not produce its output executable"""
+
+
+class MissingExecutableError(CommandError):
+    def __init__(self, command, executable_path, log_path=None):
+        super().__init__(command, log_path=log_path)
+        self.executable_path = executable_path
+
+    def __str__(self):
+        message = f"Application not found at {self.executable_path} after '{' '.join(self.command)}'"
+        if self.log_path:
+            message += f", see {self.log_path}"
+        return message
+
+
 class ApplicationBuilder:
-    def __init__(self, config, rootfs_path):
+    # Installed trees are cached as one archive per application build
+    INSTALL_ARCHIVE = "destdir.tar.gz"
+
+    def __init__(
+        self,
+        config,
+        rootfs_path,
+        log_dir=None,
+        ccache=None,
+        name=None,
+        jobserver=None,
+        target_arch=None,
+        cache=None,
+    ):
         self.config = config
+        # The recipe's [applications.<name>] key, used to label logs and stats
+        self.name = name or config.get("name", "app")
         self.rootfs_path = rootfs_path
-        self.default_make_command = os.getenv("MAKE_COMMAND", "make -j8")
+        self.log_dir = log_dir
+        self.ccache = ccache
+        self.jobserver = jobserver
+        self.target_arch = target_arch
+        self.cache = cache or BuildCache()
+        # make started by any build step joins the jobserver through MAKEFLAGS, so
+        # a -j in MAKE_COMMAND is dropped
+        if jobserver is not None:
+            self.default_make_command = Jobserver.make_command(
+                os.getenv("MAKE_COMMAND", "make")
+            )
+        else:
+            self.default_make_command = os.getenv(
+                "MAKE_COMMAND", f"make -j{CpuBudget.jobs()}"
+            )
 
         # Default to 'cc' if not set
         self.compiler = os.getenv("CC", "cc")
@@ -31,46 +83,142 @@ class ApplicationBuilder:
         self.env = os.environ.copy()
         self.env["CC"] = self.compiler
         self.env["LD"] = self.linker
+        if self.ccache:
+            self.env["CC"] = self.ccache.wrap(self.compiler)
+            self.env["CXX"] = self.ccache.wrap(os.getenv("CXX", "c++"))
 
-    """Download and extract the application source code."""
+        # Spawns both compilers, and the recipe does not change during a build
+        self._install_inputs = None
 
-    def download_and_extract_app(
-        self, app_details, app_dir, common_tarball_name="application.tar.gz"
-    ):
-        tar_path = os.path.join(app_dir, common_tarball_name)
+    """
+    Download (through the shared source cache) and extract the application source code.
+    Extraction is skipped when app_dir already holds the tree of this exact archive.
+    """
 
-        # Check if the tarball file exists and skip downloading if it does
-        if not os.path.isfile(tar_path):
-            logger.info(f"Tarball not found at {tar_path}. Downloading...")
-            HostCommand.run_command(
-                ["wget", app_details["url"], "-O", common_tarball_name], cwd=app_dir
-            )
-        else:
-            logger.info(f"Tarball already exists at {tar_path}. Skipping download.")
+    def download_and_extract_app(self, app_details, app_dir):
+        sources = SourceCache(self.cache)
+        tar_path = sources.fetch(
+            app_details["url"],
+            app_details.get("sha256"),
+            mirrors=app_details.get("mirrors", []),
+        )
+        return Archive.extract_once(
+            tar_path, app_dir, sources.indexed_sha256(app_details["url"])
+        )
 
-        # Extract the application
-        logger.info(f"Extracting tarball: {tar_path}. cwd is {app_dir}")
-        # Check if the tarball file exists
-        if not os.path.isfile(tar_path):
-            logger.error("Tarball file does not exist.")
-            return None
+    """Everything besides the source archive that influences the installed tree"""
+
+    def install_inputs(self):
+        if self._install_inputs is None:
+            self._install_inputs = self.compute_install_inputs()
+        return self._install_inputs
 
-        HostCommand.run_command(
-            ["tar", "-xzf", common_tarball_name, "-C", "."], cwd=app_dir
+    def compute_install_inputs(self):
+        return {
+            "url": self.config["url"],
+            "config_script": self.config.get("config_script"),
+            # The default make command's -j does not change what gets installed
+            "build_command": self.config.get("build_command"),
+            "install_command": self.config["install_command"],
+            "compiler": ApplicationHelpers.compiler_identity(self.compiler),
+            "cxx": ApplicationHelpers.compiler_identity(os.getenv("CXX", "c++")),
+            "linker": self.linker,
+            "flags": {var: os.getenv(var) for var in ("CFLAGS", "CXXFLAGS", "LDFLAGS")},
+            "target_arch": self.target_arch,
+        }
+
+    """The sha256 of the source archive, pinned or of the one fetched, None if unknown"""
+
+    def source_sha256(self):
+        return self.config.get("sha256") or SourceCache(self.cache).indexed_sha256(
+            self.config["url"]
         )
 
-        logger.info("Automatically finding the directory name of extracted tarball")
+    """
+    Cache key of the installed tree: its inputs and the source archive's sha256. None
+    while the sha256 is unknown, i.e. before it was pinned or first fetched.
+    """
 
-        with tarfile.open(tar_path, "r:gz") as tar:
-            top_dir = os.path.commonpath(tar.getnames())
-            app_source_dir = os.path.join(app_dir, top_dir)
+    def install_cache_key(self):
+        sha256 = self.source_sha256()
+        if sha256 is None:
+            return None
+        return BuildCache.make_key({**self.install_inputs(), "sha256": sha256.lower()})
 
-        return app_source_dir
+    """Return the path of the cached archive of this application's installed tree, None on a miss"""
 
-    """Configure and build the application."""
+    def cached_install(self):
+        cache_key = self.install_cache_key()
+        if cache_key is None:
+            return None
+        cached_entry = self.cache.lookup("app-install", cache_key)
+        if cached_entry is None:
+            return None
+        return os.path.join(cached_entry, self.INSTALL_ARCHIVE)
+
+    """
+    Unpack a previously installed tree into an empty DESTDIR, skipping extract, configure,
+    build and install. False if there is none.
+    """
+
+    def restore_cached_install(self):
+        archive_path = self.cached_install()
+        if archive_path is None:
+            return False
+        logger.info(f"Using cached install of {self.name}")
+        self.unpack_install(archive_path)
+        return True
+
+    def unpack_install(self, archive_path):
+        shutil.rmtree(self.rootfs_path, ignore_errors=True)
+        os.makedirs(self.rootfs_path)
+        with tarfile.open(archive_path, "r:gz") as tar:
+            # The archive may come from a build worker
+            tar.extractall(self.rootfs_path, filter="data")
+
+    """Held while this application is built, so identical builds run only once"""
+
+    def install_lock(self):
+        return self.cache.lock(
+            "app-install",
+            BuildCache.make_key(self.install_inputs()),
+        )
+
+    """
+    Store the installed tree, or an archive of it such as one built elsewhere, in the
+    cache and return the cached archive; the archive itself if there is no cache key
+    """
+
+    def store_install(self, archive_path=None):
+        cache_key = self.install_cache_key()
+        if archive_path is None:
+            archive_path = os.path.join(
+                os.path.dirname(self.rootfs_path), f".{self.INSTALL_ARCHIVE}"
+            )
+            # Fast compression, written on every miss while gzip unpacks about as
+            # fast whatever the level
+            with tarfile.open(archive_path, "w:gz", compresslevel=1) as tar:
+                tar.add(self.rootfs_path, arcname=".")
+        if cache_key is None:
+            return archive_path
+        cached_entry = self.cache.store(
+            "app-install",
+            cache_key,
+            {self.INSTALL_ARCHIVE: archive_path},
+            description=f"{self.name} install",
+            move=True,
+        )
+        return os.path.join(cached_entry, self.INSTALL_ARCHIVE)
 
-    def setup_and_build_app(self, app_dir):
-        app_source_dir = self.download_and_extract_app(self.config, app_dir)
+    """
+    Configure, compile and install the application into its DESTDIR and return the
+    source directory. Restoring and storing the installed tree is up to the caller.
+    """
+
+    def setup_and_build_app(self, app_dir, app_source_dir=None):
+        # The source may already have been fetched by the parallel fetch stage
+        if app_source_dir is None:
+            app_source_dir = self.download_and_extract_app(self.config, app_dir)
 
         # Check if the recipe has a config script (pre-compilation) command
         if self.config.get("config_script") is not None:
@@ -78,8 +226,13 @@ class ApplicationBuilder:
 
         # TODO: check if compilation is successful before installing
         self.compile_app(app_source_dir)
+
+        # Start from an empty DESTDIR so the application layer only holds this install
+        shutil.rmtree(self.rootfs_path, ignore_errors=True)
+        os.makedirs(self.rootfs_path)
         self.install_app_to_output(app_source_dir)
         self.check_compiled_app()
+        return app_source_dir
 
     def configure_app(self, app_details, app_source_dir):
         # Use shlex to split strings a shell would
@@ -89,7 +242,7 @@ class ApplicationBuilder:
         logger.info(
             f"Running config script: {' '.join(config_command)} in dir {app_source_dir}  with {self.linker} {self.compiler}"
         )
-        HostCommand.run_command(config_command, cwd=app_source_dir, env=self.env)
+        self.run_build_command(config_command, app_source_dir, "configure")
 
         logger.info("Config script completed.")
 
@@ -97,8 +250,8 @@ class ApplicationBuilder:
         logger.info(f"Building application")
 
         # Use the build command from the TOML file or the default if not specified
-        HostCommand.run_command(
-            shlex.split(self.build_command), cwd=app_source_dir, env=self.env
+        self.run_build_command(
+            shlex.split(self.build_command), app_source_dir, "build", progress=True
         )
         logger.info("Application built.")
 
@@ -114,12 +267,47 @@ class ApplicationBuilder:
             logger.error(
                 f"Application not found at {built_app} in rootfs {self.rootfs_path}"
             )
-            exit(1)
+            raise MissingExecutableError(
+                shlex.split(self.install_command),
+                built_app,
+                os.path.join(self.log_dir, "install.log") if self.log_dir else None,
+            )
 
     def install_app_to_output(self, app_source_dir):
         logger.info(self.config.get("application", {}))
         logger.info(f"Installing application with {self.install_command}")
 
-        HostCommand.run_command(
-            shlex.split(self.install_command), cwd=app_source_dir, env=self.env
+        self.run_build_command(
+            shlex.split(self.install_command), app_source_dir, "install"
         )
+
+    """Run a build step, streaming its output to <log_dir>/<phase>.log if a log dir is set"""
+
+    def run_build_command(self, command, app_source_dir, phase, progress=False):
+        env = self.env
+        if self.ccache:
+            env = {
+                **self.env,
+                **self.ccache.env(f"{self.name}-{phase}", app_source_dir),
+            }
+
+        pass_fds = ()
+        slot = contextlib.nullcontext()
+        if self.jobserver is not None:
+            env, pass_fds = self.jobserver.client_env(env)
+            slot = self.jobserver.slot(command)
+
+        with slot:
+            if self.log_dir is None:
+                return HostCommand.run_command(
+                    command, cwd=app_source_dir, env=env, pass_fds=pass_fds
+                )
+
+            return HostCommand.run_command(
+                command,
+                cwd=app_source_dir,
+                env=env,
+                log_path=os.path.join(self.log_dir, f"{phase}.log"),
+                progress=f"{self.name} {phase}" if progress else None,
+                pass_fds=pass_fds,
+            )
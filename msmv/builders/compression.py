@@ -0,0 +1,113 @@
+import logging
+import shutil
+import subprocess
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""Stream an initramfs through an external, multithreaded compressor"""
+
+
+class InitramfsCompressor:
+    # Candidate commands in order of preference. The kernel only accepts xz with
+    # crc32 checks and lz4 in the legacy frame format, hence those flags.
+    COMPRESSORS = {
+        "gzip": {
+            "commands": [["pigz", "-9", "-c"], ["gzip", "-9", "-c"]],
+            "decompress": ["gzip", "-dc"],
+            "suffix": ".gz",
+            "kconfig": "RD_GZIP",
+        },
+        "xz": {
+            "commands": [["xz", "-T0", "-9", "--check=crc32", "-c"]],
+            "decompress": ["xz", "-dc"],
+            "suffix": ".xz",
+            "kconfig": "RD_XZ",
+        },
+        "zstd": {
+            "commands": [["zstd", "-T0", "-19", "-q", "-c"]],
+            "decompress": ["zstd", "-dc"],
+            "suffix": ".zst",
+            "kconfig": "RD_ZSTD",
+        },
+        "lz4": {
+            "commands": [["lz4", "-l", "-9", "-q", "-c"]],
+            "decompress": ["lz4", "-dc"],
+            "suffix": ".lz4",
+            "kconfig": "RD_LZ4",
+        },
+    }
+    METHODS = ["none"] + list(COMPRESSORS)
+
+    def __init__(self, method="none"):
+        if method not in self.METHODS:
+            raise ValueError(
+                f"Unsupported initramfs compression '{method}', use one of {', '.join(self.METHODS)}"
+            )
+        self.method = method
+
+    @property
+    def suffix(self):
+        return self.COMPRESSORS[self.method]["suffix"] if self.method != "none" else ""
+
+    """The kconfig symbol the kernel needs to unpack this initramfs, None if uncompressed"""
+
+    @property
+    def kconfig_symbol(self):
+        return (
+            self.COMPRESSORS[self.method]["kconfig"] if self.method != "none" else None
+        )
+
+    def command(self):
+        for command in self.COMPRESSORS[self.method]["commands"]:
+            if shutil.which(command[0]):
+                return command
+        raise FileNotFoundError(
+            f"No {self.method} compressor found, install one of "
+            + ", ".join(c[0] for c in self.COMPRESSORS[self.method]["commands"])
+        )
+
+    def decompress_command(self):
+        return self.COMPRESSORS[self.method]["decompress"]
+
+    """
+    Yield a binary file object that writes into output_path through the compressor.
+    The archive is compressed while it is being written, no uncompressed copy hits the disk.
+    """
+
+    @contextmanager
+    def open_stream(self, output_path):
+        with open(output_path, "wb") as output_file:
+            if self.method == "none":
+                yield output_file
+                return
+
+            command = self.command()
+            logger.info(f"Compressing {output_path} with {' '.join(command)}")
+            process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=output_file
+            )
+            try:
+                yield process.stdin
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            process.stdin.close()
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, command)
+
+    """Check that the kernel .config can decompress this initramfs"""
+
+    def check_kernel_support(self, kconfig):
+        symbol = self.kconfig_symbol
+        if symbol is None:
+            return True
+        if kconfig.get(symbol) != "y":
+            logger.error(
+                f"Kernel is not configured with CONFIG_{symbol}=y, it cannot unpack a {self.method} initramfs. "
+                f'Add {symbol} = "y" to kernel.options or change output.compression.'
+            )
+            return False
+        return True
@@ -0,0 +1,214 @@
+import logging
+import os
+import stat
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""Streaming writer for cpio archives in the "newc" format read by the Linux initramfs loader"""
+
+
+class CpioWriter:
+    MAGIC = b"070701"
+    TRAILER = "TRAILER!!!"
+    BLOCK_SIZE = 512
+    COPY_CHUNK_SIZE = 1024 * 1024
+
+    DEVICE_TYPES = {
+        "c": stat.S_IFCHR,
+        "b": stat.S_IFBLK,
+    }
+
+    def __init__(self, fileobj, mtime=None):
+        self.fileobj = fileobj
+        try:
+            self.fd = fileobj.fileno()
+            # Anything already buffered must land before we write to the fd directly
+            fileobj.flush()
+        except (AttributeError, OSError):
+            self.fd = None
+        self.offset = 0
+        self.next_ino = 1
+        # SOURCE_DATE_EPOCH gives byte-for-byte reproducible archives
+        if mtime is None and os.getenv("SOURCE_DATE_EPOCH"):
+            mtime = int(os.getenv("SOURCE_DATE_EPOCH"))
+        self.mtime = mtime
+
+    def _write(self, data):
+        if self.fd is None:
+            self.fileobj.write(data)
+        else:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view) :]
+        self.offset += len(data)
+
+    def _pad(self, alignment=4):
+        padding = -self.offset % alignment
+        if padding:
+            self._write(b"\0" * padding)
+
+    def _write_header(self, name, mode, size, mtime=0, rdev=(0, 0), nlink=1, ino=None):
+        encoded_name = name.encode() + b"\0"
+        if ino is None:
+            ino = self.allocate_ino()
+        fields = [
+            ino,
+            mode,
+            0,  # uid: everything in the image is owned by root
+            0,  # gid
+            nlink,
+            self.mtime if self.mtime is not None else int(mtime),
+            size,
+            0,  # devmajor
+            0,  # devminor
+            rdev[0],
+            rdev[1],
+            len(encoded_name),
+            0,  # check, unused by newc
+        ]
+        self._write(self.MAGIC + b"".join(b"%08X" % field for field in fields))
+        self._write(encoded_name)
+        self._pad()
+
+    def allocate_ino(self):
+        self.next_ino += 1
+        return self.next_ino - 1
+
+    def add_directory(self, name, mode=0o755, mtime=0):
+        self._write_header(name, stat.S_IFDIR | mode, 0, mtime, nlink=2)
+
+    def add_symlink(self, name, target, mtime=0):
+        data = target.encode()
+        self._write_header(name, stat.S_IFLNK | 0o777, len(data), mtime)
+        self._write(data)
+        self._pad()
+
+    def add_device(self, name, type_, major, minor, mode=0o666):
+        self._write_header(
+            name, self.DEVICE_TYPES[type_] | mode, 0, rdev=(int(major), int(minor))
+        )
+
+    """
+    Add a regular file. Hard links share one ino and nlink; like gen_init_cpio, only
+    the last of them carries the data (with_data) and the others are written empty.
+    """
+
+    def add_file(self, name, path, st=None, ino=None, nlink=1, with_data=True):
+        st = st or os.stat(path)
+        size = st.st_size if with_data else 0
+        self._write_header(
+            name,
+            stat.S_IFREG | stat.S_IMODE(st.st_mode),
+            size,
+            st.st_mtime,
+            nlink=nlink,
+            ino=ino,
+        )
+        if not with_data:
+            return
+        with open(path, "rb") as src:
+            copied = self._copy_data(src, st.st_size)
+        if copied != st.st_size:
+            raise IOError(f"{path} changed size while being archived")
+        self._pad()
+
+    def _copy_data(self, src, size):
+        if self.fd is not None and hasattr(os, "sendfile"):
+            # Kernel-side copy straight from the page cache into the archive
+            copied = 0
+            try:
+                while copied < size:
+                    sent = os.sendfile(self.fd, src.fileno(), copied, size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+                self.offset += copied
+                return copied
+            except OSError:
+                if copied:
+                    raise
+                # Not supported for this pair of files, fall back to a userspace copy
+
+        copied = 0
+        for chunk in iter(lambda: src.read(self.COPY_CHUNK_SIZE), b""):
+            self._write(chunk)
+            copied += len(chunk)
+        return copied
+
+    """
+    Archive every entry below root_dir, plus synthetic device nodes given as
+    (path, type, major, minor) tuples, in sorted order with stable inode numbers.
+    Files hard linked to each other inside root_dir stay hard links in the archive.
+    """
+
+    def add_tree(self, root_dir, device_nodes=()):
+        entries = {}
+
+        def walk(dir_path, prefix):
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    name = prefix + entry.name
+                    entries[name] = entry
+                    if entry.is_dir(follow_symlinks=False):
+                        walk(entry.path, name + "/")
+
+        walk(root_dir, "")
+        for node in device_nodes:
+            entries[node[0]] = node
+
+        names = sorted(entries, key=lambda name: name.split("/"))
+        stats = {}
+        links = {}
+        for name in names:
+            if isinstance(entries[name], tuple):
+                continue
+            st = stats[name] = entries[name].stat(follow_symlinks=False)
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                links.setdefault((st.st_dev, st.st_ino), []).append(name)
+        link_inos = {}
+
+        for name in names:
+            entry = entries[name]
+            if isinstance(entry, tuple):
+                self.add_device(*entry)
+                continue
+
+            st = stats[name]
+            link_names = links.get((st.st_dev, st.st_ino), [name])
+            if stat.S_ISREG(st.st_mode) and len(link_names) > 1:
+                if (st.st_dev, st.st_ino) not in link_inos:
+                    link_inos[(st.st_dev, st.st_ino)] = self.allocate_ino()
+                self.add_file(
+                    name,
+                    entry.path,
+                    st,
+                    ino=link_inos[(st.st_dev, st.st_ino)],
+                    nlink=len(link_names),
+                    with_data=name == link_names[-1],
+                )
+            elif stat.S_ISDIR(st.st_mode):
+                self.add_directory(name, stat.S_IMODE(st.st_mode), st.st_mtime)
+            elif stat.S_ISLNK(st.st_mode):
+                self.add_symlink(name, os.readlink(entry.path), st.st_mtime)
+            elif stat.S_ISREG(st.st_mode):
+                self.add_file(name, entry.path, st)
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                type_ = "c" if stat.S_ISCHR(st.st_mode) else "b"
+                self.add_device(
+                    name,
+                    type_,
+                    os.major(st.st_rdev),
+                    os.minor(st.st_rdev),
+                    stat.S_IMODE(st.st_mode),
+                )
+            else:
+                logger.warning(f"Skipping unsupported file type at {entry.path}")
+
+    """Write the trailer entry and pad the archive to a full block"""
+
+    def close(self):
+        self._write_header(self.TRAILER, 0, 0, nlink=1)
+        self._pad(self.BLOCK_SIZE)
+        if self.fd is None:
+            self.fileobj.flush()
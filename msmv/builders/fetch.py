@@ -0,0 +1,63 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""Download and extract every source in a recipe concurrently before any compile starts"""
+
+
+class SourceFetcher:
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.jobs = {}
+
+    """Register a named fetch job; func is called without arguments and returns the source dir"""
+
+    def add(self, name, url, func):
+        logger.info(f"Resolved source {name}: {url}")
+        self.jobs[name] = func
+
+    """Register the kernel source, unless the kernel will be served from the build cache"""
+
+    def add_kernel(self, kernel_builder, workspace):
+        if kernel_builder.cached_kernel():
+            logger.info("Kernel is cached, skipping kernel source fetch")
+            return
+        self.add(
+            "kernel",
+            kernel_builder.kernel_source_url(),
+            lambda: kernel_builder.handle_kernel_source(workspace),
+        )
+
+    def add_application(self, name, app_builder, apps_dir):
+        self.add(
+            name,
+            app_builder.config["url"],
+            lambda: app_builder.download_and_extract_app(app_builder.config, apps_dir),
+        )
+
+    """Run all registered jobs at once and return a dict of job name to source dir"""
+
+    def fetch_all(self):
+        if not self.jobs:
+            return {}
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(self.jobs))
+        ) as executor:
+            # Run each job in a copy of our context so its commands join our command group
+            futures = {
+                name: executor.submit(contextvars.copy_context().run, func)
+                for name, func in self.jobs.items()
+            }
+            # result() re-raises the first failure in the calling thread
+            results = {name: future.result() for name, future in futures.items()}
+
+        logger.info(
+            f"Fetched {len(results)} sources in {time.monotonic() - start:.1f}s"
+        )
+        return results
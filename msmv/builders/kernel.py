@@ -1,13 +1,23 @@
+import contextlib
 import logging
 import os
 import shlex
 import shutil
-import tarfile
+import subprocess
+import tempfile
 
-import requests
 from tqdm import tqdm
 
+from msmv.util.archive import Archive
+from msmv.util.build_cache import BuildCache
+from msmv.util.cpu_budget import CpuBudget
+from msmv.util.download_helpers import HashingReader
+from msmv.util.downloader import SegmentedDownloader
 from msmv.util.host_command import HostCommand
+from msmv.util.jobserver import Jobserver
+from msmv.util.kconfig import KConfig
+from msmv.util.kconfig_profiles import KConfigProfiles
+from msmv.util.source_cache import SourceCache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -20,14 +30,38 @@ class KernelBuilder:
         "x86_64": "x86",
     }
 
+    # Kbuild bakes these into init/version.o; pinning them keeps that object cacheable
+    # and makes two builds of the same tree byte-for-byte comparable
+    REPRODUCIBLE_ENV = {
+        "KBUILD_BUILD_TIMESTAMP": "Thu Jan  1 00:00:00 UTC 1970",
+        "KBUILD_BUILD_USER": "msmv",
+        "KBUILD_BUILD_HOST": "msmv",
+        "KBUILD_BUILD_VERSION": "1",
+    }
+
+    # Times to refetch a source tree that was evicted between fetching and pinning it
+    PIN_ATTEMPTS = 3
+
     KERNEL_IMAGE_MAPPING = {
         "arm64": "Image",
         "x86": "bzImage",
     }
 
-    def __init__(self, config):
+    def __init__(self, config, cache=None, log_dir=None, ccache=None, jobserver=None):
         self.config = config
-        self.make_command = os.getenv("MAKE_COMMAND", "make -j8")
+        self.cache = cache or BuildCache()
+        self.sources = SourceCache(self.cache)
+        self.log_dir = log_dir
+        self.ccache = ccache
+        self.jobserver = jobserver
+        # With a jobserver make takes its parallelism from MAKEFLAGS, an explicit -j
+        # in MAKE_COMMAND would make it ignore the shared budget
+        if jobserver is not None:
+            self.make_command = Jobserver.make_command(
+                os.getenv("MAKE_COMMAND", "make")
+            )
+        else:
+            self.make_command = os.getenv("MAKE_COMMAND", f"make -j{CpuBudget.jobs()}")
         self.target_arch = self.config.get("general", {}).get("target_arch", "x86")
         self.kernel_arch = self.ARCH_MAPPING.get(self.target_arch, self.target_arch)
         self.kernel_image = self.KERNEL_IMAGE_MAPPING.get(self.kernel_arch, "Image")
@@ -39,24 +73,264 @@ class KernelBuilder:
         self.env = os.environ.copy()
         self.env["CC"] = self.compiler
         self.env["ARCH"] = self.kernel_arch
+        # With or without ccache, stamps set by the user take precedence
+        for var, value in self.REPRODUCIBLE_ENV.items():
+            self.env.setdefault(var, value)
 
-    def setup_and_build_kernel(self, workspace):
+        # Both spawn the compiler, and the recipe does not change during a build
+        self._toolchain_identity = None
+        self._kernel_cache_key = None
+
+    def setup_and_build_kernel(self, workspace, kernel_dir=None):
         dir_paths = self.setup_directories(workspace)
-        kernel_dir = self.handle_kernel_source(workspace)
-        # TODO: refactor this
-        dir_paths["kernel_build"] = kernel_dir
         dir_paths["kernel_image"] = os.path.join(
             dir_paths["output_dir"], self.kernel_image
         )
 
-        self.configure_kernel(self.config["kernel"], kernel_dir)
-        if "patches" in self.config["kernel"]:
-            self.apply_patches(self.config["kernel"]["patches"], kernel_dir)
-        self.apply_default_kernel_options(kernel_dir)
-        self.build_kernel(kernel_dir)
-        self.copy_kernel_to_output(kernel_dir, dir_paths["output_dir"])
+        # Skip the source download and compile if an identical kernel was built before
+        cache_key = self.kernel_cache_key()
+        if self.use_cached_kernel(cache_key, dir_paths):
+            return dir_paths
+
+        source_key = self.source_cache_key()
+        for _ in range(self.PIN_ATTEMPTS):
+            # The shared source tree may already have been fetched by the parallel fetch stage
+            if kernel_dir is None:
+                kernel_dir = self.handle_kernel_source(workspace)
+            # Pinned so that no prune removes the tree while make reads from it
+            with self.cache.pin("kernel-source", source_key) as source_entry:
+                if source_entry is not None:
+                    return self.build_in_object_dir(
+                        workspace, cache_key, kernel_dir, dir_paths
+                    )
+            logger.warning(
+                "Kernel source tree was evicted before use, fetching it again"
+            )
+            kernel_dir = None
+        raise Exception(
+            f"Kernel source tree {source_key[:12]} keeps being evicted, raise MSMV_CACHE_MAX_SIZE"
+        )
+
+    """
+    Configure and build in the shared object directory. Recipes with the same kernel
+    configuration share it, so only one of them may build in it at a time, and the
+    held lock also keeps it from being evicted during the build.
+    """
+
+    def build_in_object_dir(self, workspace, cache_key, kernel_dir, dir_paths):
+        with self.cache.lock("kernel-obj", cache_key):
+            # Another build of the same kernel may have finished while we waited
+            if self.use_cached_kernel(cache_key, dir_paths):
+                return dir_paths
+
+            obj_dir = self.object_dir(workspace, cache_key)
+            dir_paths["kernel_build"] = obj_dir
+            dir_paths["kernel_config"] = os.path.join(obj_dir, ".config")
+            self.configure_kernel(self.config["kernel"], kernel_dir, obj_dir)
+            self.apply_default_kernel_options(kernel_dir, obj_dir)
+            self.build_kernel(kernel_dir, obj_dir)
+            self.copy_kernel_to_output(obj_dir, dir_paths["output_dir"])
+            self.store_kernel_in_cache(cache_key, obj_dir)
+            self.cache.update_size("kernel-obj", cache_key)
         return dir_paths
 
+    """
+    Copy a cached kernel to the output directory and point dir_paths at its entry.
+    False if it is not cached. Pinned so that no prune evicts it during the copy.
+    """
+
+    def use_cached_kernel(self, cache_key, dir_paths):
+        with self.cache.pin("kernel", cache_key) as cached_entry:
+            if cached_entry is None:
+                return False
+            logger.info(f"Using cached kernel {cache_key[:12]}")
+            shutil.copy(
+                os.path.join(cached_entry, self.kernel_image), dir_paths["output_dir"]
+            )
+            dir_paths["kernel_build"] = cached_entry
+            dir_paths["kernel_config"] = os.path.join(cached_entry, "config")
+        return True
+
+    """
+    The compiler kbuild runs. It ignores CC from the environment, so this is KERNEL_CC
+    if set (passed to make as CC), else clang when LLVM is set, else
+    $(CROSS_COMPILE)gcc.
+    """
+
+    @staticmethod
+    def kernel_compiler():
+        return (
+            os.getenv("KERNEL_CC")
+            or KernelBuilder.llvm_compiler()
+            or f"{os.getenv('CROSS_COMPILE', '')}gcc"
+        )
+
+    """The compiler kbuild runs for host programs such as scripts/kconfig"""
+
+    @staticmethod
+    def host_compiler():
+        return os.getenv("HOSTCC") or KernelBuilder.llvm_compiler() or "gcc"
+
+    """
+    The clang selected by LLVM: LLVM=1, a path prefix ending in / or a version suffix
+    starting with -. None without LLVM.
+    """
+
+    @staticmethod
+    def llvm_compiler():
+        llvm = os.getenv("LLVM", "")
+        if llvm.endswith("/"):
+            return f"{llvm}clang"
+        if llvm.startswith("-"):
+            return f"clang{llvm}"
+        if llvm:
+            return "clang"
+        return None
+
+    """Identify the compiler so a toolchain upgrade invalidates cached kernels"""
+
+    def toolchain_identity(self):
+        if self._toolchain_identity is None:
+            compiler = self.kernel_compiler()
+            try:
+                result = subprocess.run(
+                    shlex.split(compiler) + ["--version"],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                self._toolchain_identity = (
+                    result.stdout.splitlines()[0] if result.stdout else compiler
+                )
+            except (OSError, subprocess.CalledProcessError):
+                self._toolchain_identity = compiler
+        return self._toolchain_identity
+
+    """Return the cache entry for this kernel configuration, None if it has to be built"""
+
+    def cached_kernel(self):
+        return self.cache.lookup("kernel", self.kernel_cache_key())
+
+    """Hash everything that influences the kernel image into a cache key"""
+
+    def kernel_cache_key(self):
+        if self._kernel_cache_key is None:
+            self._kernel_cache_key = self.compute_kernel_cache_key()
+        return self._kernel_cache_key
+
+    def compute_kernel_cache_key(self):
+        kernel_config = self.config["kernel"]
+        return BuildCache.make_key(
+            {
+                "version": kernel_config["version"],
+                "url": kernel_config.get("url"),
+                "target_arch": self.target_arch,
+                "options": {
+                    option: str(value).strip("'\"")
+                    for option, value in kernel_config.get("options", {}).items()
+                },
+                "profiles": self.profile_options(),
+                "patches": self.patch_hashes(),
+                "toolchain": self.toolchain_identity(),
+                # The version line alone does not tell cross compilers apart
+                "cross_compile": os.getenv("CROSS_COMPILE"),
+                "llvm": os.getenv("LLVM"),
+                "kernel_cc": os.getenv("KERNEL_CC"),
+            }
+        )
+
+    """Options of the recipe's kernel.profiles, merged in the order listed"""
+
+    def profile_options(self):
+        return KConfigProfiles.resolve(
+            self.config["kernel"].get("profiles", []), self.kernel_arch
+        )
+
+    """
+    Key of the resolved base .config: tinyconfig plus the profiles, after olddefconfig.
+    Kconfig probes the compiler, so the toolchain is part of it.
+    """
+
+    def base_config_key(self):
+        return BuildCache.make_key(
+            {
+                "source": self.source_cache_key(),
+                "target_arch": self.target_arch,
+                "profiles": self.config["kernel"].get("profiles", []),
+                "profile_options": self.profile_options(),
+                "toolchain": self.toolchain_identity(),
+                "cross_compile": os.getenv("CROSS_COMPILE"),
+                "llvm": os.getenv("LLVM"),
+                "kernel_cc": os.getenv("KERNEL_CC"),
+            }
+        )
+
+    def patch_hashes(self):
+        patches = []
+        for patch in self.config["kernel"].get("patches", []):
+            if os.path.isfile(patch):
+                patches.append(BuildCache.hash_file(patch))
+            else:
+                logger.warning(
+                    f"Patch {patch} not readable, keying the kernel cache on its name only"
+                )
+                patches.append(patch)
+        return patches
+
+    """Key of the pristine source tree: the tarball plus the patches applied to it"""
+
+    def source_cache_key(self):
+        return BuildCache.make_key(
+            {
+                "version": self.config["kernel"]["version"],
+                "url": self.kernel_source_url(),
+                "sha256": self.config["kernel"].get("sha256"),
+                "patches": self.patch_hashes(),
+            }
+        )
+
+    """
+    Return <workspace>/kernel-obj, a link to the object directory in the build cache
+    that make O= builds into. It is keyed like the kernel image, so recipes whose
+    kernel configuration is identical build in, and reuse, the same objects.
+    """
+
+    def object_dir(self, workspace, cache_key):
+        entry_dir = self.cache.open_entry(
+            "kernel-obj",
+            cache_key,
+            description=f"linux-{self.config['kernel']['version']} {self.target_arch} objects",
+        )
+        cached_obj_dir = os.path.join(entry_dir, "obj")
+        os.makedirs(cached_obj_dir, exist_ok=True)
+
+        obj_dir = os.path.join(workspace, "kernel-obj")
+        if os.path.islink(obj_dir):
+            os.remove(obj_dir)
+        elif os.path.isdir(obj_dir):
+            shutil.rmtree(obj_dir)
+        os.symlink(cached_obj_dir, obj_dir)
+        return obj_dir
+
+    def store_kernel_in_cache(self, cache_key, obj_dir):
+        kernel_image_path = os.path.join(
+            obj_dir, "arch", self.kernel_arch, "boot", self.kernel_image
+        )
+        self.store_kernel_files(
+            cache_key, kernel_image_path, os.path.join(obj_dir, ".config")
+        )
+
+    """Cache a kernel image and its .config, e.g. ones built by a remote worker"""
+
+    def store_kernel_files(self, cache_key, kernel_image_path, config_path, move=False):
+        self.cache.store(
+            "kernel",
+            cache_key,
+            {self.kernel_image: kernel_image_path, "config": config_path},
+            description=f"linux-{self.config['kernel']['version']} {self.target_arch}",
+            move=move,
+        )
+
     def setup_directories(self, workspace):
         dir_paths = {
             "kernel_dir": os.path.join(workspace, "kernel"),
@@ -66,68 +340,114 @@ class KernelBuilder:
             os.makedirs(dir_path, exist_ok=True)
         return dir_paths
 
-    def handle_kernel_source(self, workspace):
+    """
+    Return the shared, read-only kernel source tree for this version and patch set.
+    On first use it is extracted from a tarball placed in <workspace>/kernel or from the
+    source cache, downloading it from the kernel URL or kernel.mirrors first if needed,
+    then patched and moved into the build cache. kernel.sha256 in the recipe pins the tarball.
+    """
+
+    def handle_kernel_source(self, workspace, keep_tarball=False):
         kernel_version = self.config["kernel"]["version"]
         kernel_dir = os.path.join(workspace, "kernel")
         kernel_tar_path = os.path.join(kernel_dir, f"linux-{kernel_version}.tar.xz")
 
-        if not os.path.exists(kernel_tar_path):
-            logger.info("Kernel source tarball does not exist, downloading...")
-            kernel_url = self.config["kernel"].get("url")
-            self.download_kernel_source(kernel_version, kernel_tar_path, url=kernel_url)
+        source_key = self.source_cache_key()
+        cached_entry = self.cache.lookup("kernel-source", source_key)
+        if cached_entry:
+            logger.info(f"Using shared kernel source tree {source_key[:12]}")
+            return os.path.join(cached_entry, "source")
+
+        with self.cache.lock("kernel-source", source_key):
+            # Another build may have populated it while we waited for the lock
+            cached_entry = self.cache.lookup("kernel-source", source_key)
+            if cached_entry:
+                return os.path.join(cached_entry, "source")
+
+            # Extract next to the cache entries so moving the tree in is a rename
+            staging_dir = tempfile.mkdtemp(
+                prefix=".extract-",
+                dir=os.path.dirname(self.cache.entry_path("kernel-source", source_key)),
+            )
+            try:
+                url = self.kernel_source_url()
+                sha256 = self.config["kernel"].get("sha256")
+                cached_tarball = self.sources.lookup(url, sha256)
+                if os.path.exists(kernel_tar_path):
+                    logger.info(f"Extracting {kernel_tar_path}")
+                    extracted_kernel_dir = self.extract_kernel_tarball(
+                        kernel_tar_path, staging_dir
+                    )
+                elif cached_tarball:
+                    logger.info(f"Extracting cached kernel source {cached_tarball}")
+                    extracted_kernel_dir = self.extract_kernel_tarball(
+                        cached_tarball, staging_dir
+                    )
+                else:
+                    logger.info("Kernel source tarball does not exist, downloading...")
+                    cached_tarball = self.sources.fetch(
+                        url, sha256, mirrors=self.config["kernel"].get("mirrors", [])
+                    )
+                    extracted_kernel_dir = self.extract_kernel_tarball(
+                        cached_tarball, staging_dir
+                    )
+                    if keep_tarball:
+                        os.makedirs(kernel_dir, exist_ok=True)
+                        shutil.copy(cached_tarball, kernel_tar_path)
 
-        logger.info("Extracting tar")
-        extracted_kernel_dir = self.extract_kernel_tarball(kernel_tar_path, kernel_dir)
+                if "patches" in self.config["kernel"]:
+                    self.apply_patches(
+                        self.config["kernel"]["patches"], extracted_kernel_dir
+                    )
+                # Builds only ever write to their O= object directory
+                self.make_read_only(extracted_kernel_dir)
+                cached_entry = self.cache.store(
+                    "kernel-source",
+                    source_key,
+                    {"source": extracted_kernel_dir},
+                    description=f"linux-{kernel_version} source",
+                    move=True,
+                )
+            finally:
+                BuildCache.remove_tree(staging_dir)
 
-        if os.path.exists(extracted_kernel_dir):
-            logger.info("Extracted kernel directory exists....")
-            return extracted_kernel_dir
-        else:
-            raise Exception("Failed to locate the extracted kernel source directory.")
+        return os.path.join(cached_entry, "source")
 
-    """Download the kernel source tarball, optionally with a specified URL"""
+    @staticmethod
+    def make_read_only(root_dir):
+        for dir_path, dir_names, file_names in os.walk(root_dir, topdown=False):
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if not os.path.islink(path):
+                    os.chmod(path, os.lstat(path).st_mode & ~0o222)
+            os.chmod(dir_path, os.lstat(dir_path).st_mode & ~0o222)
 
-    def download_kernel_source(self, kernel_version, download_path, url=None):
-        if url is None:
-            url = f"https://cdn.kernel.org/pub/linux/kernel/v6.x/linux-{kernel_version}.tar.xz"
+    """URL of the kernel source tarball, the recipe's kernel.url or the kernel.org release"""
 
-        try:
-            response = requests.get(url, stream=True)
-            if response.status_code == 200:
-                total_size_in_bytes = int(response.headers.get("content-length", 0))
-                chunk_size = 1024
-                progress_bar = tqdm(
-                    total=total_size_in_bytes, unit="iB", unit_scale=True
-                )
+    def kernel_source_url(self):
+        kernel_version = self.config["kernel"]["version"]
+        url = self.config["kernel"].get("url")
+        if url is None:
+            major = kernel_version.split(".")[0]
+            url = f"https://cdn.kernel.org/pub/linux/kernel/v{major}.x/linux-{kernel_version}.tar.xz"
+        return url
 
-                with open(download_path, "wb") as f:
-                    for chunk in response.iter_content(chunk_size=chunk_size):
-                        progress_bar.update(len(chunk))
-                        f.write(chunk)
-                progress_bar.close()
+    """Download the kernel source tarball, optionally with a specified URL"""
 
-                if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-                    logger.error(
-                        "WARNING: Downloaded file size does not match expected content length."
-                    )
-            else:
-                logger.error(
-                    f"Error downloading kernel source: HTTP {response.status_code}"
-                )
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error downloading kernel source: {e}")
-            raise Exception(f"Failed to download kernel source due to: {str(e)}")
+    def download_kernel_source(self, kernel_version, download_path, url=None):
+        if url is None:
+            url = self.kernel_source_url()
+        mirrors = self.config["kernel"].get("mirrors", [])
+        SegmentedDownloader().download(
+            [url, *mirrors], download_path, self.config["kernel"].get("sha256")
+        )
 
-    """Extract the kernel source tarball to a specified directory"""
+    """
+    Extract the kernel source tarball to a specified directory, hashing it in the same pass.
+    A tarball that does not match kernel.sha256 is removed again and the build fails.
+    """
 
     def extract_kernel_tarball(self, tar_path, extract_to):
-        if tar_path.endswith(".gz"):
-            tar_open_mode = "r:gz"
-        elif tar_path.endswith(".xz"):
-            tar_open_mode = "r:xz"
-        else:
-            raise ValueError("Unsupported archive format. Please use .gz or .xz files.")
-
         # Try to predict the directory name from the tarball name
         base_name = os.path.basename(tar_path)
         if ".tar" in base_name:
@@ -142,77 +462,169 @@ class KernelBuilder:
             )
             return predicted_dir
 
-        with tarfile.open(tar_path, tar_open_mode) as tar:
-            total_length = sum(member.size for member in tar.getmembers())
-            progress_bar = tqdm(total=total_length, unit="iB", unit_scale=True)
-
-            # Extract and identify the kernel source directory
-            tar.extractall(path=extract_to)
-            progress_bar.close()
+        # One streaming pass decompresses, extracts and hashes the tarball
+        compression = Archive.detect_compression(tar_path)
+        progress_bar = tqdm(total=os.path.getsize(tar_path), unit="iB", unit_scale=True)
+        with open(tar_path, "rb") as f:
+            reader = HashingReader(f, progress_bar=progress_bar)
+            kernel_source_dir = Archive.extract_fileobj(
+                reader, compression, extract_to, base_name
+            )
+            reader.drain()
+        progress_bar.close()
 
-            # Assuming the kernel directory is the first directory in the tarball
-            kernel_source_dir = [
-                member.name.split("/")[0]
-                for member in tar.getmembers()
-                if member.isdir()
-            ][0]
-            return os.path.join(extract_to, kernel_source_dir)
+        try:
+            SourceCache.verify_file(
+                tar_path, self.config["kernel"].get("sha256"), reader.hexdigest()
+            )
+        except Exception:
+            BuildCache.remove_tree(kernel_source_dir)
+            raise
+        return kernel_source_dir
 
     """ Set kernel kconfig options """
 
-    def configure_kernel(self, kernel_config, kernel_dir):
+    def configure_kernel(self, kernel_config, kernel_dir, obj_dir):
         kernel_dir = os.path.abspath(kernel_dir)
         logger.info(f"Checking if directory exists: {kernel_dir}")
         if not os.path.exists(kernel_dir):
             raise FileNotFoundError(f"The directory {kernel_dir} does not exist.")
 
-        logger.info(
-            f'Running "{self.env["CC"]} {self.make_command} tinyconfig" in directory {kernel_dir} for arch {self.env["ARCH"]}'
+        # Start from the cached tinyconfig + profiles base instead of regenerating it
+        shutil.copy(
+            self.base_config(kernel_dir, obj_dir), os.path.join(obj_dir, ".config")
         )
-
-        make_kernel_command = shlex.split(self.make_command) + ["tinyconfig"]
-        HostCommand.run_command(make_kernel_command, cwd=kernel_dir, env=self.env)
         logger.info("Applying kernel configs")
 
-        # Apply custom configurations from TOML
-        for option, raw_value in kernel_config["options"].items():
-            # Remove both single and double quotes
-            value = raw_value.strip("'\"")
-            logger.info(f"Setting {option} to {value}")
-            # Ensure the command is split into separate arguments
-            kconfig_config_command = ["scripts/config", "--set-val", option, value]
-            HostCommand.run_command(
-                kconfig_config_command, cwd=kernel_dir, env=self.env
+        # Apply custom configurations from TOML in memory and write .config once
+        kconfig = KConfig(os.path.join(obj_dir, ".config"))
+        options = kernel_config.get("options", {})
+        kconfig.apply_options(options)
+        kconfig.write()
+        logger.info(f"Applied {len(options)} kernel options")
+
+    """
+    Return the cached base .config for this source, arch and profile set, generating
+    it with tinyconfig, the profile options and olddefconfig in obj_dir on first use
+    """
+
+    def base_config(self, kernel_dir, obj_dir):
+        key = self.base_config_key()
+        cached_entry = self.cache.lookup("kconfig-base", key)
+        if cached_entry:
+            logger.info(f"Using cached base kernel config {key[:12]}")
+            return os.path.join(cached_entry, "config")
+
+        with self.cache.lock("kconfig-base", key):
+            cached_entry = self.cache.lookup("kconfig-base", key)
+            if cached_entry:
+                return os.path.join(cached_entry, "config")
+
+            logger.info(
+                f'Running "{self.kernel_compiler()} {self.make_command} tinyconfig" for source {kernel_dir} in {obj_dir} for arch {self.env["ARCH"]}'
             )
+            self.run_make(["tinyconfig"], kernel_dir, obj_dir, "tinyconfig")
+
+            profiles = self.config["kernel"].get("profiles", [])
+            if profiles:
+                kconfig = KConfig(os.path.join(obj_dir, ".config"))
+                kconfig.apply_options(self.profile_options())
+                kconfig.write()
+                logger.info(f"Applied kernel profiles: {', '.join(profiles)}")
+            self.run_make(["olddefconfig"], kernel_dir, obj_dir, "base-olddefconfig")
+
+            cached_entry = self.cache.store(
+                "kconfig-base",
+                key,
+                {"config": os.path.join(obj_dir, ".config")},
+                description=f"linux-{self.config['kernel']['version']} {self.kernel_arch} "
+                + ("+".join(profiles) or "tinyconfig"),
+            )
+        return os.path.join(cached_entry, "config")
 
     """Apply given patches to the kernel source."""
 
     def apply_patches(self, patches, kernel_dir):
         for patch in patches:
             HostCommand.run_command(
-                ["git", "apply", patch], cwd=kernel_dir, shell=False
+                ["git", "apply", os.path.abspath(patch)],
+                cwd=kernel_dir,
+                shell=False,
+                log_path=self.log_path("patches"),
             )
 
     """"Apply default kconfig selections after applying the user's selections"""
 
-    def apply_default_kernel_options(self, kernel_dir):
+    def apply_default_kernel_options(self, kernel_dir, obj_dir):
         # we need to run make olddefconfig to set default options after applying the user's TOML settings
-        make_kernel_command = shlex.split(self.make_command) + ["olddefconfig"]
-        HostCommand.run_command(make_kernel_command, cwd=kernel_dir, env=self.env)
+        self.run_make(["olddefconfig"], kernel_dir, obj_dir, "olddefconfig")
 
     """Build the configured Linux kernel."""
 
-    def build_kernel(self, kernel_dir):
-        make_kernel_command = shlex.split(self.make_command) + [self.kernel_image]
-        HostCommand.run_command(
-            make_kernel_command, cwd=kernel_dir, timeout=3600, env=self.env
+    def build_kernel(self, kernel_dir, obj_dir):
+        self.run_make(
+            [self.kernel_image],
+            kernel_dir,
+            obj_dir,
+            "build",
+            timeout=3600,
+            progress=True,
         )
 
+    def log_path(self, phase):
+        return os.path.join(self.log_dir, f"{phase}.log") if self.log_dir else None
+
+    """
+    Run make on the read-only source tree with its output in obj_dir, streaming
+    output to the phase's log when a log dir is set
+    """
+
+    def run_make(
+        self, targets, kernel_dir, obj_dir, phase, timeout=None, progress=False
+    ):
+        make_kernel_command = shlex.split(self.make_command) + [
+            "-C",
+            kernel_dir,
+            f"O={os.path.abspath(obj_dir)}",
+        ]
+        env = self.env
+        if self.ccache:
+            # Kbuild ignores CC from the environment, it has to be a make variable.
+            # ccache wraps the compilers kbuild would run without it, never the host $CC
+            make_kernel_command += [
+                f"CC={self.ccache.wrap(self.kernel_compiler())}",
+                f"HOSTCC={self.ccache.wrap(self.host_compiler())}",
+            ]
+            env = {
+                **self.env,
+                # Source and object trees both live below the cache directory
+                **self.ccache.env(f"kernel-{phase}", self.cache.cache_dir),
+            }
+        elif os.getenv("KERNEL_CC"):
+            make_kernel_command.append(f"CC={os.getenv('KERNEL_CC')}")
+        make_kernel_command += targets
+
+        pass_fds = ()
+        slot = contextlib.nullcontext()
+        if self.jobserver is not None:
+            env, pass_fds = self.jobserver.client_env(env)
+            slot = self.jobserver.slot(make_kernel_command)
+        with slot:
+            HostCommand.run_command(
+                make_kernel_command,
+                cwd=obj_dir,
+                timeout=timeout,
+                env=env,
+                log_path=self.log_path(phase),
+                progress=f"kernel {phase}" if progress else None,
+                pass_fds=pass_fds,
+            )
+
     """"Copy the kernel to the output_vm directory"""
 
-    def copy_kernel_to_output(self, kernel_dir, output_dir):
+    def copy_kernel_to_output(self, obj_dir, output_dir):
         kernel_image_path = os.path.join(
-            kernel_dir, "arch", self.kernel_arch, "boot", self.kernel_image
+            obj_dir, "arch", self.kernel_arch, "boot", self.kernel_image
         )
         logger.info(f"Copying kernel from {kernel_image_path} to {output_dir}")
 
@@ -0,0 +1,436 @@
+import base64
+import contextlib
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from msmv.builders.application import ApplicationBuilder
+from msmv.builders.kernel import KernelBuilder
+from msmv.util.build_cache import BuildCache
+from msmv.util.ccache import CCache
+from msmv.util.cpu_budget import CpuBudget
+from msmv.util.host_command import CommandError
+from msmv.util.jobserver import Jobserver
+from msmv.util.source_cache import SourceCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Build kernels and applications on other machines. A worker (msmv worker) receives the
+inputs of one phase over HTTP: the recipe's kernel section with the contents of its
+patches, or an application's recipe table. It builds the phase with its own source
+cache, build cache and jobserver and keeps the results as artifacts named by their
+sha256. The coordinator (msmv build --workers) hands phases to idle workers, builds
+them itself when every worker is busy, and pulls the artifacts back by hash.
+Workers run whatever build commands they are sent, so every request must carry the
+shared MSMV_WORKER_TOKEN, and a worker without one only listens on loopback.
+"""
+
+
+class RemoteBuildError(CommandError):
+    def __init__(self, worker, label, error, log_tail=()):
+        super().__init__([label], log_tail=log_tail)
+        self.worker = worker
+        self.label = label
+        self.error = error
+
+    def __str__(self):
+        return f"Building {self.label} on worker {self.worker} failed: {self.error}"
+
+
+class BuildWorker:
+    DEFAULT_ADDRESS = "127.0.0.1:8700"
+    ARTIFACT_RE = re.compile(r"^/artifacts/([0-9a-f]{64})$")
+    TOKEN_ENV = "MSMV_WORKER_TOKEN"
+    TOKEN_HEADER = "X-MSMV-Worker-Token"
+
+    def __init__(self, address, work_dir, ccache_dir=None, token=None):
+        self.token = token or os.getenv(self.TOKEN_ENV)
+        self.address = WorkerPool.parse_address(address)
+        if not self.token and not self.is_loopback(self.address[0]):
+            raise Exception(
+                f"Refusing to listen on {address} without a token, set "
+                f"{self.TOKEN_ENV} on the worker and the coordinator"
+            )
+        self.work_dir = os.path.abspath(work_dir)
+        self.artifacts_dir = os.path.join(self.work_dir, "artifacts")
+        os.makedirs(self.artifacts_dir, exist_ok=True)
+        # None disables ccache, an empty string uses the default ccache directory
+        self.ccache_dir = ccache_dir
+        self.cache = BuildCache()
+        # Concurrent requests share this worker's job budget
+        self.jobs = CpuBudget.jobs()
+        self.jobserver = Jobserver.start(self.jobs)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.server = ThreadingHTTPServer(self.address, WorkerRequestHandler)
+        self.server.worker = self
+
+    def serve(self):
+        host, port = self.server.server_address[:2]
+        logger.info(f"Build worker listening on {host}:{port} with {self.jobs} jobs")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Stopping build worker")
+        finally:
+            self.server.server_close()
+            if self.jobserver is not None:
+                self.jobserver.close()
+
+    @staticmethod
+    def is_loopback(host):
+        if host == "localhost":
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+
+    """Whether a request carries this worker's token, any request does without one"""
+
+    def authorized(self, headers):
+        if not self.token:
+            return True
+        return hmac.compare_digest(
+            headers.get(self.TOKEN_HEADER, "").encode(), self.token.encode()
+        )
+
+    def status(self):
+        with self.lock:
+            return {"jobs": self.jobs, "running": self.running}
+
+    @contextlib.contextmanager
+    def track(self):
+        with self.lock:
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def ccache(self, log_dir):
+        if self.ccache_dir is None:
+            return None
+        return CCache(
+            self.ccache_dir or None, stats_dir=os.path.join(log_dir, "ccache")
+        )
+
+    def artifact_path(self, sha256):
+        return os.path.join(self.artifacts_dir, sha256)
+
+    """Add a file to the artifact store and return the sha256 it is served under"""
+
+    def publish(self, path):
+        sha256 = BuildCache.hash_file(path)
+        artifact_path = self.artifact_path(sha256)
+        if not os.path.exists(artifact_path):
+            tmp_path = f"{artifact_path}.{threading.get_ident()}.tmp"
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, artifact_path)
+        return sha256
+
+    def build_kernel(self, request):
+        key = BuildCache.make_key(request)
+        workspace = os.path.join(self.work_dir, "kernel", key[:16])
+        os.makedirs(workspace, exist_ok=True)
+
+        # Patches arrive by content and are written where the recipe now points
+        config = request["config"]
+        config["kernel"] = dict(config["kernel"])
+        if request.get("patches"):
+            config["kernel"]["patches"] = []
+            for index, content in enumerate(request["patches"]):
+                patch_path = os.path.join(workspace, f"{index:04d}.patch")
+                with open(patch_path, "wb") as f:
+                    f.write(base64.b64decode(content))
+                config["kernel"]["patches"].append(patch_path)
+
+        log_dir = os.path.join(workspace, "logs")
+        kernel_builder = KernelBuilder(
+            config,
+            log_dir=log_dir,
+            ccache=self.ccache(log_dir),
+            jobserver=self.jobserver,
+        )
+        with self.cache.lock("worker-kernel", key):
+            kernel_path = kernel_builder.setup_and_build_kernel(workspace)
+            return {
+                "cache_key": kernel_builder.kernel_cache_key(),
+                "artifacts": {
+                    "image": self.publish(kernel_path["kernel_image"]),
+                    "config": self.publish(kernel_path["kernel_config"]),
+                },
+            }
+
+    def build_app(self, request):
+        key = BuildCache.make_key(request)
+        name = request["name"]
+        app_details = request["app"]
+        app_dir = os.path.join(self.work_dir, "applications", f"{name}-{key[:12]}")
+        destdir = os.path.join(app_dir, "destdir")
+        log_dir = os.path.join(app_dir, "logs")
+
+        app_builder = ApplicationBuilder(
+            app_details,
+            destdir,
+            log_dir=log_dir,
+            ccache=self.ccache(log_dir),
+            name=name,
+            jobserver=self.jobserver,
+            target_arch=request.get("target_arch"),
+            cache=self.cache,
+        )
+        with self.cache.lock("worker-app", key):
+            # Served straight from this worker's install cache when it built it before
+            archive_path = app_builder.cached_install()
+            if archive_path is not None:
+                logger.info(f"Serving cached install of {name}")
+            else:
+                app_builder.setup_and_build_app(app_dir)
+                archive_path = app_builder.store_install()
+            return {
+                "artifacts": {"destdir": self.publish(archive_path)},
+                # Lets the coordinator key the install without fetching the source
+                "source_sha256": app_builder.source_sha256(),
+            }
+
+
+class WorkerRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self):
+        if self.server.worker.authorized(self.headers):
+            return True
+        self.send_json(401, {"error": f"Missing or wrong {BuildWorker.TOKEN_HEADER}"})
+        return False
+
+    def do_GET(self):
+        worker = self.server.worker
+        if not self.authorized():
+            return
+        if self.path == "/status":
+            return self.send_json(200, worker.status())
+
+        match = BuildWorker.ARTIFACT_RE.match(self.path)
+        if not match or not os.path.exists(worker.artifact_path(match.group(1))):
+            return self.send_json(404, {"error": f"No artifact at {self.path}"})
+        artifact_path = worker.artifact_path(match.group(1))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(artifact_path)))
+        self.end_headers()
+        with open(artifact_path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_POST(self):
+        worker = self.server.worker
+        if not self.authorized():
+            return
+        phases = {"/build/kernel": worker.build_kernel, "/build/app": worker.build_app}
+        if self.path not in phases:
+            return self.send_json(404, {"error": f"Unknown phase {self.path}"})
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+            with worker.track():
+                result = phases[self.path](request)
+        except CommandError as e:
+            logger.error(f"{self.path} failed: {e}")
+            return self.send_json(500, {"error": str(e), "log_tail": e.log_tail})
+        # Builders report some user errors by exiting, the worker must keep serving
+        except (Exception, SystemExit) as e:
+            logger.error(f"{self.path} failed: {e}")
+            return self.send_json(500, {"error": str(e) or type(e).__name__})
+        self.send_json(200, result)
+
+
+"""
+The coordinator's side: the workers that answered at startup, and the phases sent to
+them. A worker that stops answering is dropped and its phase built locally.
+"""
+
+
+class WorkerPool:
+    CONNECT_TIMEOUT = 10
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, addresses, token=None):
+        token = token or os.getenv(BuildWorker.TOKEN_ENV)
+        self.headers = {BuildWorker.TOKEN_HEADER: token} if token else {}
+        self.idle = queue.Queue()
+        self.workers = []
+        for address in addresses:
+            host, port = self.parse_address(address)
+            url = f"http://{host}:{port}"
+            try:
+                response = requests.get(
+                    f"{url}/status", headers=self.headers, timeout=self.CONNECT_TIMEOUT
+                )
+                response.raise_for_status()
+                status = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning(f"Build worker {address} is not available: {e}")
+                continue
+            logger.info(f"Build worker {url} has {status['jobs']} jobs")
+            self.workers.append(url)
+            self.idle.put(url)
+
+    """Split HOST:PORT, a bare :PORT or PORT listens on or connects to localhost"""
+
+    @staticmethod
+    def parse_address(address):
+        host, _, port = address.rpartition(":")
+        return host or "127.0.0.1", int(port)
+
+    """
+    Run a phase on an idle worker and return (worker URL, response), or (None, None)
+    if no worker is idle or the worker could not be reached
+    """
+
+    def submit(self, phase, request, label):
+        try:
+            url = self.idle.get_nowait()
+        except queue.Empty:
+            return None, None
+
+        logger.info(f"Building {label} on worker {url}")
+        try:
+            # Builds take as long as they take, only connecting is bounded
+            response = requests.post(
+                f"{url}/build/{phase}",
+                json=request,
+                headers=self.headers,
+                timeout=(self.CONNECT_TIMEOUT, None),
+            )
+            body = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"Lost build worker {url}, building {label} locally: {e}")
+            return None, None
+        self.idle.put(url)
+
+        if response.status_code != 200:
+            raise RemoteBuildError(
+                url, label, body.get("error"), body.get("log_tail", ())
+            )
+        return url, body
+
+    """Download an artifact and check that its content matches the hash it was asked by"""
+
+    def fetch(self, url, sha256, dest_path):
+        digest = hashlib.sha256()
+        with requests.get(
+            f"{url}/artifacts/{sha256}",
+            headers=self.headers,
+            stream=True,
+            timeout=(self.CONNECT_TIMEOUT, None),
+        ) as response:
+            response.raise_for_status()
+            with open(dest_path, "wb") as f:
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+        if digest.hexdigest() != sha256:
+            raise Exception(f"Artifact {sha256} from {url} has a different sha256")
+        return dest_path
+
+    """
+    Build the kernel on a worker and store it in the local kernel cache, so the local
+    build finds it there. False if no worker took it or it built a different kernel.
+    """
+
+    def build_kernel(self, kernel_builder):
+        cache_key = kernel_builder.kernel_cache_key()
+        # Recipes sharing this kernel wait for it rather than send it out again. Not the
+        # kernel-obj lock, a worker sharing this cache takes that one to build
+        with kernel_builder.cache.lock("kernel-remote", cache_key):
+            if kernel_builder.cached_kernel():
+                return True
+
+            kernel_config = kernel_builder.config["kernel"]
+            patches = []
+            for patch in kernel_config.get("patches", []):
+                with open(patch, "rb") as f:
+                    patches.append(base64.b64encode(f.read()).decode())
+            request = {
+                "config": {
+                    "general": {"target_arch": kernel_builder.target_arch},
+                    "kernel": kernel_config,
+                },
+                "patches": patches,
+            }
+            url, result = self.submit("kernel", request, f"kernel {cache_key[:12]}")
+            if result is None:
+                return False
+            # A kernel from a different toolchain is not the one this key stands for
+            if result["cache_key"] != cache_key:
+                logger.warning(
+                    f"Worker {url} keyed the kernel {result['cache_key'][:12]}, its "
+                    f"toolchain differs from this host's, building {cache_key[:12]} locally"
+                )
+                return False
+
+            with tempfile.TemporaryDirectory(dir=kernel_builder.cache.cache_dir) as tmp:
+                artifacts = result["artifacts"]
+                kernel_builder.store_kernel_files(
+                    cache_key,
+                    self.fetch(url, artifacts["image"], os.path.join(tmp, "image")),
+                    self.fetch(url, artifacts["config"], os.path.join(tmp, "config")),
+                    move=True,
+                )
+        return True
+
+    """Build an application on a worker and unpack its DESTDIR. False if no worker took it."""
+
+    def build_app(self, app_builder):
+        request = {
+            "name": app_builder.name,
+            "app": app_builder.config,
+            "target_arch": app_builder.target_arch,
+        }
+        url, result = self.submit("app", request, app_builder.name)
+        if result is None:
+            return False
+
+        # The installed tree goes into the local install cache like a local build's,
+        # keyed by the source archive the worker built
+        if result.get("source_sha256"):
+            SourceCache(app_builder.cache).record(
+                app_builder.config["url"], result["source_sha256"]
+            )
+        with tempfile.TemporaryDirectory(dir=app_builder.cache.cache_dir) as tmp:
+            archive_path = app_builder.store_install(
+                self.fetch(
+                    url,
+                    result["artifacts"]["destdir"],
+                    os.path.join(tmp, ApplicationBuilder.INSTALL_ARCHIVE),
+                )
+            )
+            app_builder.unpack_install(archive_path)
+        logger.info(
+            f"Installed {app_builder.name} built on {url} into {app_builder.rootfs_path}"
+        )
+        return True
@@ -1,9 +1,15 @@
+import contextlib
+import hashlib
+import json
 import logging
 import os
+import shutil
 import stat
-import subprocess
+import time
 
-from msmv.util.host_command import HostCommand
+from msmv.builders.compression import InitramfsCompressor
+from msmv.builders.cpio import CpioWriter
+from msmv.util.build_cache import BuildCache
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -13,22 +19,16 @@ USE_C_INIT = True
 
 
 class RootFSBuilder:
-    def __init__(self, rootfs_path):
-        self.rootfs_path = rootfs_path
-
-    """Check if the device node exists and is of the correct type"""
+    DEVICE_NODES = [
+        ("console", "c", 5, 1),
+        ("ttyS0", "c", 4, 64),
+        ("tty", "c", 5, 0),
+        ("ram0", "b", 1, 0),
+    ]
 
-    def device_node_exists(self, path, type_):
-        try:
-            if os.path.exists(path):
-                st = os.stat(path)
-                if (type_ == "c" and stat.S_ISCHR(st.st_mode)) or (
-                    type_ == "b" and stat.S_ISBLK(st.st_mode)
-                ):
-                    return True
-        except Exception as e:
-            logger.error(f"Error checking device at {path}: {str(e)}")
-        return False
+    def __init__(self, rootfs_path, cache=None):
+        self.rootfs_path = rootfs_path
+        self.cache = cache
 
     def setup_rootfs(self):
         # root_dir = os.path.join(output_dir, "root")
@@ -73,85 +73,209 @@ class RootFSBuilder:
         self.create_device_nodes(output_dir)
 
     def create_device_nodes(self, output_dir):
-        # Create device nodes
-        # need root privileges to create device nodes
-        # does not work otherwise lol
-        device_nodes = [
-            ("console", "c", "5", "1"),
-            ("ttyS0", "c", "4", "64"),
-            ("tty", "c", "5", "0"),
-            ("ram0", "b", "1", "0"),
+        # Device nodes are not created on disk (that needs root privileges),
+        # they are written into the cpio archive as synthetic entries instead
+        os.makedirs(os.path.join(output_dir, "dev"), exist_ok=True)
+        for node, type_, major, minor in self.DEVICE_NODES:
+            logger.info(
+                f"Device node {os.path.join('dev', node)} ({type_} {major}:{minor}) will be added to the archive"
+            )
+
+    """Device nodes as (archive path, type, major, minor) entries for CpioWriter"""
+
+    def device_node_entries(self):
+        return [
+            (os.path.join("dev", node), type_, major, minor)
+            for node, type_, major, minor in self.DEVICE_NODES
         ]
-        for node, type_, major, minor in device_nodes:
-            device_path = os.path.join("dev", node)
-            o_device_path = os.path.join(output_dir, "dev", node)
-            if not self.device_node_exists(o_device_path, type_):
-                logger.info(
-                    f"Creating device nodes in {output_dir} with path {device_path}"
-                )
-                HostCommand.run_command(
-                    ["sudo", "mknod", device_path, type_, major, minor], output_dir
-                )
-                HostCommand.run_command(
-                    ["sudo", "chmod", "666", device_path], output_dir
-                )
-                logger.info("Finished creating device nodes")
-            else:
-                logger.info(f"Device node {device_path} already exists")
-
-    def make_compressed_cpio(self, output_dir):
-        # Create cpio archive without compression
-        HostCommand.run_command(
-            [
-                "find",
-                output_dir,
-                "-print0",
-                "|",
-                "cpio",
-                "--null",
-                "-ov",
-                "--format=newc",
-                ">",
-                f"{output_dir}/rootfs.cpio",
-            ]
+
+    """Write the rootfs as a cpio archive streamed through the given compression method"""
+
+    def make_compressed_cpio(self, rootfs_path, output_dir, compression="gzip"):
+        os.makedirs(output_dir, exist_ok=True)
+
+        compressor = InitramfsCompressor(compression)
+        cpio_path = os.path.abspath(
+            os.path.join(output_dir, "rootfs.cpio" + compressor.suffix)
         )
 
-        # Compress the cpio archive
-        HostCommand.run_command(
-            ["gzip", "-9", f"{output_dir}/rootfs.cpio"], cwd=output_dir
+        with compressor.open_stream(cpio_path) as cpio_stream:
+            writer = CpioWriter(cpio_stream)
+            writer.add_tree(rootfs_path, self.device_node_entries())
+            writer.close()
+
+        logger.info(
+            f"{compression} CPIO archive created at: {cpio_path} "
+            f"({writer.offset} bytes uncompressed, {os.path.getsize(cpio_path)} compressed)"
         )
+        return cpio_path
 
     def make_uncompressed_cpio(self, rootfs_path, output_dir):
-        # Save the current directory before changing it
-        current_dir = os.getcwd()
-
         # Ensure the output directory exists
         os.makedirs(output_dir, exist_ok=True)
 
         # Define the path for the cpio file
-        cpio_path = os.path.join(current_dir, output_dir, "rootfs.cpio")
+        cpio_path = os.path.abspath(os.path.join(output_dir, "rootfs.cpio"))
+
+        # Archive paths are relative to the rootfs, no need to chdir into it
+        with open(cpio_path, "wb") as cpio_file:
+            writer = CpioWriter(cpio_file)
+            writer.add_tree(rootfs_path, self.device_node_entries())
+            writer.close()
+
+        logger.info(
+            f"CPIO archive created successfully at: {cpio_path} ({writer.offset} bytes)"
+        )
+        return cpio_path
+
+    """
+    Hash the names, types, modes and contents of every entry below root_dir. With
+    hash_cache_path, file hashes are remembered by (path, size, mtime) and only files
+    that changed since the last call are read again.
+    """
+
+    @staticmethod
+    def tree_hash(root_dir, hash_cache_path=None):
+        known = RootFSBuilder.read_hash_cache(hash_cache_path)
+        file_hashes = {}
+        # A file written within the mtime resolution of now could change again
+        # without its mtime moving, so it is not remembered yet
+        racy_after = time.time_ns() - 1_000_000_000
 
-        # Change directory to the rootfs path to ensure relative paths in the cpio archive
-        os.chdir(rootfs_path)
+        sha256 = hashlib.sha256()
+        for dir_path, dir_names, file_names in os.walk(root_dir):
+            dir_names.sort()
+            for name in sorted(dir_names + file_names):
+                path = os.path.join(dir_path, name)
+                relative_path = os.path.relpath(path, root_dir)
+                st = os.lstat(path)
+                sha256.update(f"{relative_path}\0{st.st_mode:o}\0".encode())
+                if stat.S_ISLNK(st.st_mode):
+                    sha256.update(os.readlink(path).encode())
+                elif stat.S_ISREG(st.st_mode):
+                    file_stat = [st.st_size, st.st_mtime_ns]
+                    cached = known.get(relative_path)
+                    if cached and cached[:2] == file_stat:
+                        file_hash = cached[2]
+                    else:
+                        file_hash = BuildCache.hash_file(path)
+                    if st.st_mtime_ns < racy_after:
+                        file_hashes[relative_path] = file_stat + [file_hash]
+                    sha256.update(file_hash.encode())
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                    sha256.update(f"{st.st_rdev}".encode())
+                sha256.update(b"\0")
 
-        # Command to find files and output null-separated names
-        find_command = ["find", ".", "-print0"]
+        if hash_cache_path:
+            tmp_path = hash_cache_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(file_hashes, f)
+            os.replace(tmp_path, hash_cache_path)
+        return sha256.hexdigest()
 
-        # Command to create cpio archive, with output directed to a file
-        cpio_command = ["cpio", "--null", "-ov", "--format=newc"]
+    @staticmethod
+    def read_hash_cache(hash_cache_path):
+        if not hash_cache_path:
+            return {}
+        try:
+            with open(hash_cache_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    """Cache key of a layer: its content hash, device nodes and compression"""
+
+    def layer_key(self, name, layer_dir, output_dir, compression, device_nodes=()):
+        layers_dir = os.path.join(output_dir, "layers")
+        os.makedirs(layers_dir, exist_ok=True)
+        return BuildCache.make_key(
+            {
+                "tree": self.tree_hash(
+                    layer_dir, os.path.join(layers_dir, f"{name}.hashes.json")
+                ),
+                "device_nodes": [list(node) for node in device_nodes],
+                "compression": compression,
+            }
+        )
+
+    """
+    Archive one layer directory, reusing the cached archive when the layer's
+    content hash has been archived before. Returns the archive path.
+    """
+
+    def make_layer(
+        self, name, layer_dir, output_dir, compression, cache_key, device_nodes=()
+    ):
+        compressor = InitramfsCompressor(compression)
+        archive_name = "layer.cpio" + compressor.suffix
+
+        cached_entry = self.cache.lookup("layers", cache_key) if self.cache else None
+        if cached_entry:
+            logger.info(f"Reusing cached {name} layer {cache_key[:12]}")
+            return os.path.join(cached_entry, archive_name)
+
+        logger.info(f"Archiving {name} layer from {layer_dir}")
+        layer_path = os.path.join(
+            output_dir, "layers", f"{name}.cpio{compressor.suffix}"
+        )
+        with compressor.open_stream(layer_path) as layer_stream:
+            writer = CpioWriter(layer_stream)
+            writer.add_tree(layer_dir, device_nodes)
+            writer.close()
 
-        # Run find and pipe to cpio
-        stdout, stderr = HostCommand.run_command(
-            find_command,
-            cwd=self.rootfs_path,
-            next_command=cpio_command,
-            stdout=open(cpio_path, "wb"),
-            binary_mode=True,
-            verbose=False,
+        if not self.cache:
+            return layer_path
+        cached_entry = self.cache.store(
+            "layers",
+            cache_key,
+            {archive_name: layer_path},
+            description=f"{name} layer ({compression})",
+            move=True,
         )
+        return os.path.join(cached_entry, archive_name)
 
-        # Restore the original working directory
-        os.chdir(current_dir)
+    """
+    Build the initramfs as a concatenation of per-layer cpio archives, which the
+    kernel unpacks in order, so later layers override files from earlier ones.
+    layers is a list of (name, directory) pairs; the first one is the base layer
+    and also receives the synthetic device nodes.
+    """
+
+    def make_layered_cpio(self, layers, output_dir, compression="none"):
+        os.makedirs(output_dir, exist_ok=True)
+        compressor = InitramfsCompressor(compression)
+        cpio_path = os.path.abspath(
+            os.path.join(output_dir, "rootfs.cpio" + compressor.suffix)
+        )
+
+        layer_specs = []
+        for index, (name, layer_dir) in enumerate(layers):
+            device_nodes = self.device_node_entries() if index == 0 else ()
+            cache_key = self.layer_key(
+                name, layer_dir, output_dir, compression, device_nodes
+            )
+            layer_specs.append((name, layer_dir, cache_key, device_nodes))
 
-        # TODO: Check if the cpio operation was successful
-        logger.info(f"CPIO archive created successfully at: {cpio_path}")
+        with contextlib.ExitStack() as stack:
+            if self.cache:
+                # Cached layers must not be evicted before they are concatenated. The
+                # locks are taken in key order, so builds sharing layers cannot deadlock
+                for cache_key in sorted({spec[2] for spec in layer_specs}):
+                    stack.enter_context(self.cache.lock("layers", cache_key))
+
+            layer_files = []
+            for name, layer_dir, cache_key, device_nodes in layer_specs:
+                layer_path = self.make_layer(
+                    name, layer_dir, output_dir, compression, cache_key, device_nodes
+                )
+                layer_files.append(stack.enter_context(open(layer_path, "rb")))
+
+            with open(cpio_path, "wb") as cpio_file:
+                for layer_file in layer_files:
+                    shutil.copyfileobj(layer_file, cpio_file, 1024 * 1024)
+
+        logger.info(
+            f"CPIO archive created from {len(layer_files)} layers at: {cpio_path} "
+            f"({os.path.getsize(cpio_path)} bytes)"
+        )
+        return cpio_path
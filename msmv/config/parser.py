@@ -22,3 +22,9 @@ class ConfigParser:
             first_app_key = next(iter(applications))
             return applications[first_app_key]
         return None
+
+    """Get every application from the applications section as (key, details) pairs, in recipe order"""
+
+    @staticmethod
+    def get_applications(config):
+        return list(config.get("applications", {}).items())
@@ -1,8 +1,10 @@
+import functools
 import logging
 import os
 import shutil
 import subprocess
 
+from msmv.util.build_cache import BuildCache
 from msmv.util.host_command import HostCommand
 
 logger = logging.getLogger(__name__)
@@ -12,6 +14,71 @@ logging.basicConfig(level=logging.INFO)
 
 
 class ApplicationHelpers:
+    HELPER_COMPILER = "gcc"
+
+    """Identify the helper compiler and the target it produces code for"""
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def compiler_identity(compiler="gcc"):
+        identity = []
+        for flag in ["--version", "-dumpmachine"]:
+            try:
+                result = subprocess.run(
+                    [compiler, flag], capture_output=True, text=True, check=True
+                )
+                identity.append(result.stdout.splitlines()[0])
+            except (OSError, subprocess.CalledProcessError, IndexError):
+                identity.append(compiler)
+        return tuple(identity)
+
+    """
+    Statically compile a generated C helper, reusing a cached binary when the same
+    source was already built with the same compiler for the recipe's target_arch.
+    The cache is shared across recipes and workspaces.
+    """
+
+    @staticmethod
+    def compile_static_helper(
+        c_source, c_file_path, executable_path, cache=None, target_arch=None
+    ):
+        cache = cache or BuildCache()
+        compiler_version, target = ApplicationHelpers.compiler_identity(
+            ApplicationHelpers.HELPER_COMPILER
+        )
+        cache_key = BuildCache.make_key(
+            {
+                "source": c_source,
+                "compiler": compiler_version,
+                "target": target,
+                "target_arch": target_arch,
+            }
+        )
+        binary_name = os.path.basename(executable_path)
+
+        cached_entry = cache.lookup("helpers", cache_key)
+        if cached_entry:
+            logger.info(f"Using cached {binary_name} helper {cache_key[:12]}")
+            shutil.copy(os.path.join(cached_entry, binary_name), executable_path)
+            return executable_path
+
+        HostCommand.run_command(
+            [
+                ApplicationHelpers.HELPER_COMPILER,
+                c_file_path,
+                "-o",
+                executable_path,
+                "-static",
+            ],
+            cwd=os.path.dirname(executable_path),
+        )
+        cache.store(
+            "helpers",
+            cache_key,
+            {binary_name: executable_path},
+            description=f"{binary_name} ({target_arch or target})",
+        )
+        return executable_path
 
     """
     This method compiles a statically linked init binary
@@ -22,7 +89,9 @@ class ApplicationHelpers:
     """
 
     @staticmethod
-    def compile_init_c(output_dir, start_program_path="/bin/sh", include_net=True):
+    def compile_init_c(
+        output_dir, start_program_path="/bin/sh", include_net=True, target_arch=None
+    ):
         # Split the start_program_path into parts for argv
         program_parts = start_program_path.split()
         program_args = ", ".join(f'"{part}"' for part in program_parts) + ", NULL"
@@ -105,16 +174,12 @@ class ApplicationHelpers:
             f"C init script written to {init_c_path} using {start_program_path}"
         )
 
-        # Compile the init program
+        # Compile the init program, or reuse an identical build from the cache
         init_executable_path = os.path.join(output_dir, "init")
-        try:
-            HostCommand.run_command(
-                ["gcc", init_c_path, "-o", init_executable_path, "-static"],
-                cwd=output_dir,
-            )
-            logger.info(f"Compiled init executable to {init_executable_path}")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to compile init.c: {e}")
+        ApplicationHelpers.compile_static_helper(
+            init_c_code, init_c_path, init_executable_path, target_arch=target_arch
+        )
+        logger.info(f"Compiled init executable to {init_executable_path}")
 
         # Make sure the init executable is executable
         os.chmod(init_executable_path, 0o755)
@@ -125,7 +190,9 @@ class ApplicationHelpers:
     """
 
     @staticmethod
-    def compile_network_standalone_utility(output_dir, file_name="setnet"):
+    def compile_network_standalone_utility(
+        output_dir, file_name="setnet", target_arch=None
+    ):
         c_code = """
     #include <stdio.h>
     #include <stdlib.h>
@@ -188,13 +255,10 @@ class ApplicationHelpers:
             logger.info(f"C source written to {c_file_path}")
 
         # Compile the C source code into a static binary
-        try:
-            HostCommand.run_command(
-                ["gcc", c_file_path, "-o", executable_path, "-static"], cwd=output_dir
-            )
-            logger.info(f"Compiled {executable_path} successfully")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error compiling {file_name}.c: {str(e)}")
+        ApplicationHelpers.compile_static_helper(
+            c_code, c_file_path, executable_path, target_arch=target_arch
+        )
+        logger.info(f"Compiled {executable_path} successfully")
 
         # Make the binary executable
         os.chmod(executable_path, 0o755)
@@ -211,6 +275,7 @@ class ApplicationHelpers:
         ip_address="192.168.0.100",
         netmask="255.255.255.0",
         gateway="192.168.0.1",
+        target_arch=None,
     ):
         c_code = f"""
     #include <stdio.h>
@@ -296,15 +361,10 @@ class ApplicationHelpers:
             logger.info(f"C source written to {c_file_path}")
 
         # Compile the C source code into a static binary
-        try:
-            subprocess.run(
-                ["gcc", c_file_path, "-o", executable_path, "-static"],
-                check=True,
-                cwd=output_dir,
-            )
-            logger.info(f"Compiled {executable_path} successfully")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error compiling {file_name}.c: {str(e)}")
+        ApplicationHelpers.compile_static_helper(
+            c_code, c_file_path, executable_path, target_arch=target_arch
+        )
+        logger.info(f"Compiled {executable_path} successfully")
 
         # Make the binary executable
         os.chmod(executable_path, 0o755)
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+
+from msmv.util.build_cache import BuildCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Unpack source tarballs in a single streaming pass. Compression is detected from the
+file's magic bytes rather than its name, and a stamp next to the extracted tree records
+the hash of the archive it came from, so an unchanged archive is never unpacked twice.
+"""
+
+
+class Archive:
+    # Leading bytes of each supported compressed stream
+    MAGIC = [
+        (b"\x1f\x8b", "gz"),
+        (b"\xfd7zXZ\x00", "xz"),
+        (b"BZh", "bz2"),
+        (b"\x28\xb5\x2f\xfd", "zst"),
+    ]
+    # tarfile has no zstd support before Python 3.14, the CLI decompresses instead
+    ZSTD_COMMAND = ["zstd", "-dc"]
+    TAR_MAGIC_OFFSET = 257
+    STAMP_FILE = ".msmv-extracted"
+
+    """Return "gz", "xz", "bz2", "zst" or "tar" for an uncompressed archive"""
+
+    @staticmethod
+    def detect_compression(path):
+        with open(path, "rb") as f:
+            header = f.read(Archive.TAR_MAGIC_OFFSET + 8)
+        for magic, compression in Archive.MAGIC:
+            if header.startswith(magic):
+                return compression
+        if header[Archive.TAR_MAGIC_OFFSET :].startswith(b"ustar"):
+            return "tar"
+        raise ValueError(f"Unsupported archive format: {path}")
+
+    """
+    Unpack path into a staging directory inside dest_dir, recording top level names
+    while the members stream past, then move the top level directory into place.
+    Returns the extracted directory.
+    """
+
+    @staticmethod
+    def extract(path, dest_dir):
+        compression = Archive.detect_compression(path)
+        with open(path, "rb") as f:
+            return Archive.extract_fileobj(
+                f,
+                compression,
+                dest_dir,
+                os.path.basename(path).split(".tar")[0],
+            )
+
+    """
+    Unpack a tar stream with the given compression into dest_dir, see extract(). The
+    stream may be any reader, e.g. one hashing the archive in the same pass. name is
+    used for the extracted directory when the archive has no single top level one.
+    """
+
+    @staticmethod
+    def extract_fileobj(fileobj, compression, dest_dir, name):
+        staging_dir = tempfile.mkdtemp(prefix=".extract-", dir=dest_dir)
+        process = None
+        feeder = None
+        try:
+            if compression == "zst":
+                process = subprocess.Popen(
+                    Archive.ZSTD_COMMAND, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+                )
+                feeder = threading.Thread(
+                    target=Archive.feed, args=(fileobj, process.stdin), daemon=True
+                )
+                feeder.start()
+                tar_stream, mode = process.stdout, "r|"
+            else:
+                tar_stream = fileobj
+                mode = "r|" if compression == "tar" else f"r|{compression}"
+
+            top_dirs = set()
+            with tarfile.open(fileobj=tar_stream, mode=mode) as tar:
+                for member in tar:
+                    name_in_archive = os.path.normpath(member.name)
+                    if name_in_archive != ".":
+                        top_dirs.add(name_in_archive.split(os.sep)[0])
+                    # "data" rejects absolute paths, ../ and links leaving staging_dir
+                    tar.extract(member, path=staging_dir, filter="data")
+
+            if process is not None:
+                process.stdout.close()
+                feeder.join()
+                if process.wait() != 0:
+                    raise Exception(
+                        f"{' '.join(Archive.ZSTD_COMMAND)} failed on {name} with exit code {process.returncode}"
+                    )
+
+            top_dir = top_dirs.pop() if len(top_dirs) == 1 else None
+            if top_dir and os.path.isdir(os.path.join(staging_dir, top_dir)):
+                extracted_dir = os.path.join(staging_dir, top_dir)
+            else:
+                # No single top level directory, keep the members together under
+                # a directory named after the archive
+                top_dir = name
+                extracted_dir = staging_dir
+            target_dir = os.path.join(dest_dir, top_dir)
+            # A tree without a matching stamp is stale or was cut short
+            BuildCache.remove_tree(target_dir)
+            os.rename(extracted_dir, target_dir)
+            return target_dir
+        finally:
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    """Copy a compressed stream into a decompressor's stdin from a helper thread"""
+
+    @staticmethod
+    def feed(fileobj, stdin, chunk_size=1024 * 1024):
+        try:
+            for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+                stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # The decompressor exited early, its exit code reports why
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    """
+    Extract path into dest_dir unless the stamp there shows the tree already came from
+    an archive with this sha256. A stale or half-extracted tree is removed first.
+    """
+
+    @staticmethod
+    def extract_once(path, dest_dir, sha256=None):
+        sha256 = sha256 or BuildCache.hash_file(path)
+        stamp_path = os.path.join(dest_dir, Archive.STAMP_FILE)
+        os.makedirs(dest_dir, exist_ok=True)
+
+        stamp = Archive.read_stamp(stamp_path)
+        if stamp and stamp["sha256"] == sha256:
+            source_dir = os.path.join(dest_dir, stamp["top_dir"])
+            if os.path.isdir(source_dir):
+                logger.info(f"{source_dir} is up to date with {path}, not extracting")
+                return source_dir
+
+        if stamp:
+            os.remove(stamp_path)
+            BuildCache.remove_tree(os.path.join(dest_dir, stamp["top_dir"]))
+
+        logger.info(f"Extracting {path} into {dest_dir}")
+        source_dir = Archive.extract(path, dest_dir)
+        tmp_path = stamp_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"sha256": sha256, "top_dir": os.path.basename(source_dir)}, f)
+        os.replace(tmp_path, stamp_path)
+        return source_dir
+
+    @staticmethod
+    def read_stamp(stamp_path):
+        try:
+            with open(stamp_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
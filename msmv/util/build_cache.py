@@ -0,0 +1,342 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""Content-addressed, size-bounded store for build artifacts shared across workspaces"""
+
+
+class BuildCache:
+    DEFAULT_MAX_SIZE = "20G"
+    META_FILE = "meta.json"
+
+    SIZE_SUFFIXES = {
+        "K": 1024,
+        "M": 1024**2,
+        "G": 1024**3,
+        "T": 1024**4,
+    }
+
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = os.path.abspath(
+            cache_dir
+            or os.getenv("MSMV_CACHE_DIR")
+            or os.path.join(os.path.expanduser("~"), ".cache", "msmv")
+        )
+        self.max_size = self.parse_size(
+            max_size or os.getenv("MSMV_CACHE_MAX_SIZE", self.DEFAULT_MAX_SIZE)
+        )
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    """Convert a human readable size such as 512M or 20G to bytes"""
+
+    @classmethod
+    def parse_size(cls, size):
+        if isinstance(size, int):
+            return size
+        size = str(size).strip().upper().rstrip("B")
+        if size and size[-1] in cls.SIZE_SUFFIXES:
+            return int(float(size[:-1]) * cls.SIZE_SUFFIXES[size[-1]])
+        return int(size)
+
+    @staticmethod
+    def format_size(size):
+        for suffix in ["B", "K", "M", "G"]:
+            if size < 1024:
+                return f"{size:.1f}{suffix}"
+            size /= 1024
+        return f"{size:.1f}T"
+
+    """Hash an arbitrary JSON-serialisable description of the inputs into a cache key"""
+
+    @staticmethod
+    def make_key(inputs):
+        encoded = json.dumps(inputs, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    @staticmethod
+    def hash_file(path, chunk_size=1024 * 1024):
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def entry_path(self, namespace, key):
+        return os.path.join(self.cache_dir, namespace, key)
+
+    """Bytes used by a file or a whole directory tree, symlinks are not followed"""
+
+    @staticmethod
+    def path_size(path):
+        if not os.path.isdir(path) or os.path.islink(path):
+            return os.lstat(path).st_size
+        size = 0
+        for dir_path, dir_names, file_names in os.walk(path):
+            for name in dir_names + file_names:
+                size += os.lstat(os.path.join(dir_path, name)).st_size
+        return size
+
+    """Delete a directory tree, including trees that were made read-only"""
+
+    @staticmethod
+    def remove_tree(path):
+        if not os.path.lexists(path):
+            return
+        for dir_path, dir_names, _ in os.walk(path):
+            os.chmod(dir_path, 0o755)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def lock_path(self, namespace, key):
+        namespace_dir = os.path.join(self.cache_dir, namespace)
+        os.makedirs(namespace_dir, exist_ok=True)
+        return os.path.join(namespace_dir, f".{key}.lock")
+
+    """
+    Hold an exclusive lock on one entry, across threads and processes, for work that
+    must not run twice at once, such as populating or building inside the entry.
+    prune() never evicts a locked entry.
+    """
+
+    @contextlib.contextmanager
+    def lock(self, namespace, key, shared=False):
+        with open(self.lock_path(namespace, key), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    """
+    Keep an entry that is used in place (e.g. a source tree make reads from) from being
+    evicted. Yields the entry directory, or None if it was evicted before it was pinned.
+    Must not be nested inside, or wrap, lock() on the same entry.
+    """
+
+    @contextlib.contextmanager
+    def pin(self, namespace, key):
+        with self.lock(namespace, key, shared=True):
+            yield self.lookup(namespace, key)
+
+    """Yield True with the entry's exclusive lock held, False if anyone holds or pins it"""
+
+    @contextlib.contextmanager
+    def try_lock(self, namespace, key):
+        with open(self.lock_path(namespace, key), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    """
+    Return the directory of a mutable entry that is worked on in place (e.g. a kernel
+    object directory), creating it on first use; call update_size once it has changed
+    """
+
+    def open_entry(self, namespace, key, description=None):
+        entry_dir = self.entry_path(namespace, key)
+        if self.lookup(namespace, key):
+            return entry_dir
+
+        os.makedirs(entry_dir, exist_ok=True)
+        now = time.time()
+        self._write_meta(
+            entry_dir,
+            {
+                "key": key,
+                "namespace": namespace,
+                "description": description or "",
+                "files": [],
+                "size": 0,
+                "created": now,
+                "last_used": now,
+            },
+        )
+        return entry_dir
+
+    def update_size(self, namespace, key):
+        entry_dir = self.entry_path(namespace, key)
+        meta = self.read_meta(entry_dir)
+        if meta is None:
+            return
+        meta["size"] = self.path_size(entry_dir)
+        meta["files"] = sorted(
+            name
+            for name in os.listdir(entry_dir)
+            if name != self.META_FILE and not name.startswith(".")
+        )
+        self._write_meta(entry_dir, meta)
+        self.prune(keep=(namespace, key))
+
+    """
+    Return the entry directory on a hit, None on a miss. A hit marks the entry as
+    recently used through the mtime of its meta file, so concurrent lookups of one
+    entry never rewrite the file under each other.
+    """
+
+    def lookup(self, namespace, key):
+        entry_dir = self.entry_path(namespace, key)
+        try:
+            os.utime(os.path.join(entry_dir, self.META_FILE))
+        except FileNotFoundError:
+            return None
+        logger.info(f"Cache hit for {namespace}/{key[:12]}")
+        return entry_dir
+
+    """
+    Copy (or with move=True, move) the given files or directories into a new cache entry,
+    replacing any existing entry. The old entry is renamed aside before the new one is
+    renamed into place, so a reader sees either complete entry or, briefly, a miss.
+    """
+
+    def store(self, namespace, key, files, description=None, move=False):
+        namespace_dir = os.path.join(self.cache_dir, namespace)
+        os.makedirs(namespace_dir, exist_ok=True)
+
+        staging_dir = tempfile.mkdtemp(prefix=f".{key[:12]}-", dir=namespace_dir)
+        size = 0
+        for name, src_path in files.items():
+            dest_path = os.path.join(staging_dir, name)
+            if move:
+                shutil.move(src_path, dest_path)
+            elif os.path.isdir(src_path):
+                shutil.copytree(src_path, dest_path, symlinks=True)
+            else:
+                shutil.copy2(src_path, dest_path)
+            size += self.path_size(dest_path)
+
+        now = time.time()
+        self._write_meta(
+            staging_dir,
+            {
+                "key": key,
+                "namespace": namespace,
+                "description": description or "",
+                "files": sorted(files),
+                "size": size,
+                "created": now,
+                "last_used": now,
+            },
+        )
+
+        entry_dir = self.entry_path(namespace, key)
+        old_dir = staging_dir + ".old"
+        try:
+            os.rename(entry_dir, old_dir)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(staging_dir, entry_dir)
+        except OSError:
+            # A concurrent store of the same key won, its content is the same
+            self.remove_tree(staging_dir)
+        self.remove_tree(old_dir)
+        logger.info(
+            f"Stored {namespace}/{key[:12]} in cache ({self.format_size(size)})"
+        )
+
+        self.prune(keep=(namespace, key))
+        return entry_dir
+
+    def _write_meta(self, entry_dir, meta):
+        # A temporary file per writer, concurrent writers must not share one
+        fd, tmp_path = tempfile.mkstemp(prefix=".meta-", dir=entry_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, os.path.join(entry_dir, self.META_FILE))
+
+    """Read an entry's metadata, None if it is gone; last_used comes from lookup()s"""
+
+    def read_meta(self, entry_dir):
+        meta_path = os.path.join(entry_dir, self.META_FILE)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            meta["last_used"] = max(meta["last_used"], os.stat(meta_path).st_mtime)
+        except (OSError, ValueError, KeyError):
+            # Evicted or replaced while we looked at it
+            return None
+        return meta
+
+    """List all cache entries, most recently used first"""
+
+    def entries(self, namespace=None):
+        found = []
+        namespaces = [namespace] if namespace else sorted(os.listdir(self.cache_dir))
+        for ns in namespaces:
+            namespace_dir = os.path.join(self.cache_dir, ns)
+            if not os.path.isdir(namespace_dir):
+                continue
+            for key in os.listdir(namespace_dir):
+                if key.startswith("."):
+                    continue
+                meta = self.read_meta(os.path.join(namespace_dir, key))
+                if meta is not None:
+                    found.append(meta)
+        return sorted(found, key=lambda meta: meta["last_used"], reverse=True)
+
+    def total_size(self):
+        return sum(meta["size"] for meta in self.entries())
+
+    """
+    Evict least recently used entries until the cache fits in max_size bytes. Entries
+    that are locked or pinned, i.e. in use by a build, are skipped, and so is keep, the
+    (namespace, key) of an entry that was just written and is about to be used.
+    """
+
+    def prune(self, max_size=None, keep=None):
+        max_size = self.max_size if max_size is None else self.parse_size(max_size)
+        entries = self.entries()
+        total = sum(meta["size"] for meta in entries)
+        evicted = []
+
+        # entries() is ordered most recently used first, so evict from the tail
+        while entries and total > max_size:
+            meta = entries.pop()
+            if (meta["namespace"], meta["key"]) == keep:
+                continue
+            with self.try_lock(meta["namespace"], meta["key"]) as locked:
+                if not locked:
+                    logger.info(
+                        f"Not evicting {meta['namespace']}/{meta['key'][:12]}, it is in use"
+                    )
+                    continue
+                self.remove_tree(self.entry_path(meta["namespace"], meta["key"]))
+            total -= meta["size"]
+            evicted.append(meta)
+            logger.info(
+                f"Evicted {meta['namespace']}/{meta['key'][:12]} from cache ({self.format_size(meta['size'])})"
+            )
+        return evicted
+
+    def print_entries(self):
+        entries = self.entries()
+        print(f"Cache directory: {self.cache_dir}")
+        print(
+            f"{'NAMESPACE':<14} {'KEY':<14} {'SIZE':>8} {'LAST USED':<20} DESCRIPTION"
+        )
+        for meta in entries:
+            last_used = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(meta["last_used"])
+            )
+            print(
+                f"{meta['namespace']:<14} {meta['key'][:12]:<14} "
+                f"{self.format_size(meta['size']):>8} {last_used:<20} {meta['description']}"
+            )
+        print(
+            f"{len(entries)} entries, {self.format_size(sum(m['size'] for m in entries))} "
+            f"of {self.format_size(self.max_size)}"
+        )
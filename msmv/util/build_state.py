@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Per-workspace record of the build phases that completed: a fingerprint of each phase's
+inputs, the phase's result and the paths it produced. A phase whose fingerprint still
+matches and whose outputs are still on disk does not have to run again.
+"""
+
+
+class BuildState:
+    FILE_NAME = ".msmv-state.json"
+    # --force value that reruns every phase
+    ALL = "all"
+
+    def __init__(self, workspace, force=()):
+        self.path = os.path.join(workspace, self.FILE_NAME)
+        self.force = set(force)
+        self.lock = threading.Lock()
+        self.phases = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)["phases"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"phases": self.phases}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def forced(self, phase):
+        return self.ALL in self.force or phase in self.force
+
+    """True if phase last completed with this fingerprint and its outputs still exist"""
+
+    def is_fresh(self, phase, fingerprint):
+        with self.lock:
+            entry = self.phases.get(phase)
+        if self.forced(phase) or entry is None or entry["fingerprint"] != fingerprint:
+            return False
+        missing = [path for path in entry["outputs"] if not os.path.exists(path)]
+        if missing:
+            logger.info(f"Phase {phase} must rerun, {missing[0]} is gone")
+            return False
+        return True
+
+    def result(self, phase):
+        with self.lock:
+            return self.phases[phase]["result"]
+
+    """
+    Identifier of the phase's last run. It changes every time the phase runs, so phases
+    that include it in their fingerprint rerun after it, like make with timestamps.
+    """
+
+    def stamp(self, phase):
+        with self.lock:
+            entry = self.phases.get(phase)
+        return entry["stamp"] if entry else None
+
+    """Forget a phase about to run, so a failed run is never mistaken for a fresh one"""
+
+    def invalidate(self, phase):
+        with self.lock:
+            if self.phases.pop(phase, None) is not None:
+                self.save()
+
+    def record(self, phase, fingerprint, result=None, outputs=()):
+        with self.lock:
+            self.phases[phase] = {
+                "fingerprint": fingerprint,
+                "stamp": uuid.uuid4().hex,
+                "result": result,
+                "outputs": [os.path.abspath(path) for path in outputs],
+                "finished": time.time(),
+            }
+            self.save()
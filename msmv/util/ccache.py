@@ -0,0 +1,125 @@
+import collections
+import logging
+import os
+import shutil
+import threading
+
+from msmv.util.build_cache import BuildCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""Wrap kernel and application compilers in ccache and report hit rates per build phase"""
+
+
+class CCache:
+    DEFAULT_MAX_SIZE = "5G"
+    # Stat ids ccache writes to CCACHE_STATSLOG for each compiler invocation
+    HIT_STATS = {"direct_cache_hit", "preprocessed_cache_hit"}
+    MISS_STATS = {"cache_miss"}
+    # Calls ccache passed straight to the compiler. Newer ccache versions log further
+    # ids next to a hit or miss (e.g. local_storage_hit), those are not counted
+    UNCACHEABLE_STATS = {
+        "autoconf_test",
+        "bad_compiler_arguments",
+        "called_for_link",
+        "called_for_preprocessing",
+        "compile_failed",
+        "compiler_produced_empty_output",
+        "compiler_produced_no_output",
+        "compiler_produced_stdout",
+        "could_not_use_modules",
+        "could_not_use_precompiled_header",
+        "modified_input_file",
+        "multiple_source_files",
+        "no_input_file",
+        "output_to_stdout",
+        "preprocessor_error",
+        "unsupported_code_directive",
+        "unsupported_compiler_option",
+        "unsupported_environment_variable",
+        "unsupported_source_language",
+    }
+
+    def __init__(self, cache_dir=None, max_size=None, stats_dir=None):
+        self.cache_dir = os.path.abspath(
+            cache_dir
+            or os.getenv("CCACHE_DIR")
+            or os.path.join(BuildCache().cache_dir, "ccache")
+        )
+        self.max_size = max_size or os.getenv(
+            "MSMV_CCACHE_MAX_SIZE", self.DEFAULT_MAX_SIZE
+        )
+        self.stats_dir = stats_dir
+        self.phases = []
+        self.lock = threading.Lock()
+        self.binary = shutil.which("ccache")
+        if self.binary is None:
+            raise FileNotFoundError("ccache requested but not found in PATH")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def wrap(self, compiler):
+        return f"{self.binary} {compiler}"
+
+    def stats_log(self, phase):
+        return os.path.join(self.stats_dir, f"{phase}.ccache-stats")
+
+    """
+    Environment for one build phase. base_dir lets ccache rewrite absolute paths below
+    the source tree, so the same sources in another workspace still hit the cache.
+    """
+
+    def env(self, phase, base_dir=None):
+        env = {
+            "CCACHE_DIR": self.cache_dir,
+            "CCACHE_MAXSIZE": str(self.max_size),
+            "CCACHE_COMPILERCHECK": "content",
+            "CCACHE_NOHASHDIR": "1",
+        }
+        if base_dir:
+            env["CCACHE_BASEDIR"] = os.path.abspath(base_dir)
+        if self.stats_dir:
+            os.makedirs(self.stats_dir, exist_ok=True)
+            stats_log = self.stats_log(phase)
+            # Each build starts the phase's counts from zero
+            if os.path.exists(stats_log):
+                os.remove(stats_log)
+            env["CCACHE_STATSLOG"] = stats_log
+            with self.lock:
+                if phase not in self.phases:
+                    self.phases.append(phase)
+        return env
+
+    """Count hits, misses and uncacheable calls in a phase's stats log"""
+
+    def phase_stats(self, phase):
+        stats = collections.Counter(hits=0, misses=0, uncacheable=0)
+        stats_log = self.stats_log(phase)
+        if not os.path.isfile(stats_log):
+            return stats
+
+        with open(stats_log) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line in self.HIT_STATS:
+                    stats["hits"] += 1
+                elif line in self.MISS_STATS:
+                    stats["misses"] += 1
+                elif line in self.UNCACHEABLE_STATS:
+                    stats["uncacheable"] += 1
+        return stats
+
+    def print_stats(self):
+        print(
+            f"{'CCACHE PHASE':<28} {'HITS':>7} {'MISSES':>7} {'UNCACHEABLE':>11} {'HIT RATE':>9}"
+        )
+        for phase in self.phases:
+            stats = self.phase_stats(phase)
+            cacheable = stats["hits"] + stats["misses"]
+            hit_rate = f"{100 * stats['hits'] / cacheable:.1f}%" if cacheable else "-"
+            print(
+                f"{phase[:28]:<28} {stats['hits']:>7} {stats['misses']:>7} "
+                f"{stats['uncacheable']:>11} {hit_rate:>9}"
+            )
@@ -0,0 +1,160 @@
+import logging
+import math
+import os
+
+from msmv.util.build_cache import BuildCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Size build parallelism from what this process may actually use: the CPUs in its
+affinity mask, the CPU quota of its cgroup and the memory still available, so builds
+neither oversubscribe a container nor leave a large host idle.
+"""
+
+
+class CpuBudget:
+    CGROUP_ROOT = "/sys/fs/cgroup"
+    # Memory one compiler job may need; C++ and LTO builds want more
+    DEFAULT_MEMORY_PER_JOB = "512M"
+
+    """CPUs the scheduler lets this process run on"""
+
+    @staticmethod
+    def affinity_cpus():
+        if hasattr(os, "sched_getaffinity"):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+    """Map each cgroup controller (the empty string for v2) to this process's cgroup path"""
+
+    @staticmethod
+    def cgroup_paths():
+        paths = {}
+        try:
+            with open("/proc/self/cgroup") as f:
+                for line in f:
+                    _, controllers, path = line.rstrip("\n").split(":", 2)
+                    for controller in controllers.split(","):
+                        paths[controller] = path
+        except OSError:
+            pass
+        return paths
+
+    """Directories of a cgroup and all of its ancestors, whose limits all apply"""
+
+    @staticmethod
+    def cgroup_dirs(mount, path):
+        dirs = []
+        while True:
+            dirs.append(os.path.join(mount, path.lstrip("/")))
+            if path in ("", "/"):
+                return dirs
+            path = os.path.dirname(path)
+
+    @staticmethod
+    def read_file(path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    """CPUs allowed by the cgroup CPU quota, None when there is no quota"""
+
+    @staticmethod
+    def cgroup_cpus():
+        paths = CpuBudget.cgroup_paths()
+        quotas = []
+        if "" in paths:
+            for cgroup_dir in CpuBudget.cgroup_dirs(CpuBudget.CGROUP_ROOT, paths[""]):
+                value = CpuBudget.read_file(os.path.join(cgroup_dir, "cpu.max"))
+                if value and not value.startswith("max"):
+                    quota, period = value.split()
+                    quotas.append(int(quota) / int(period))
+        if "cpu" in paths:
+            mount = os.path.join(CpuBudget.CGROUP_ROOT, "cpu")
+            for cgroup_dir in CpuBudget.cgroup_dirs(mount, paths["cpu"]):
+                quota = CpuBudget.read_file(
+                    os.path.join(cgroup_dir, "cpu.cfs_quota_us")
+                )
+                period = CpuBudget.read_file(
+                    os.path.join(cgroup_dir, "cpu.cfs_period_us")
+                )
+                if quota and period and int(quota) > 0:
+                    quotas.append(int(quota) / int(period))
+        if not quotas:
+            return None
+        return max(1, math.ceil(min(quotas)))
+
+    """Bytes of memory available to new jobs, within the host and the cgroup limit"""
+
+    @staticmethod
+    def available_memory():
+        available = []
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        available.append(int(line.split()[1]) * 1024)
+        except OSError:
+            pass
+
+        paths = CpuBudget.cgroup_paths()
+        limit_files = []
+        if "" in paths:
+            limit_files.append(
+                (
+                    os.path.join(CpuBudget.CGROUP_ROOT, paths[""].lstrip("/")),
+                    "memory.max",
+                    "memory.current",
+                )
+            )
+        if "memory" in paths:
+            limit_files.append(
+                (
+                    os.path.join(
+                        CpuBudget.CGROUP_ROOT, "memory", paths["memory"].lstrip("/")
+                    ),
+                    "memory.limit_in_bytes",
+                    "memory.usage_in_bytes",
+                )
+            )
+        for cgroup_dir, limit_file, usage_file in limit_files:
+            limit = CpuBudget.read_file(os.path.join(cgroup_dir, limit_file))
+            usage = CpuBudget.read_file(os.path.join(cgroup_dir, usage_file))
+            # v1 reports "no limit" as a huge page-aligned number
+            if limit and usage and limit != "max" and int(limit) < 2**60:
+                available.append(max(int(limit) - int(usage), 0))
+        return min(available) if available else None
+
+    """
+    Number of parallel jobs for the whole build: MSMV_JOBS if set, otherwise the
+    smallest of the affinity mask, the cgroup CPU quota and available memory divided
+    by MSMV_MEMORY_PER_JOB
+    """
+
+    @staticmethod
+    def jobs():
+        if os.getenv("MSMV_JOBS"):
+            return max(1, int(os.environ["MSMV_JOBS"]))
+
+        limits = {"affinity": CpuBudget.affinity_cpus()}
+        cgroup_cpus = CpuBudget.cgroup_cpus()
+        if cgroup_cpus is not None:
+            limits["cgroup quota"] = cgroup_cpus
+        memory = CpuBudget.available_memory()
+        if memory is not None:
+            per_job = BuildCache.parse_size(
+                os.getenv("MSMV_MEMORY_PER_JOB", CpuBudget.DEFAULT_MEMORY_PER_JOB)
+            )
+            limits["memory"] = max(1, memory // per_job)
+
+        jobs = min(limits.values())
+        logger.info(
+            f"Using {jobs} parallel jobs ("
+            + ", ".join(f"{name} {value}" for name, value in limits.items())
+            + ")"
+        )
+        return jobs
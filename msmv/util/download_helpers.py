@@ -0,0 +1,35 @@
+import hashlib
+
+"""Utility classes to process archives as they stream past"""
+
+
+class HashingReader:
+    """
+    File-like wrapper that hashes every byte read from the underlying stream and
+    reports progress, so a single pass over an archive can feed tarfile and a
+    checksum at once.
+    """
+
+    def __init__(self, stream, progress_bar=None):
+        self.stream = stream
+        self.progress_bar = progress_bar
+        self.sha256 = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.sha256.update(data)
+            self.bytes_read += len(data)
+            if self.progress_bar is not None:
+                self.progress_bar.update(len(data))
+        return data
+
+    """Consume anything left in the stream (e.g. tar padding) so the hash covers the whole file"""
+
+    def drain(self, chunk_size=1024 * 1024):
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
@@ -0,0 +1,279 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from tqdm import tqdm
+
+from msmv.util.build_cache import BuildCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Fetch a file over HTTP in several Range segments at once. Progress is kept next to the
+partial file, so an interrupted download (dropped connection, killed build) resumes where
+it stopped. Each segment must deliver exactly its length and the finished file is checked
+against the expected size and sha256 before it is handed out; mirrors are tried in order
+until one of them delivers a good copy.
+"""
+
+
+class SegmentedDownloader:
+    CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+    # Byte ranges and lengths refer to the file as stored, never to a compressed transfer
+    HEADERS = {"Accept-Encoding": "identity"}
+
+    def __init__(
+        self,
+        segments=4,
+        min_segment_size=8 * 1024 * 1024,
+        retries=5,
+        chunk_size=1024 * 1024,
+        timeout=60,
+        retry_delay=0.25,
+        state_interval=1.0,
+    ):
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.state_interval = state_interval
+
+    """Try each URL in turn until one yields a complete, verified file; returns its sha256"""
+
+    def download(self, urls, dest_path, sha256=None):
+        errors = []
+        for url in urls:
+            try:
+                actual_sha256 = self.download_from(url, dest_path)
+            except (requests.exceptions.RequestException, IOError) as e:
+                logger.warning(f"Download from {url} failed: {e}")
+                errors.append(f"{url}: {e}")
+                continue
+
+            if sha256 and actual_sha256 != sha256.lower():
+                logger.warning(
+                    f"{url} served a file with sha256 {actual_sha256}, expected {sha256}"
+                )
+                errors.append(f"{url}: sha256 mismatch")
+                self.discard_partial(dest_path)
+                continue
+            return actual_sha256
+
+        raise Exception(f"Could not download {urls[0]}: " + "; ".join(errors))
+
+    @staticmethod
+    def state_path(dest_path):
+        return dest_path + ".state"
+
+    def discard_partial(self, dest_path):
+        for path in (dest_path, self.state_path(dest_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    """Return (total size, whether ranges are supported, validator) from a one byte range request"""
+
+    def probe(self, url):
+        with requests.get(
+            url,
+            headers={**self.HEADERS, "Range": "bytes=0-0"},
+            stream=True,
+            timeout=self.timeout,
+        ) as response:
+            response.raise_for_status()
+            validator = response.headers.get("ETag") or response.headers.get(
+                "Last-Modified"
+            )
+            match = self.CONTENT_RANGE_RE.match(
+                response.headers.get("Content-Range", "")
+            )
+            if response.status_code == 206 and match and match.group(3) != "*":
+                return int(match.group(3)), True, validator
+            length = response.headers.get("Content-Length")
+            return (int(length) if length else None), False, validator
+
+    def plan_segments(self, total_size):
+        count = max(1, min(self.segments, total_size // self.min_segment_size))
+        size = -(-total_size // count)
+        return [
+            [start, min(start + size, total_size) - 1, 0]
+            for start in range(0, total_size, size)
+        ]
+
+    def load_state(self, dest_path, url_size, validator):
+        state_path = self.state_path(dest_path)
+        if not os.path.isfile(state_path) or not os.path.isfile(dest_path):
+            return None
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # A file that changed upstream cannot be resumed
+        if state.get("size") != url_size or state.get("validator") != validator:
+            return None
+        return state
+
+    def save_state(self, dest_path, state):
+        state_path = self.state_path(dest_path)
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def download_from(self, url, dest_path):
+        total_size, ranges, validator = self.probe(url)
+        if not ranges or not total_size:
+            logger.info(f"{url} does not support ranges, downloading in one stream")
+            return self.download_single(url, dest_path, total_size)
+
+        state = self.load_state(dest_path, total_size, validator)
+        if state:
+            done = sum(segment[2] for segment in state["segments"])
+            logger.info(
+                f"Resuming {url} at {BuildCache.format_size(done)} of {BuildCache.format_size(total_size)}"
+            )
+        else:
+            state = {
+                "size": total_size,
+                "validator": validator,
+                "segments": self.plan_segments(total_size),
+            }
+            with open(dest_path, "wb") as f:
+                f.truncate(total_size)
+            self.save_state(dest_path, state)
+
+        lock = threading.Lock()
+        progress_bar = tqdm(
+            total=total_size,
+            initial=sum(segment[2] for segment in state["segments"]),
+            unit="iB",
+            unit_scale=True,
+        )
+        last_saved = [time.monotonic()]
+
+        # Rewriting the state file for every chunk costs more than the chunk itself,
+        # it is saved every state_interval seconds and once more when the download stops
+        def on_progress(segment, count):
+            with lock:
+                segment[2] += count
+                progress_bar.update(count)
+                if time.monotonic() - last_saved[0] >= self.state_interval:
+                    self.save_state(dest_path, state)
+                    last_saved[0] = time.monotonic()
+
+        try:
+            pending = [
+                segment
+                for segment in state["segments"]
+                if segment[2] < segment[1] - segment[0] + 1
+            ]
+            logger.info(f"Downloading {url} in {len(pending)} segments")
+            with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+                futures = [
+                    executor.submit(
+                        self.fetch_segment, url, dest_path, segment, on_progress
+                    )
+                    for segment in pending
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            progress_bar.close()
+            with lock:
+                self.save_state(dest_path, state)
+
+        if os.path.getsize(dest_path) != total_size:
+            self.discard_partial(dest_path)
+            raise IOError(f"{url}: expected {total_size} bytes on disk")
+        os.remove(self.state_path(dest_path))
+        return BuildCache.hash_file(dest_path)
+
+    """
+    Fetch the rest of one segment, reconnecting with a narrower range after drops.
+    Only consecutive failed attempts count against retries: a connection that
+    delivered data before it dropped starts the count again.
+    """
+
+    def fetch_segment(self, url, dest_path, segment, on_progress):
+        attempt = 0
+        while True:
+            start, end, done = segment
+            if start + done > end:
+                return
+            try:
+                with requests.get(
+                    url,
+                    headers={**self.HEADERS, "Range": f"bytes={start + done}-{end}"},
+                    stream=True,
+                    timeout=self.timeout,
+                ) as response:
+                    if response.status_code != 206:
+                        raise IOError(
+                            f"expected 206 for a range request, got {response.status_code}"
+                        )
+                    with open(dest_path, "r+b") as f:
+                        f.seek(start + done)
+                        for chunk in response.iter_content(self.chunk_size):
+                            remaining = end - (start + segment[2]) + 1
+                            if len(chunk) > remaining:
+                                raise IOError(
+                                    "server sent more than the range asked for"
+                                )
+                            f.write(chunk)
+                            # On disk before the state file can claim it
+                            f.flush()
+                            on_progress(segment, len(chunk))
+                if start + segment[2] <= end:
+                    raise IOError(
+                        f"segment {start}-{end} ended early at {start + segment[2]}"
+                    )
+                return
+            except (requests.exceptions.RequestException, IOError) as e:
+                if segment[2] > done:
+                    attempt = 0
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                delay = min(2**attempt, 30) * self.retry_delay
+                logger.info(
+                    f"Segment {start}-{end} of {url} interrupted ({e}), retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+    """Plain streaming download for servers without range support, restarted on errors"""
+
+    def download_single(self, url, dest_path, total_size=None):
+        attempt = 0
+        while True:
+            try:
+                sha256 = hashlib.sha256()
+                received = 0
+                with requests.get(
+                    url, headers=self.HEADERS, stream=True, timeout=self.timeout
+                ) as response:
+                    response.raise_for_status()
+                    with open(dest_path, "wb") as f, tqdm(
+                        total=total_size, unit="iB", unit_scale=True
+                    ) as progress_bar:
+                        for chunk in response.iter_content(self.chunk_size):
+                            f.write(chunk)
+                            sha256.update(chunk)
+                            received += len(chunk)
+                            progress_bar.update(len(chunk))
+                if total_size is not None and received != total_size:
+                    raise IOError(f"got {received} of {total_size} bytes")
+                return sha256.hexdigest()
+            except (requests.exceptions.RequestException, IOError):
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                time.sleep(min(2**attempt, 30) * self.retry_delay)
@@ -1,9 +1,185 @@
+import asyncio
+import collections
+import contextvars
+import os
+import re
+import signal
 import subprocess
+import threading
+import time
+
+from tqdm import tqdm
+
+from msmv.util.tracer import Tracer
+
+"""Raised when a host command exits non-zero, carries what is needed to report the failure"""
+
+
+class CommandError(Exception):
+    def __init__(
+        self, command, exit_code=None, duration=None, log_tail=(), log_path=None
+    ):
+        super().__init__(command, exit_code, duration, list(log_tail), log_path)
+        self.command = list(command)
+        self.exit_code = exit_code
+        self.duration = duration
+        self.log_tail = list(log_tail)
+        self.log_path = log_path
+
+    @property
+    def reason(self):
+        return f"exit code {self.exit_code}"
+
+    def __str__(self):
+        message = f"Command '{' '.join(self.command)}' failed with {self.reason}"
+        if self.duration is not None:
+            message += f" after {self.duration:.1f}s"
+        if self.log_path:
+            message += f", see {self.log_path}"
+        return message
+
+
+class CommandTimeout(CommandError):
+    @property
+    def reason(self):
+        return "a timeout"
+
+
+class CommandCancelled(CommandError):
+    @property
+    def reason(self):
+        return "cancellation"
+
+
+"""
+A set of running commands that can be torn down together. Every command is started in
+its own session, so terminating the group signals each command's whole process group,
+make and all the compilers it spawned included. Groups started under another group are
+terminated with it.
+"""
+
+
+class CommandGroup:
+    def __init__(self, parent=None, kill_grace=10):
+        self.kill_grace = kill_grace
+        self.lock = threading.Lock()
+        self.pids = set()
+        self.children = []
+        self.cancelled = False
+        if parent is not None:
+            with parent.lock:
+                parent.children.append(self)
+                self.cancelled = parent.cancelled
+
+    def register(self, pid):
+        with self.lock:
+            self.pids.add(pid)
+            cancelled = self.cancelled
+        # Started while the group was being torn down
+        if cancelled:
+            HostCommand.kill_process_group(pid, signal.SIGKILL)
+
+    def unregister(self, pid):
+        with self.lock:
+            self.pids.discard(pid)
+
+    def signal_all(self, sig):
+        with self.lock:
+            pids = list(self.pids)
+        for pid in pids:
+            HostCommand.kill_process_group(pid, sig)
+
+    """Send SIGTERM to every running command, SIGKILL whatever is left after kill_grace seconds"""
+
+    def terminate(self):
+        with self.lock:
+            self.cancelled = True
+            children = list(self.children)
+        self.signal_all(signal.SIGTERM)
+        timer = threading.Timer(
+            self.kill_grace, self.signal_all, args=(signal.SIGKILL,)
+        )
+        timer.daemon = True
+        timer.start()
+        for child in children:
+            child.terminate()
+
+
+"""
+Popen that reaps its child with wait4 and keeps the resource usage of the whole process
+tree. wait() and poll() only look for the exit without reaping (waitid with WNOWAIT),
+then reap() collects the status and rusage in one wait4 call.
+"""
+
+
+class RusagePopen(subprocess.Popen):
+    rusage = None
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, *args, **kwargs):
+        self.reap_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def reap(self):
+        with self.reap_lock:
+            if self.returncode is not None:
+                return self.returncode
+            try:
+                _, status, self.rusage = os.wait4(self.pid, 0)
+                self.returncode = os.waitstatus_to_exitcode(status)
+            except ChildProcessError:
+                # Reaped by someone else, the exit status is lost
+                self.returncode = 0
+        return self.returncode
+
+    def has_exited(self, block):
+        flags = os.WEXITED | os.WNOWAIT | (0 if block else os.WNOHANG)
+        try:
+            return os.waitid(os.P_PID, self.pid, flags) is not None
+        except ChildProcessError:
+            return True
+
+    def poll(self):
+        if self.returncode is None and self.has_exited(block=False):
+            self.reap()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.returncode is not None:
+            return self.returncode
+        if timeout is None:
+            self.has_exited(block=True)
+            return self.reap()
+
+        deadline = time.monotonic() + timeout
+        while not self.has_exited(block=False):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+        return self.reap()
+
+
+# The group commands started in this context belong to, set by whoever runs them concurrently
+current_command_group = contextvars.ContextVar("current_command_group", default=None)
 
 """Utility class to execute shell commands in a subprocess on the host OS"""
 
 
 class HostCommand:
+    # Lines announcing a compiled object: kbuild's "  CC      kernel/fork.o" and
+    # plain compiler invocations with -c, as printed by most application makefiles
+    KBUILD_OBJECT_RE = re.compile(r"^\s+(CC|AS|HOSTCC)\s+(\[M\]\s+)?\S+\.o$")
+    COMPILER_OBJECT_RE = re.compile(r"(^|\s)(\S*cc|\S*gcc|\S*clang|\S*g\+\+)\s.*\s-c\s")
+    READ_CHUNK_SIZE = 65536
+    STOP_GRACE = 5
+
+    """
+    Run a command and wait for it. Raises CommandError on a non-zero exit,
+    CommandTimeout on timeout and CommandCancelled if the surrounding group is torn down.
+    With log_path set the output is streamed to that file instead of being returned.
+    """
+
     @staticmethod
     def run_command(
         command,
@@ -17,12 +193,35 @@ class HostCommand:
         verbose=False,
         binary_mode=False,
         next_command=None,
+        log_path=None,
+        tail_lines=50,
+        progress=None,
+        pass_fds=(),
     ):
+        if log_path:
+            return HostCommand.run_coroutine(
+                HostCommand.run_async(
+                    command,
+                    cwd,
+                    timeout=timeout,
+                    env=env,
+                    log_path=log_path,
+                    tail_lines=tail_lines,
+                    progress=progress,
+                    pass_fds=pass_fds,
+                )
+            )
+
+        group = current_command_group.get()
+        if group is not None and group.cancelled:
+            raise CommandCancelled(command)
+
         print(f"Running command: {' '.join(command)} in dir {cwd}")
-        process = None
+        start = time.monotonic()
+        processes = []
         try:
             # Setup the first process
-            process = subprocess.Popen(
+            process = RusagePopen(
                 command,
                 stdout=subprocess.PIPE if next_command else stdout,
                 stderr=stderr,
@@ -31,11 +230,15 @@ class HostCommand:
                 shell=shell,
                 env=env,
                 text=not binary_mode,
+                start_new_session=True,
+                pass_fds=pass_fds,
             )
-            next_process = None
+            processes.append(process)
+            if group is not None:
+                group.register(process.pid)
             # If there's a next command, set it up to receive input from the first process
             if next_command:
-                next_process = subprocess.Popen(
+                next_process = RusagePopen(
                     next_command,
                     stdin=process.stdout,
                     stdout=stdout,
@@ -44,29 +247,314 @@ class HostCommand:
                     shell=shell,
                     env=env,
                     text=not binary_mode,
+                    start_new_session=True,
+                    pass_fds=pass_fds,
                 )
+                processes.append(next_process)
+                if group is not None:
+                    group.register(next_process.pid)
                 # Allow process to receive a SIGPIPE if next_process exits
                 process.stdout.close()
                 output, error = next_process.communicate(timeout=timeout)
                 exit_code = next_process.returncode
+                # Reap the first command too, it would otherwise stay a zombie
+                remaining = None
+                if timeout is not None:
+                    remaining = max(0, timeout - (time.monotonic() - start))
+                process.communicate(timeout=remaining)
             else:
                 output, error = process.communicate(timeout=timeout)
                 exit_code = process.returncode
+        except subprocess.TimeoutExpired:
+            HostCommand.stop_processes(processes)
+            raise CommandTimeout(command, duration=time.monotonic() - start) from None
+        except BaseException:
+            # KeyboardInterrupt and friends must not leave the command running
+            HostCommand.stop_processes(processes)
+            raise
+        finally:
+            end = time.monotonic()
+            for process in processes:
+                if group is not None:
+                    group.unregister(process.pid)
+                Tracer.record(
+                    process.args, start, end, process.rusage, process.returncode
+                )
 
-            if verbose and output:
-                print(output.decode() if not binary_mode else output)
+        if verbose and output:
+            print(output.decode() if not binary_mode else output)
 
-            if exit_code != 0:
-                print(f"Error executing command: {error}")
-                exit(1)
+        if exit_code != 0:
+            if isinstance(error, bytes):
+                error = error.decode(errors="replace")
+            tail = (error or "").splitlines()[-tail_lines:]
+            if group is not None and group.cancelled:
+                raise CommandCancelled(command, exit_code, end - start, tail)
+            raise CommandError(command, exit_code, end - start, tail)
 
-            return output, error
-        except subprocess.TimeoutExpired as e:
-            process.kill()
-            if next_command:
-                next_process.kill()
-            print(f"Process timed out with error: {e}")
-            exit(1)
-        except subprocess.CalledProcessError as e:
-            print(f"An error occurred: {e}")
-            exit(1)
+        return output, error
+
+    """
+    Run a coroutine to completion from synchronous code. asyncio.run refuses to start
+    a loop inside a running one, so a caller that is itself on an event loop gets a
+    private loop in a helper thread; coroutines should await run_async instead.
+    """
+
+    @staticmethod
+    def run_coroutine(coroutine):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+
+        result = {}
+        context = contextvars.copy_context()
+
+        def run():
+            try:
+                result["value"] = context.run(asyncio.run, coroutine)
+            except BaseException as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+    @staticmethod
+    def kill_process_group(pid, sig):
+        try:
+            os.killpg(pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    @staticmethod
+    def stop_processes(processes):
+        for process in processes:
+            HostCommand.kill_process_group(process.pid, signal.SIGKILL)
+            process.wait()
+
+    """Wait for a process from a dedicated thread, so its rusage is collected by wait4"""
+
+    @staticmethod
+    def wait_in_thread(process):
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+
+        def wait():
+            returncode = process.wait()
+            try:
+                loop.call_soon_threadsafe(
+                    lambda: exited.done() or exited.set_result(returncode)
+                )
+            except RuntimeError:
+                # The event loop is already gone, nobody is waiting anymore
+                pass
+
+        threading.Thread(target=wait, daemon=True).start()
+        return exited
+
+    """Terminate a command's process group, escalating to SIGKILL if it does not exit in time"""
+
+    @staticmethod
+    async def stop_process(process, exited):
+        if exited.done():
+            return
+        HostCommand.kill_process_group(process.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(exited), HostCommand.STOP_GRACE)
+        except asyncio.TimeoutError:
+            HostCommand.kill_process_group(process.pid, signal.SIGKILL)
+            await exited
+
+    @staticmethod
+    def is_object_line(line):
+        return bool(
+            HostCommand.KBUILD_OBJECT_RE.match(line)
+            or HostCommand.COMPILER_OBJECT_RE.search(line)
+        )
+
+    """Count compiled objects in a previous log of the same phase, used as the progress total"""
+
+    @staticmethod
+    def count_objects(log_path):
+        if not os.path.isfile(log_path):
+            return None
+        with open(log_path, "r", errors="replace") as log_file:
+            count = sum(1 for line in log_file if HostCommand.is_object_line(line))
+        return count or None
+
+    """
+    Run a command on the event loop. stdout and stderr are read as they arrive; with
+    log_path set they are written to that file and only the last tail_lines lines are
+    kept in memory for the error report, otherwise they are returned as bytes.
+    With progress set to a phase name, compiled objects are counted into a progress bar
+    (the total comes from the previous run's log). Cancelling the awaiting task kills
+    the command's whole process group.
+    """
+
+    @staticmethod
+    async def run_async(
+        command,
+        cwd,
+        timeout=None,
+        env=None,
+        log_path=None,
+        tail_lines=50,
+        progress=None,
+        input=None,
+        pass_fds=(),
+    ):
+        group = current_command_group.get()
+        if group is not None and group.cancelled:
+            raise CommandCancelled(command, log_path=log_path)
+
+        if log_path:
+            print(f"Running command: {' '.join(command)} in dir {cwd}, log: {log_path}")
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        else:
+            print(f"Running command: {' '.join(command)} in dir {cwd}")
+
+        progress_bar = None
+        if progress:
+            progress_bar = tqdm(
+                total=HostCommand.count_objects(log_path) if log_path else None,
+                desc=progress,
+                unit="obj",
+            )
+
+        tail = collections.deque(maxlen=tail_lines)
+        captured = {"stdout": bytearray(), "stderr": bytearray()}
+        log_file = open(log_path, "wb") if log_path else None
+
+        def handle_line(raw_line):
+            line = raw_line.decode(errors="replace")
+            tail.append(line)
+            if progress_bar is not None and HostCommand.is_object_line(line):
+                progress_bar.update(1)
+
+        async def pump(pipe, name):
+            loop = asyncio.get_running_loop()
+            stream = asyncio.StreamReader(limit=HostCommand.READ_CHUNK_SIZE)
+            transport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(stream), pipe
+            )
+            partial = b""
+            try:
+                while True:
+                    data = await stream.read(HostCommand.READ_CHUNK_SIZE)
+                    if not data:
+                        break
+                    if log_file is not None:
+                        log_file.write(data)
+                    else:
+                        captured[name].extend(data)
+                    lines = (partial + data).split(b"\n")
+                    partial = lines.pop()
+                    for raw_line in lines:
+                        handle_line(raw_line)
+            finally:
+                transport.close()
+            if partial:
+                if log_file is not None:
+                    log_file.write(b"\n")
+                handle_line(partial)
+
+        async def feed(stdin):
+            if stdin is None:
+                return
+            try:
+                await asyncio.to_thread(stdin.write, input)
+            except BrokenPipeError:
+                pass
+            finally:
+                stdin.close()
+
+        start = time.monotonic()
+        try:
+            if log_file is not None:
+                log_file.write(f"$ {' '.join(command)}\n".encode())
+            process = RusagePopen(
+                command,
+                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+                env=env,
+                start_new_session=True,
+                pass_fds=pass_fds,
+            )
+            if group is not None:
+                group.register(process.pid)
+            exited = HostCommand.wait_in_thread(process)
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(
+                        pump(process.stdout, "stdout"),
+                        pump(process.stderr, "stderr"),
+                        feed(process.stdin),
+                        asyncio.shield(exited),
+                    ),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                await HostCommand.stop_process(process, exited)
+                raise CommandTimeout(
+                    command, None, time.monotonic() - start, tail, log_path
+                ) from None
+            except BaseException:
+                # Cancelled, or interrupted: take the whole process tree down with us
+                await HostCommand.stop_process(process, exited)
+                raise
+            finally:
+                if group is not None:
+                    group.unregister(process.pid)
+                Tracer.record(
+                    command,
+                    start,
+                    time.monotonic(),
+                    process.rusage,
+                    process.returncode,
+                    log_path,
+                )
+        finally:
+            if log_file is not None:
+                log_file.close()
+            if progress_bar is not None:
+                progress_bar.close()
+
+        duration = time.monotonic() - start
+        if process.returncode != 0:
+            error_type = CommandError
+            if group is not None and group.cancelled:
+                error_type = CommandCancelled
+            raise error_type(command, process.returncode, duration, tail, log_path)
+
+        if log_file is not None:
+            return None, None
+        return bytes(captured["stdout"]), bytes(captured["stderr"])
+
+    """
+    Await several commands or coroutines and return their results in order. A failure
+    cancels everything still running, which kills those commands' process groups,
+    and is then re-raised.
+    """
+
+    @staticmethod
+    async def gather(*aws):
+        tasks = [asyncio.ensure_future(aw) for aw in aws]
+        try:
+            if tasks:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # Also runs when the caller itself is cancelled
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+        return [task.result() for task in tasks]
@@ -0,0 +1,219 @@
+import contextlib
+import logging
+import os
+import re
+import select
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from msmv.util.host_command import CommandCancelled, current_command_group
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+A GNU make jobserver shared by every make msmv runs. The fifo holds one token per job
+in the budget. Every make joins it through MAKEFLAGS and takes a token for each job
+beyond its first, and msmv takes a token for that first job before starting make.
+The total number of jobs therefore stays at the budget however many kernel and
+application builds run at once. When msmv itself runs under make, it joins that
+make's jobserver instead of starting its own.
+"""
+
+
+class Jobserver:
+    TOKEN = b"+"
+    VERSION_RE = re.compile(r"GNU Make (\d+)\.(\d+)")
+    # --jobserver-auth appeared in make 4.2; 4.4 can open the fifo by name, older
+    # versions need inherited descriptors
+    MIN_VERSION = (4, 2)
+    FIFO_AUTH_VERSION = (4, 4)
+    # --jobserver-fds is the name make before 4.2 used
+    AUTH_RE = re.compile(r"--jobserver-(?:auth|fds)=(\S+)")
+    MAKEFLAGS_JOBS_RE = re.compile(r"(?:^|\s)-j(\d+)")
+    JOBS_FLAG_RE = re.compile(r"-j\d*|--jobs(?:=\d+)?")
+
+    """Whether the host's make can join a jobserver through --jobserver-auth"""
+
+    @staticmethod
+    def available():
+        return Jobserver.make_version() >= Jobserver.MIN_VERSION
+
+    """
+    Start a jobserver for a budget of jobs, or join the one of the make msmv runs
+    under. None when the host's make cannot use a jobserver.
+    """
+
+    @staticmethod
+    def start(jobs):
+        if not Jobserver.available():
+            return None
+        return Jobserver.inherited() or Jobserver(jobs)
+
+    """The jobserver of a parent make found in MAKEFLAGS, None if there is none we can use"""
+
+    @staticmethod
+    def inherited(makeflags=None):
+        if makeflags is None:
+            makeflags = os.getenv("MAKEFLAGS", "")
+        match = Jobserver.AUTH_RE.search(makeflags)
+        if match is None:
+            return None
+        auth = match.group(1)
+        jobs = Jobserver.MAKEFLAGS_JOBS_RE.search(makeflags)
+        try:
+            jobserver = Jobserver(int(jobs.group(1)) if jobs else 1, parent_auth=auth)
+        except (OSError, ValueError) as e:
+            # Make only passes its descriptors to recipes marked with "+"
+            logger.warning(
+                f"Cannot join the parent make jobserver {auth} ({e}), starting our own"
+            )
+            return None
+        logger.info(
+            f"Joined the parent make jobserver {auth} with {jobserver.jobs} jobs"
+        )
+        return jobserver
+
+    def __init__(self, jobs, parent_auth=None):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.closed = False
+        self.fifo_auth = self.make_version() >= self.FIFO_AUTH_VERSION
+        if parent_auth is not None:
+            self.join(parent_auth)
+            return
+        self.fifo_dir = tempfile.mkdtemp(prefix="msmv-jobserver-")
+        self.fifo_path = os.path.join(self.fifo_dir, "fifo")
+        os.mkfifo(self.fifo_path, 0o600)
+        # Opening read-write never blocks and keeps the fifo alive without a reader
+        self.read_fd = os.open(self.fifo_path, os.O_RDWR)
+        self.write_fd = os.open(self.fifo_path, os.O_WRONLY)
+        # A separate non-blocking description for our own token reads
+        self.poll_fd = os.open(self.fifo_path, os.O_RDWR | os.O_NONBLOCK)
+        for fd in (self.read_fd, self.write_fd):
+            os.set_inheritable(fd, True)
+        self.owned_fds = (self.read_fd, self.write_fd, self.poll_fd)
+        os.write(self.write_fd, self.TOKEN * jobs)
+        if self.fifo_auth:
+            self.auth = f"fifo:{self.fifo_path}"
+        else:
+            self.auth = f"{self.read_fd},{self.write_fd}"
+        logger.info(f"Started make jobserver with {jobs} jobs at {self.fifo_path}")
+
+    """Use the token fifo or pipe of a parent make, its tokens are never added to"""
+
+    def join(self, auth):
+        self.fifo_dir = None
+        self.auth = auth
+        if auth.startswith("fifo:"):
+            if not self.fifo_auth:
+                raise ValueError("make older than 4.4 cannot open a jobserver fifo")
+            path = auth[len("fifo:") :]
+            self.read_fd = os.open(path, os.O_RDWR)
+            self.write_fd = os.open(path, os.O_WRONLY)
+            self.poll_fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            for fd in (self.read_fd, self.write_fd):
+                os.set_inheritable(fd, True)
+            self.owned_fds = (self.read_fd, self.write_fd, self.poll_fd)
+        else:
+            self.read_fd, self.write_fd = (int(fd) for fd in auth.split(","))
+            for fd in (self.read_fd, self.write_fd):
+                os.fstat(fd)
+                os.set_inheritable(fd, True)
+            # Reopening the pipe gives a description we can make non-blocking without
+            # changing the one the parent make reads from
+            self.poll_fd = os.open(
+                f"/proc/self/fd/{self.read_fd}", os.O_RDONLY | os.O_NONBLOCK
+            )
+            self.owned_fds = (self.poll_fd,)
+
+    @staticmethod
+    def make_version():
+        try:
+            result = subprocess.run(
+                [os.getenv("MAKE", "make"), "--version"],
+                capture_output=True,
+                text=True,
+            )
+        except OSError:
+            return (0, 0)
+        match = Jobserver.VERSION_RE.search(result.stdout)
+        return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+    """MAKEFLAGS that make every make started with them a client of this jobserver"""
+
+    def make_flags(self):
+        return f"-j{self.jobs} --jobserver-auth={self.auth}"
+
+    """
+    A make command without the -j options of the user, an explicit job count would
+    make it leave the jobserver and run that many jobs on top of the shared budget
+    """
+
+    @staticmethod
+    def make_command(command):
+        words = []
+        dropped = []
+        previous = None
+        for word in shlex.split(command):
+            # The count may follow -j or --jobs as its own word
+            if previous in ("-j", "--jobs") and word.isdigit():
+                dropped.append(word)
+            elif Jobserver.JOBS_FLAG_RE.fullmatch(word):
+                dropped.append(word)
+            else:
+                words.append(word)
+            previous = word
+        if dropped:
+            logger.warning(
+                f'Ignoring "{" ".join(dropped)}" in "{command}", make takes its jobs from the shared jobserver'
+            )
+        return shlex.join(words)
+
+    """Environment and pass_fds for a command that should join the jobserver"""
+
+    def client_env(self, env):
+        env = dict(env)
+        # Keep flags such as -k the caller set, drop the jobserver of a parent make,
+        # which is this jobserver when msmv joined it
+        other_flags = [
+            flag
+            for flag in env.get("MAKEFLAGS", "").split()
+            if not flag.startswith(("-j", "--jobserver"))
+        ]
+        env["MAKEFLAGS"] = " ".join(other_flags + [self.make_flags()])
+        return env, (self.read_fd, self.write_fd)
+
+    """
+    Hold one token while a command runs, the job make itself starts without a token.
+    Waiting is abandoned if the command group of the caller is cancelled.
+    """
+
+    @contextlib.contextmanager
+    def slot(self, command=()):
+        token = None
+        while token is None:
+            group = current_command_group.get()
+            if group is not None and group.cancelled:
+                raise CommandCancelled(command)
+            try:
+                token = os.read(self.poll_fd, 1)
+            except BlockingIOError:
+                select.select([self.poll_fd], [], [], 0.5)
+        try:
+            yield
+        finally:
+            os.write(self.write_fd, token)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        for fd in self.owned_fds:
+            os.close(fd)
+        if self.fifo_dir is not None:
+            shutil.rmtree(self.fifo_dir, ignore_errors=True)
@@ -0,0 +1,90 @@
+import os
+import re
+
+"""In-memory reader/writer for kernel .config files with the semantics of scripts/config"""
+
+
+class KConfig:
+    PREFIX = "CONFIG_"
+
+    SET_RE = re.compile(r"^(CONFIG_[A-Za-z0-9_]+)=(.*)$")
+    NOT_SET_RE = re.compile(r"^# (CONFIG_[A-Za-z0-9_]+) is not set$")
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "r") as f:
+            self.lines = f.read().splitlines()
+        self._index = None
+
+    """Normalise an option name the way scripts/config does: strip one CONFIG_ prefix, then upper case"""
+
+    @classmethod
+    def symbol(cls, option):
+        if option.startswith(cls.PREFIX):
+            option = option[len(cls.PREFIX) :]
+        return cls.PREFIX + option.upper()
+
+    """Map each symbol to the line numbers that assign it or mark it as not set"""
+
+    def index(self):
+        if self._index is None:
+            self._index = {}
+            for line_number, line in enumerate(self.lines):
+                match = self.SET_RE.match(line) or self.NOT_SET_RE.match(line)
+                if match:
+                    self._index.setdefault(match.group(1), []).append(line_number)
+        return self._index
+
+    """Return the value of an option, 'n' if it is marked as not set, None if absent"""
+
+    def get(self, option):
+        line_numbers = self.index().get(self.symbol(option))
+        if not line_numbers:
+            return None
+        line = self.lines[line_numbers[0]]
+        match = self.SET_RE.match(line)
+        return match.group(2) if match else "n"
+
+    """Replace every existing assignment of the symbol in place, or append it (scripts/config set_var)"""
+
+    def set_line(self, symbol, new_line):
+        line_numbers = self.index().get(symbol)
+        if line_numbers:
+            for line_number in line_numbers:
+                self.lines[line_number] = new_line
+        else:
+            self.index()[symbol] = [len(self.lines)]
+            self.lines.append(new_line)
+
+    def set_val(self, option, value):
+        symbol = self.symbol(option)
+        self.set_line(symbol, f"{symbol}={value}")
+
+    def set_str(self, option, value):
+        symbol = self.symbol(option)
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        self.set_line(symbol, f'{symbol}="{escaped}"')
+
+    def enable(self, option):
+        self.set_val(option, "y")
+
+    def module(self, option):
+        self.set_val(option, "m")
+
+    def disable(self, option):
+        symbol = self.symbol(option)
+        self.set_line(symbol, f"# {symbol} is not set")
+
+    """Apply a recipe's kernel.options map, equivalent to scripts/config --set-val per entry"""
+
+    def apply_options(self, options):
+        for option, raw_value in options.items():
+            # Remove both single and double quotes
+            self.set_val(option, str(raw_value).strip("'\""))
+
+    def write(self, path=None):
+        path = path or self.path
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(self.lines) + "\n")
+        os.replace(tmp_path, path)
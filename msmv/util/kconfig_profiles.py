@@ -0,0 +1,97 @@
+"""
+Named sets of kernel options that recipes list in kernel.profiles instead of copying
+them. Profiles are merged in the order given, later ones overriding earlier ones, and
+the recipe's own kernel.options are applied on top of the result.
+"""
+
+
+class KConfigProfiles:
+    # Options shared by every architecture, keyed by profile name
+    PROFILES = {
+        "serial": {
+            "PRINTK": "y",
+            "TTY": "y",
+            "SERIAL_CORE": "y",
+            "SERIAL_CORE_CONSOLE": "y",
+            "VT": "n",
+        },
+        "virtio-net": {
+            "NET": "y",
+            "NET_CORE": "y",
+            "INET": "y",
+            "UNIX": "y",
+            "PACKET": "y",
+            "PCI": "y",
+            "PCI_MSI": "y",
+            "VIRTIO_MENU": "y",
+            "VIRTIO": "y",
+            "VIRTIO_PCI": "y",
+            "VIRTIO_MMIO": "y",
+            "NETDEVICES": "y",
+            "VIRTIO_NET": "y",
+            "ETHERNET": "n",
+            "WLAN": "n",
+            "WIRELESS": "n",
+        },
+        "framebuffer": {
+            "PCI": "y",
+            "VIRTIO_MENU": "y",
+            "VIRTIO": "y",
+            "VIRTIO_PCI": "y",
+            "DRM": "y",
+            "DRM_VIRTIO_GPU": "y",
+            "DRM_FBDEV_EMULATION": "y",
+            "FB": "y",
+            "VT": "y",
+            "VT_CONSOLE": "y",
+            "FRAMEBUFFER_CONSOLE": "y",
+        },
+        "debug": {
+            "PRINTK": "y",
+            "PRINTK_TIME": "y",
+            "BUG": "y",
+            "KALLSYMS": "y",
+            "DEBUG_KERNEL": "y",
+            "DEBUG_INFO_NONE": "n",
+            "DEBUG_INFO_DWARF_TOOLCHAIN_DEFAULT": "y",
+            "GDB_SCRIPTS": "y",
+            "DEBUG_FS": "y",
+            "MAGIC_SYSRQ": "y",
+        },
+    }
+
+    # Additions per kernel ARCH, e.g. the UART each QEMU machine emulates
+    ARCH_PROFILES = {
+        "arm64": {
+            "serial": {
+                "SERIAL_AMBA_PL011": "y",
+                "SERIAL_AMBA_PL011_CONSOLE": "y",
+            },
+        },
+        "x86": {
+            "serial": {
+                "SERIAL_8250": "y",
+                "SERIAL_8250_CONSOLE": "y",
+            },
+            "debug": {
+                "EARLY_PRINTK": "y",
+            },
+        },
+    }
+
+    """Merge the named profiles for a kernel ARCH into one ordered option map"""
+
+    @staticmethod
+    def resolve(names, arch):
+        unknown = [name for name in names if name not in KConfigProfiles.PROFILES]
+        if unknown:
+            raise Exception(
+                f"Unknown kernel profile(s) {', '.join(unknown)}, "
+                f"available: {', '.join(KConfigProfiles.PROFILES)}"
+            )
+
+        options = {}
+        for name in names:
+            options.update(KConfigProfiles.PROFILES[name])
+            options.update(KConfigProfiles.ARCH_PROFILES.get(arch, {}).get(name, {}))
+        return options
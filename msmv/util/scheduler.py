@@ -0,0 +1,200 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from msmv.util.build_cache import BuildCache
+from msmv.util.cpu_budget import CpuBudget
+from msmv.util.host_command import CommandGroup, current_command_group
+from msmv.util.tracer import Tracer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Run a dependency graph of build tasks in parallel under a global CPU budget.
+With a BuildState, tasks that declare their inputs are skipped while those inputs,
+and the runs of the fingerprinted tasks they depend on, are unchanged.
+"""
+
+
+class BuildTask:
+    def __init__(self, name, func, deps=(), cpus=1, inputs=None, outputs=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cpus = cpus
+        # inputs() returns what the task's work depends on, outputs(result) the paths
+        # it produces; tasks without inputs always run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.result = None
+        self.duration = None
+        self.skipped = False
+
+
+class BuildScheduler:
+    JOBS_RE = re.compile(r"(?:^|\s)(?:-j\s*|--jobs[=\s])(\d+)")
+
+    def __init__(self, cpu_budget=None, state=None):
+        self.cpu_budget = cpu_budget or CpuBudget.jobs()
+        self.state = state
+        self.tasks = {}
+
+    """Return the -j value of a make command line, 1 if it does not run in parallel"""
+
+    @classmethod
+    def make_jobs(cls, command):
+        match = cls.JOBS_RE.search(command)
+        return int(match.group(1)) if match else 1
+
+    """Register a task; it starts once every task named in deps has finished"""
+
+    def add_task(self, name, func, deps=(), cpus=1, inputs=None, outputs=None):
+        if name in self.tasks:
+            raise ValueError(f"Duplicate build task: {name}")
+        self.tasks[name] = BuildTask(name, func, deps, cpus, inputs, outputs)
+        return self.tasks[name]
+
+    """
+    Fingerprint a task's inputs together with the last run of each fingerprinted
+    dependency, None if the task is not tracked. Call once its dependencies finished.
+    """
+
+    def fingerprint(self, name):
+        task = self.tasks[name]
+        if self.state is None or task.inputs is None:
+            return None
+        return BuildCache.make_key(
+            {
+                "inputs": task.inputs(),
+                "deps": {
+                    dep: self.state.stamp(dep)
+                    for dep in task.deps
+                    if self.tasks[dep].inputs is not None
+                },
+            }
+        )
+
+    """True if the task would be skipped, e.g. to avoid fetching what it would need"""
+
+    def up_to_date(self, name):
+        fingerprint = self.fingerprint(name)
+        return fingerprint is not None and self.state.is_fresh(name, fingerprint)
+
+    def validate(self):
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise ValueError(f"Task {task.name} depends on unknown task {dep}")
+
+        # Depth first search for cycles
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle involving task {name}")
+            visiting.add(name)
+            for dep in self.tasks[name].deps:
+                visit(dep)
+            visiting.remove(name)
+            done.add(name)
+
+        for name in self.tasks:
+            visit(name)
+
+    """
+    Run every task and return a dict of task name to result. The first failure stops
+    scheduling, terminates the host commands of tasks still running and is re-raised.
+    """
+
+    def run(self):
+        self.validate()
+        condition = threading.Condition()
+        pending = dict(self.tasks)
+        finished = set()
+        running = {}
+        failures = []
+        cpus_free = self.cpu_budget
+        # Commands started by any task belong to this group, nested under the caller's
+        group = CommandGroup(parent=current_command_group.get())
+
+        def execute(task, cpus):
+            nonlocal cpus_free
+            start = time.monotonic()
+            try:
+                fingerprint = self.fingerprint(task.name)
+                if fingerprint is not None and self.state.is_fresh(
+                    task.name, fingerprint
+                ):
+                    task.result = self.state.result(task.name)
+                    task.skipped = True
+                    logger.info(f"Task {task.name} is up to date, skipping")
+                else:
+                    if fingerprint is not None:
+                        self.state.invalidate(task.name)
+                    with Tracer.trace(task.name, cpus=cpus):
+                        task.result = task.func()
+                    if fingerprint is not None:
+                        outputs = task.outputs(task.result) if task.outputs else ()
+                        self.state.record(task.name, fingerprint, task.result, outputs)
+            except BaseException as e:
+                failures.append((task.name, e))
+            finally:
+                task.duration = time.monotonic() - start
+                with condition:
+                    cpus_free += cpus
+                    running.pop(task.name)
+                    finished.add(task.name)
+                    condition.notify_all()
+            if not task.skipped:
+                logger.info(f"Task {task.name} finished in {task.duration:.1f}s")
+
+        with ThreadPoolExecutor(max_workers=max(len(self.tasks), 1)) as executor:
+            with condition:
+                while pending or running:
+                    if failures:
+                        # Stop scheduling new work, cancel running tasks and let them drain
+                        if not group.cancelled:
+                            logger.info(
+                                f"Task {failures[0][0]} failed, cancelling {len(running)} running tasks"
+                            )
+                            group.terminate()
+                        if not running:
+                            break
+                        condition.wait()
+                        continue
+
+                    ready = [
+                        task
+                        for task in pending.values()
+                        if all(dep in finished for dep in task.deps)
+                    ]
+                    started = False
+                    for task in ready:
+                        # Tasks wider than the whole budget run once everything else is idle
+                        cpus = min(task.cpus, self.cpu_budget)
+                        if cpus > cpus_free:
+                            continue
+                        cpus_free -= cpus
+                        del pending[task.name]
+                        running[task.name] = task
+                        logger.info(f"Starting task {task.name} ({cpus} CPUs)")
+                        context = contextvars.copy_context()
+                        context.run(current_command_group.set, group)
+                        executor.submit(context.run, execute, task, cpus)
+                        started = True
+
+                    if not started:
+                        condition.wait()
+
+        if failures:
+            name, error = failures[0]
+            logger.error(f"Task {name} failed: {error}")
+            raise error
+
+        return {name: task.result for name, task in self.tasks.items()}
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+
+from msmv.util.build_cache import BuildCache
+from msmv.util.downloader import SegmentedDownloader
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Content-addressed cache of downloaded source archives, shared by every recipe and workspace.
+Archives are stored under the sha256 of their contents and found through an index of
+URLs; every reuse re-hashes the file, so a truncated or corrupted archive is dropped and
+downloaded again instead of failing a build later on. Downloads go through
+SegmentedDownloader, so they resume after an interruption and fall back to mirrors.
+"""
+
+
+class SourceCache:
+    NAMESPACE = "sources"
+    INDEX_DIR = ".urls"
+
+    def __init__(self, cache=None):
+        self.cache = cache or BuildCache()
+        self.namespace_dir = os.path.join(self.cache.cache_dir, self.NAMESPACE)
+        self.index_dir = os.path.join(self.namespace_dir, self.INDEX_DIR)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    @staticmethod
+    def url_key(url):
+        return BuildCache.make_key({"url": url})
+
+    def indexed_sha256(self, url):
+        index_path = os.path.join(self.index_dir, self.url_key(url))
+        if not os.path.isfile(index_path):
+            return None
+        with open(index_path, "r") as f:
+            return json.load(f)["sha256"]
+
+    """
+    Remember the sha256 of url's archive without having it, e.g. as reported by the
+    build worker that fetched it. An archive fetched here later replaces it.
+    """
+
+    def record(self, url, sha256):
+        if self.indexed_sha256(url) is None:
+            self._write_index(url, sha256.lower())
+
+    def _write_index(self, url, sha256):
+        index_path = os.path.join(self.index_dir, self.url_key(url))
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": url, "sha256": sha256}, f)
+        os.replace(tmp_path, index_path)
+
+    """
+    Return the path of a verified cached archive for url, None if there is none.
+    With sha256 given (from the recipe) only an archive with that hash is accepted.
+    """
+
+    def lookup(self, url, sha256=None):
+        sha256 = (sha256 or self.indexed_sha256(url) or "").lower() or None
+        if sha256 is None:
+            return None
+        entry_dir = self.cache.lookup(self.NAMESPACE, sha256)
+        if entry_dir is None:
+            return None
+
+        meta = self.cache.read_meta(entry_dir)
+        if meta is None:
+            return None
+        path = os.path.join(entry_dir, meta["files"][0])
+        if not os.path.isfile(path) or BuildCache.hash_file(path) != sha256:
+            logger.warning(f"Cached source {path} is corrupted, discarding it")
+            BuildCache.remove_tree(entry_dir)
+            return None
+        return path
+
+    """Raise if the file at path does not have the expected sha256, a no-op without one"""
+
+    @staticmethod
+    def verify_file(path, sha256, actual=None, name=None):
+        if sha256 is None:
+            return
+        actual = actual or BuildCache.hash_file(path)
+        if actual != sha256.lower():
+            raise Exception(
+                f"Checksum mismatch for {name or path}: expected sha256 {sha256}, got {actual}"
+            )
+
+    """
+    Move an archive downloaded elsewhere into the cache, after checking it against
+    the expected sha256. Returns the cached path.
+    """
+
+    def add(self, url, path, sha256=None, actual_sha256=None):
+        actual_sha256 = actual_sha256 or BuildCache.hash_file(path)
+        self.verify_file(path, sha256, actual_sha256, name=url)
+        file_name = os.path.basename(url.split("?")[0]) or "source"
+        entry_dir = self.cache.store(
+            self.NAMESPACE,
+            actual_sha256,
+            {file_name: path},
+            description=url,
+            move=True,
+        )
+        self._write_index(url, actual_sha256)
+        return os.path.join(entry_dir, file_name)
+
+    """
+    Return a verified local copy of url, downloading it once for all builds on this cache.
+    mirrors are tried in order when url fails or serves a file with the wrong sha256;
+    the archive is cached under url either way.
+    """
+
+    def fetch(self, url, sha256=None, mirrors=()):
+        cached_path = self.lookup(url, sha256)
+        if cached_path:
+            logger.info(f"Using cached source {url}")
+            return cached_path
+
+        # Parallel builds wanting the same URL wait here for the first download
+        with self.cache.lock(self.NAMESPACE, self.url_key(url)):
+            cached_path = self.lookup(url, sha256)
+            if cached_path:
+                return cached_path
+
+            # Named after the URL, so a download cut short by a failed or killed
+            # build is resumed by the next one
+            partial_path = self.partial_path(url)
+            logger.info(f"Downloading {url}")
+            actual_sha256 = SegmentedDownloader().download(
+                [url, *mirrors], partial_path, sha256
+            )
+            return self.add(url, partial_path, sha256, actual_sha256)
+
+    """A partial download on the cache's filesystem, so adding it to the cache is a rename"""
+
+    def partial_path(self, url):
+        return os.path.join(self.namespace_dir, f".download-{self.url_key(url)}")
@@ -0,0 +1,214 @@
+import contextvars
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from msmv.util.build_cache import BuildCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Block I/O counters in rusage are in 512 byte units
+RUSAGE_BLOCK_SIZE = 512
+
+# The tracer of the running build and the innermost open span, if any
+current_tracer = contextvars.ContextVar("current_tracer", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+"""A timed build phase or host command and the resources spent in it"""
+
+
+class Span:
+    def __init__(self, name, category, parent=None, args=None):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.args = dict(args or {})
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.start = time.monotonic()
+        self.end = None
+        self.user_s = 0.0
+        self.sys_s = 0.0
+        self.max_rss_kb = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.commands = 0
+
+    @property
+    def duration(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def add_usage(self, user_s, sys_s, max_rss_kb, read_bytes, write_bytes):
+        self.user_s += user_s
+        self.sys_s += sys_s
+        self.max_rss_kb = max(self.max_rss_kb, max_rss_kb)
+        self.read_bytes += read_bytes
+        self.write_bytes += write_bytes
+
+    def summary(self):
+        return {
+            **self.args,
+            "wall_s": round(self.duration, 3),
+            "user_s": round(self.user_s, 3),
+            "sys_s": round(self.sys_s, 3),
+            "max_rss_kb": self.max_rss_kb,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+            "commands": self.commands,
+        }
+
+
+"""
+Collects spans for build phases and every host command run inside them.
+Commands report the rusage of their whole process tree as returned by wait4 and
+roll it up into every enclosing span; phases add the CPU time and block I/O of
+their own thread. The result can be exported as a Chrome trace (chrome://tracing,
+Perfetto) or printed as a per-phase summary table.
+"""
+
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.origin = time.monotonic()
+        self.pid = os.getpid()
+
+    """Open a span on the current tracer, a no-op when the build is not traced"""
+
+    @staticmethod
+    def trace(name, category="phase", **args):
+        tracer = current_tracer.get()
+        if tracer is None:
+            return nullcontext()
+        return tracer.span(name, category, **args)
+
+    """Record a finished host command on the current tracer, if any"""
+
+    @staticmethod
+    def record(command, start, end, rusage=None, exit_code=None, log_path=None):
+        tracer = current_tracer.get()
+        if tracer is not None:
+            tracer.record_command(command, start, end, rusage, exit_code, log_path)
+
+    @staticmethod
+    def thread_usage():
+        if not hasattr(resource, "RUSAGE_THREAD"):
+            return None
+        return resource.getrusage(resource.RUSAGE_THREAD)
+
+    @contextmanager
+    def span(self, name, category="phase", **args):
+        span = Span(name, category, current_span.get(), args)
+        token = current_span.set(span)
+        usage_start = self.thread_usage()
+        try:
+            yield span
+        finally:
+            span.end = time.monotonic()
+            current_span.reset(token)
+            usage_end = self.thread_usage()
+            if usage_start and usage_end:
+                # Work done in this thread itself, e.g. archiving or extracting in Python
+                span.add_usage(
+                    usage_end.ru_utime - usage_start.ru_utime,
+                    usage_end.ru_stime - usage_start.ru_stime,
+                    0,
+                    (usage_end.ru_inblock - usage_start.ru_inblock) * RUSAGE_BLOCK_SIZE,
+                    (usage_end.ru_oublock - usage_start.ru_oublock) * RUSAGE_BLOCK_SIZE,
+                )
+            with self.lock:
+                self.spans.append(span)
+
+    def record_command(
+        self, command, start, end, rusage=None, exit_code=None, log_path=None
+    ):
+        args = {"command": " ".join(command), "exit_code": exit_code}
+        if log_path:
+            args["log"] = log_path
+        span = Span(os.path.basename(command[0]), "command", current_span.get(), args)
+        span.start, span.end = start, end
+        span.commands = 1
+
+        if rusage is not None:
+            # ru_maxrss is the largest process in the tree; Linux starts counting at
+            # fork, so tiny commands show roughly the RSS of this interpreter
+            usage = (
+                rusage.ru_utime,
+                rusage.ru_stime,
+                rusage.ru_maxrss,
+                rusage.ru_inblock * RUSAGE_BLOCK_SIZE,
+                rusage.ru_oublock * RUSAGE_BLOCK_SIZE,
+            )
+            span.add_usage(*usage)
+        with self.lock:
+            parent = span.parent
+            while parent is not None:
+                if rusage is not None:
+                    parent.add_usage(*usage)
+                parent.commands += 1
+                parent = parent.parent
+            self.spans.append(span)
+
+    """Return the spans as Chrome trace events, one track per build thread"""
+
+    def chrome_trace(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+
+        thread_ids = {}
+        events = []
+        for span in spans:
+            if span.thread_id not in thread_ids:
+                thread_ids[span.thread_id] = len(thread_ids) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": thread_ids[span.thread_id],
+                        "args": {"name": span.thread_name},
+                    }
+                )
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": round((span.start - self.origin) * 1e6),
+                    "dur": round(span.duration * 1e6),
+                    "pid": self.pid,
+                    "tid": thread_ids[span.thread_id],
+                    "args": span.summary(),
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f, indent=1)
+        logger.info(f"Wrote build trace to {path}")
+
+    def print_summary(self):
+        with self.lock:
+            phases = sorted(
+                (span for span in self.spans if span.category in ("build", "phase")),
+                key=lambda span: span.start,
+            )
+
+        print(
+            f"{'PHASE':<24} {'WALL':>9} {'USER':>9} {'SYS':>8} {'PEAK RSS':>9} "
+            f"{'READ':>8} {'WRITE':>8} {'CMDS':>5}"
+        )
+        for span in phases:
+            print(
+                f"{span.name[:24]:<24} {span.duration:>8.1f}s {span.user_s:>8.1f}s "
+                f"{span.sys_s:>7.1f}s {BuildCache.format_size(span.max_rss_kb * 1024):>9} "
+                f"{BuildCache.format_size(span.read_bytes):>8} "
+                f"{BuildCache.format_size(span.write_bytes):>8} {span.commands:>5}"
+            )
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import math
+import re
+import signal
+import statistics
+import time
+
+from msmv.util.host_command import HostCommand
+from msmv.vm.packer import VMBooter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Boot a built kernel and initramfs under QEMU several times and time the serial console.
+Every marker is the host time in seconds from launching QEMU to the first console line
+matching it, so QEMU startup and firmware are part of the measurement.
+"""
+
+
+class BootBenchmark:
+    # First printk lines on the architectures we build for; kernels built with
+    # PRINTK=n print nothing, first_output then is the earliest sign of life
+    KERNEL_START_RE = r"Booting Linux on physical CPU|Linux version \d"
+    # Printed by the generated init right before it execs the application
+    INIT_RE = r"Starting the program\.\.\."
+
+    def __init__(
+        self,
+        target_arch,
+        kernel_path,
+        initrd_path,
+        cmdline,
+        ready_regex=None,
+        enable_network=False,
+        timeout=120,
+    ):
+        self.command = VMBooter.build_boot_command(
+            target_arch,
+            kernel_path,
+            initrd_path,
+            cmdline,
+            enable_network=enable_network,
+        )
+        self.timeout = timeout
+        self.markers = {
+            "kernel_start": re.compile(self.KERNEL_START_RE),
+            "init": re.compile(self.INIT_RE),
+        }
+        if ready_regex:
+            self.markers["app_ready"] = re.compile(ready_regex)
+        # The run is over once the last marker shows up
+        self.final_marker = list(self.markers)[-1]
+
+    """Boot once and return the seconds from launch to each marker, None for markers never seen"""
+
+    async def run_once(self):
+        timings = {"first_output": None, **{name: None for name in self.markers}}
+        start = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+            limit=1024 * 1024,
+        )
+
+        async def watch_console():
+            while True:
+                raw_line = await process.stdout.readline()
+                if not raw_line:
+                    return
+                now = time.monotonic() - start
+                if timings["first_output"] is None:
+                    timings["first_output"] = now
+                line = raw_line.decode(errors="replace").rstrip("\r\n")
+                for name, pattern in self.markers.items():
+                    if timings[name] is None and pattern.search(line):
+                        timings[name] = now
+                if timings[self.final_marker] is not None:
+                    return
+
+        try:
+            await asyncio.wait_for(watch_console(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Boot did not reach {self.final_marker} in {self.timeout}s")
+        finally:
+            HostCommand.kill_process_group(process.pid, signal.SIGKILL)
+            await process.wait()
+        return timings
+
+    async def run_all(self, runs):
+        logger.info(f"Benchmarking boot with: {' '.join(self.command)}")
+        results = []
+        for run in range(runs):
+            timings = await self.run_once()
+            logger.info(
+                f"Run {run + 1}/{runs}: "
+                + ", ".join(
+                    f"{name} {self.format_seconds(value)}"
+                    for name, value in timings.items()
+                )
+            )
+            results.append(timings)
+        return results
+
+    def run(self, runs=10):
+        return asyncio.run(self.run_all(runs))
+
+    @staticmethod
+    def format_seconds(value):
+        return f"{value:.3f}s" if value is not None else "-"
+
+    """Linear interpolation between closest ranks, as numpy's default percentile"""
+
+    @staticmethod
+    def percentile(values, pct):
+        values = sorted(values)
+        rank = (len(values) - 1) * pct / 100
+        low, high = math.floor(rank), math.ceil(rank)
+        return values[low] + (values[high] - values[low]) * (rank - low)
+
+    @staticmethod
+    def summarize(results):
+        summary = {}
+        for name in results[0] if results else []:
+            values = [run[name] for run in results if run[name] is not None]
+            if not values:
+                summary[name] = None
+                continue
+            summary[name] = {
+                "count": len(values),
+                "min": min(values),
+                "mean": statistics.fmean(values),
+                "p50": BootBenchmark.percentile(values, 50),
+                "p95": BootBenchmark.percentile(values, 95),
+                "p99": BootBenchmark.percentile(values, 99),
+                "max": max(values),
+            }
+        return summary
+
+    def report(self, results):
+        return {
+            "command": self.command,
+            "markers": {
+                name: pattern.pattern for name, pattern in self.markers.items()
+            },
+            "runs": results,
+            "summary": self.summarize(results),
+        }
+
+    """Print p50/p95/p99 per marker, with the p50 change against a previous report if given"""
+
+    @staticmethod
+    def print_report(report, baseline=None):
+        runs = len(report["runs"])
+        print(
+            f"{'MARKER':<14} {'SEEN':>6} {'P50':>9} {'P95':>9} {'P99':>9} {'MAX':>9}"
+            + (f" {'P50 DELTA':>10}" if baseline else "")
+        )
+        for name, stats in report["summary"].items():
+            if stats is None:
+                print(f"{name:<14} {f'0/{runs}':>6}")
+                continue
+            seen = f"{stats['count']}/{runs}"
+            line = (
+                f"{name:<14} {seen:>6} {stats['p50']:>8.3f}s "
+                f"{stats['p95']:>8.3f}s {stats['p99']:>8.3f}s {stats['max']:>8.3f}s"
+            )
+            previous = (baseline or {}).get("summary", {}).get(name)
+            if previous:
+                line += f" {stats['p50'] - previous['p50']:>+9.3f}s"
+            print(line)
+
+    @staticmethod
+    def write_report(report, path):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Wrote boot benchmark results to {path}")
@@ -1,5 +1,6 @@
 import logging
 
+from msmv.builders.kernel import KernelBuilder
 from msmv.util.host_command import HostCommand
 
 logger = logging.getLogger(__name__)
@@ -9,6 +10,22 @@ logger.setLevel(logging.INFO)
 
 
 class VMBooter:
+    # QEMU's names for the kernel architectures recipes map to
+    QEMU_ARCH_MAPPING = {
+        "arm64": "aarch64",
+        "x86": "x86_64",
+    }
+    # aarch64 has no microvm machine type
+    QEMU_MACHINE_MAPPING = {
+        "x86_64": "microvm",
+    }
+
+    """QEMU architecture of a recipe's target_arch, resolved like the kernel build does"""
+
+    @staticmethod
+    def qemu_arch(target_arch):
+        kernel_arch = KernelBuilder.ARCH_MAPPING.get(target_arch, target_arch)
+        return VMBooter.QEMU_ARCH_MAPPING.get(kernel_arch, kernel_arch)
 
     """Create a QEMU image"""
 
@@ -39,26 +56,26 @@ class VMBooter:
             cwd=".",
         )
 
-    """Setup boot parameters and run QEMU."""
+    """Build the QEMU command line used to boot a kernel and initramfs"""
 
     @staticmethod
-    def setup_boot_parameters(
+    def build_boot_command(
         target_arch,
         kernel_path,
         initrd_path,
         cmdline,
-        output_path,
         enable_network=False,
         network_interface="net0",
     ):
         # Determine the appropriate qemu binary based on target_arch
-        qemu_binary = f"qemu-system-{target_arch}"
+        qemu_arch = VMBooter.qemu_arch(target_arch)
+        qemu_binary = f"qemu-system-{qemu_arch}"
 
         # Base command setup
         command = [
             qemu_binary,
             "-M",
-            "virt",
+            VMBooter.QEMU_MACHINE_MAPPING.get(qemu_arch, "virt"),
             "-cpu",
             "max",
             "-kernel",
@@ -84,6 +101,28 @@ class VMBooter:
                     f"virtio-net-device,netdev={network_interface}",
                 ]
             )
+        return command
+
+    """Setup boot parameters and run QEMU."""
+
+    @staticmethod
+    def setup_boot_parameters(
+        target_arch,
+        kernel_path,
+        initrd_path,
+        cmdline,
+        output_path,
+        enable_network=False,
+        network_interface="net0",
+    ):
+        command = VMBooter.build_boot_command(
+            target_arch,
+            kernel_path,
+            initrd_path,
+            cmdline,
+            enable_network=enable_network,
+            network_interface=network_interface,
+        )
 
         logger.info(f"Running QEMU with command: {' '.join(command)}")
         HostCommand.run_command(command, cwd=output_path)
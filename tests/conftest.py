@@ -0,0 +1,26 @@
+import functools
+import http.server
+import threading
+
+import pytest
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+"""Serve a directory over HTTP on an ephemeral port, yields (base URL, directory)"""
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    serve_dir = tmp_path / "srv"
+    serve_dir.mkdir()
+    handler = functools.partial(QuietHandler, directory=str(serve_dir))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", serve_dir
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,31 @@
+import io
+import tarfile
+
+from msmv.builders.application import ApplicationBuilder
+from msmv.util.build_cache import BuildCache
+
+
+def test_install_is_keyed_on_the_source_fetched_into_its_cache(
+    tmp_path, http_server, monkeypatch
+):
+    base_url, serve_dir = http_server
+    with tarfile.open(serve_dir / "hello-1.0.tar.gz", "w:gz") as tar:
+        info = tarfile.TarInfo("hello-1.0/Makefile")
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"all:"))
+    # Nothing may end up in the default cache
+    monkeypatch.setenv("MSMV_CACHE_DIR", str(tmp_path / "default-cache"))
+    app = {"url": f"{base_url}/hello-1.0.tar.gz", "install_command": "true"}
+    app_builder = ApplicationBuilder(
+        app,
+        str(tmp_path / "destdir"),
+        name="hello",
+        cache=BuildCache(str(tmp_path / "cache")),
+    )
+
+    assert app_builder.install_cache_key() is None
+    source_dir = app_builder.download_and_extract_app(app, str(tmp_path / "hello"))
+    with open(f"{source_dir}/Makefile") as f:
+        assert f.read() == "all:"
+    assert app_builder.install_cache_key() is not None
+    assert not (tmp_path / "default-cache" / "sources").exists()
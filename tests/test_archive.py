@@ -0,0 +1,86 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+from msmv.util.archive import Archive
+
+
+def make_archive(path, members, mode):
+    with tarfile.open(path, mode) as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+@pytest.mark.parametrize(
+    "suffix, mode, compression",
+    [
+        ("tar", "w", "tar"),
+        ("tar.gz", "w:gz", "gz"),
+        ("tar.xz", "w:xz", "xz"),
+        ("tar.bz2", "w:bz2", "bz2"),
+    ],
+)
+def test_extracts_by_content_not_name(tmp_path, suffix, mode, compression):
+    # Named .tgz whatever the compression, detection must not look at the name
+    path = tmp_path / "app-1.0.tgz"
+    make_archive(path, {"app-1.0/Makefile": b"all:\n"}, mode)
+    assert Archive.detect_compression(str(path)) == compression
+
+    source_dir = Archive.extract(str(path), str(tmp_path))
+    assert source_dir == str(tmp_path / "app-1.0")
+    assert (tmp_path / "app-1.0" / "Makefile").read_bytes() == b"all:\n"
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".")] == []
+
+
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="zstd not installed")
+def test_extracts_zstd_through_the_cli(tmp_path):
+    make_archive(tmp_path / "app.tar", {"app/main.c": b"int main;\n"}, "w")
+    subprocess.run(
+        ["zstd", "-q", str(tmp_path / "app.tar"), "-o", str(tmp_path / "app.tar.zst")],
+        check=True,
+    )
+    (tmp_path / "out").mkdir()
+    assert Archive.extract(str(tmp_path / "app.tar.zst"), str(tmp_path / "out")) == str(
+        tmp_path / "out" / "app"
+    )
+
+
+def test_members_without_a_common_top_directory(tmp_path):
+    path = tmp_path / "flat.tar.gz"
+    make_archive(path, {"Makefile": b"all:\n", "main.c": b""}, "w:gz")
+    (tmp_path / "out").mkdir()
+    source_dir = Archive.extract(str(path), str(tmp_path / "out"))
+    assert source_dir == str(tmp_path / "out" / "flat")
+    assert sorted(os.listdir(source_dir)) == ["Makefile", "main.c"]
+
+
+def test_member_outside_the_destination_is_rejected(tmp_path):
+    path = tmp_path / "evil.tar.gz"
+    make_archive(path, {"app/Makefile": b"", "app/../../escaped": b"x"}, "w:gz")
+    (tmp_path / "out").mkdir()
+    with pytest.raises(tarfile.FilterError):
+        Archive.extract(str(path), str(tmp_path / "out"))
+    assert not (tmp_path / "escaped").exists()
+    assert os.listdir(tmp_path / "out") == []
+
+
+def test_extract_once_skips_an_unchanged_archive(tmp_path):
+    path = tmp_path / "app.tar.gz"
+    make_archive(path, {"app/Makefile": b"all:\n"}, "w:gz")
+    dest_dir = tmp_path / "src"
+
+    source_dir = Archive.extract_once(str(path), str(dest_dir))
+    (dest_dir / "app" / "built.o").write_bytes(b"")
+    assert Archive.extract_once(str(path), str(dest_dir)) == source_dir
+    assert (dest_dir / "app" / "built.o").exists()
+
+    make_archive(path, {"app/Makefile": b"all: new\n"}, "w:gz")
+    Archive.extract_once(str(path), str(dest_dir))
+    assert not (dest_dir / "app" / "built.o").exists()
+    assert (dest_dir / "app" / "Makefile").read_bytes() == b"all: new\n"
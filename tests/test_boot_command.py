@@ -0,0 +1,11 @@
+from msmv.vm.packer import VMBooter
+
+
+def test_boot_command_uses_the_kernel_build_architecture():
+    # Recipes default to the kernel build's "x86"
+    for target_arch in ("x86", "x86_64"):
+        command = VMBooter.build_boot_command(target_arch, "bzImage", "rootfs.cpio", "")
+        assert command[:3] == ["qemu-system-x86_64", "-M", "microvm"]
+    for target_arch in ("aarch64", "arm64"):
+        command = VMBooter.build_boot_command(target_arch, "Image", "rootfs.cpio", "")
+        assert command[:3] == ["qemu-system-aarch64", "-M", "virt"]
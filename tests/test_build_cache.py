@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+from msmv.util.build_cache import BuildCache
+
+
+def store_file(cache, tmp_path, key, content, namespace="ns"):
+    path = tmp_path / f"src-{key[:4]}-{len(content)}"
+    path.write_text(content)
+    return cache.store(namespace, key, {"file": str(path)})
+
+
+def test_concurrent_lookups_of_one_entry(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"))
+    key = "a" * 64
+    store_file(cache, tmp_path, key, "x")
+    errors = []
+
+    def look_up():
+        for _ in range(300):
+            try:
+                assert cache.lookup("ns", key)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=look_up) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert [meta["key"] for meta in cache.entries()] == [key]
+
+
+def test_store_replaces_entry(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"))
+    key = "b" * 64
+    store_file(cache, tmp_path, key, "old")
+    entry_dir = store_file(cache, tmp_path, key, "new!")
+    with open(os.path.join(entry_dir, "file")) as f:
+        assert f.read() == "new!"
+    # No staging or renamed-aside directories are left behind
+    assert os.listdir(os.path.dirname(entry_dir)) == [key]
+
+
+def test_prune_evicts_least_recently_looked_up(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"), max_size="1G")
+    first, second = "c" * 64, "d" * 64
+    store_file(cache, tmp_path, first, "1" * 1000)
+    store_file(cache, tmp_path, second, "2" * 1000)
+    time.sleep(0.01)
+    cache.lookup("ns", first)
+
+    evicted = cache.prune(1500)
+    assert [meta["key"] for meta in evicted] == [second]
+    assert cache.lookup("ns", first)
+    assert cache.lookup("ns", second) is None
+
+
+def test_prune_skips_locked_and_pinned_entries(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"), max_size="1G")
+    locked, pinned, unused = "e" * 64, "f" * 64, "0" * 64
+    for key in (locked, pinned, unused):
+        store_file(cache, tmp_path, key, key[0] * 1000)
+
+    with cache.lock("ns", locked), cache.pin("ns", pinned) as entry_dir:
+        assert entry_dir == cache.entry_path("ns", pinned)
+        evicted = cache.prune(0)
+    assert [meta["key"] for meta in evicted] == [unused]
+    assert cache.lookup("ns", locked) and cache.lookup("ns", pinned)
+
+    assert len(cache.prune(0)) == 2
+
+
+def test_pin_yields_none_for_an_evicted_entry(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"))
+    with cache.pin("ns", "1" * 64) as entry_dir:
+        assert entry_dir is None
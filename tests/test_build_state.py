@@ -0,0 +1,107 @@
+import json
+import os
+
+from msmv.bin.msmv import VMManager
+from msmv.util.build_state import BuildState
+from msmv.util.scheduler import BuildScheduler
+
+APP = {
+    "url": "https://example.com/hello-1.0.tar.gz",
+    "build_command": "make",
+    "install_command": "make install",
+    "output_executable_path": "/usr/bin/hello",
+}
+
+
+"""
+Build a toy version of the recipe build: an application, init starting it and a cpio
+of both. Returns the names of the tasks that ran and the scheduler's results.
+"""
+
+
+def run_build(workspace, app, force=()):
+    ran = []
+    scheduler = BuildScheduler(cpu_budget=2, state=BuildState(workspace, force))
+    cpio_path = os.path.join(workspace, "rootfs.cpio")
+
+    def task(name, result=None):
+        def run():
+            ran.append(name)
+            return result
+
+        return run
+
+    def make_cpio():
+        ran.append("cpio")
+        with open(cpio_path, "w") as f:
+            f.write("cpio")
+
+    scheduler.add_task(
+        "app:hello",
+        task("app:hello", {"destdir": os.path.join(workspace, "destdir")}),
+        inputs=lambda: {"app": VMManager.app_build_inputs(app)},
+        outputs=lambda result: [workspace],
+    )
+    scheduler.add_task(
+        "init",
+        task("init"),
+        inputs=lambda: {"start_program": app["output_executable_path"]},
+    )
+    scheduler.add_task(
+        "cpio",
+        make_cpio,
+        deps=["app:hello", "init"],
+        inputs=lambda: {},
+        outputs=lambda result: [cpio_path],
+    )
+    # Not fingerprinted, runs every time
+    scheduler.add_task("check", task("check"), deps=["cpio"])
+    return ran, scheduler.run()
+
+
+def test_unchanged_build_is_skipped_and_results_restored(tmp_path):
+    workspace = str(tmp_path)
+    ran, results = run_build(workspace, APP)
+    assert sorted(ran) == ["app:hello", "check", "cpio", "init"]
+
+    with open(os.path.join(workspace, BuildState.FILE_NAME)) as f:
+        phases = json.load(f)["phases"]
+    assert sorted(phases) == ["app:hello", "cpio", "init"]
+
+    ran, rerun_results = run_build(workspace, APP)
+    assert ran == ["check"]
+    assert rerun_results["app:hello"] == results["app:hello"]
+
+
+def test_output_executable_path_reruns_only_init_and_cpio(tmp_path):
+    workspace = str(tmp_path)
+    run_build(workspace, APP)
+
+    moved = {**APP, "output_executable_path": "/bin/hello"}
+    ran, _ = run_build(workspace, moved)
+    assert sorted(ran) == ["check", "cpio", "init"]
+
+    ran, _ = run_build(workspace, {**moved, "build_command": "make V=1"})
+    assert sorted(ran) == ["app:hello", "check", "cpio"]
+
+
+def test_forced_or_missing_outputs_rerun(tmp_path):
+    workspace = str(tmp_path)
+    run_build(workspace, APP)
+
+    # Forcing a phase reruns the phases built from it too
+    ran, _ = run_build(workspace, APP, force=["app:hello"])
+    assert sorted(ran) == ["app:hello", "check", "cpio"]
+
+    ran, _ = run_build(workspace, APP, force=[BuildState.ALL])
+    assert sorted(ran) == ["app:hello", "check", "cpio", "init"]
+
+    os.remove(os.path.join(workspace, "rootfs.cpio"))
+    ran, _ = run_build(workspace, APP)
+    assert sorted(ran) == ["check", "cpio"]
+
+
+def test_phases_accepted_by_force():
+    config = {"general": {"name": "vm"}, "applications": {"hello": APP}}
+    phases = VMManager.phases(config)
+    assert "app:hello" in phases and "kernel" in phases and BuildState.ALL in phases
@@ -0,0 +1,53 @@
+import shutil
+
+from msmv.builders.kernel import KernelBuilder
+from msmv.util.build_cache import BuildCache
+from msmv.util.ccache import CCache
+from msmv.util.host_command import HostCommand
+
+
+def test_phase_stats_counts_only_known_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda name: "/usr/bin/ccache")
+    ccache = CCache(str(tmp_path / "ccache"), stats_dir=str(tmp_path / "stats"))
+    ccache.env("build")
+    with open(ccache.stats_log("build"), "w") as f:
+        f.write(
+            "# main.c\n"
+            "direct_cache_hit\nlocal_storage_read_hit\nlocal_storage_hit\n"
+            "# util.c\n"
+            "cache_miss\ndirect_cache_miss\npreprocessed_cache_miss\n"
+            "local_storage_miss\nlocal_storage_write\n"
+            "# app\n"
+            "called_for_link\n"
+            "# conftest.c\n"
+            "autoconf_test\n"
+        )
+
+    assert ccache.phase_stats("build") == {"hits": 1, "misses": 1, "uncacheable": 2}
+
+
+def test_kernel_ccache_wraps_the_kbuild_compiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda name: "/usr/bin/ccache")
+    commands = []
+    monkeypatch.setattr(
+        HostCommand, "run_command", lambda command, **kwargs: commands.append(command)
+    )
+    for var in ("LLVM", "KERNEL_CC", "HOSTCC"):
+        monkeypatch.delenv(var, raising=False)
+    # The host compiler must not replace the cross compiler
+    monkeypatch.setenv("CC", "cc")
+    monkeypatch.setenv("CROSS_COMPILE", "aarch64-linux-gnu-")
+    kernel_builder = KernelBuilder(
+        {"kernel": {"version": "1.0"}},
+        cache=BuildCache(str(tmp_path / "cache")),
+        ccache=CCache(str(tmp_path / "ccache"), stats_dir=str(tmp_path / "stats")),
+    )
+
+    kernel_builder.run_make(["Image"], str(tmp_path), str(tmp_path), "build")
+    monkeypatch.setenv("LLVM", "-17")
+    kernel_builder.run_make(["Image"], str(tmp_path), str(tmp_path), "build")
+
+    assert "CC=/usr/bin/ccache aarch64-linux-gnu-gcc" in commands[0]
+    assert "HOSTCC=/usr/bin/ccache gcc" in commands[0]
+    assert "CC=/usr/bin/ccache clang-17" in commands[1]
+    assert "HOSTCC=/usr/bin/ccache clang-17" in commands[1]
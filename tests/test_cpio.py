@@ -0,0 +1,144 @@
+import io
+import os
+import stat
+
+from msmv.builders.cpio import CpioWriter
+
+HEADER_FIELDS = [
+    "ino",
+    "mode",
+    "uid",
+    "gid",
+    "nlink",
+    "mtime",
+    "filesize",
+    "devmajor",
+    "devminor",
+    "rdevmajor",
+    "rdevminor",
+    "namesize",
+    "check",
+]
+
+
+def align(offset):
+    return offset + (-offset % 4)
+
+
+"""Parse a newc archive into a list of (name, header fields, data)"""
+
+
+def parse_newc(data):
+    entries = []
+    offset = 0
+    while True:
+        assert data[offset : offset + 6] == CpioWriter.MAGIC
+        values = [
+            int(data[offset + 6 + 8 * i : offset + 14 + 8 * i], 16)
+            for i in range(len(HEADER_FIELDS))
+        ]
+        header = dict(zip(HEADER_FIELDS, values))
+        name_start = offset + 110
+        name = data[name_start : name_start + header["namesize"] - 1].decode()
+        assert data[name_start + header["namesize"] - 1] == 0
+        data_start = align(name_start + header["namesize"])
+        body = data[data_start : data_start + header["filesize"]]
+        offset = align(data_start + header["filesize"])
+        if name == CpioWriter.TRAILER:
+            return entries, offset
+        entries.append((name, header, body))
+
+
+def make_tree(root):
+    (root / "bin").mkdir()
+    (root / "bin" / "app").write_bytes(b"#!/bin/sh\necho hi\n")
+    os.chmod(root / "bin" / "app", 0o755)
+    os.symlink("app", root / "bin" / "sh")
+    (root / "etc").mkdir(mode=0o700)
+    (root / "etc" / "hosts").write_bytes(b"127.0.0.1 localhost\n")
+    os.link(root / "etc" / "hosts", root / "etc" / "hosts.bak")
+    (root / "empty").write_bytes(b"")
+
+
+def write_tree(root, fileobj):
+    writer = CpioWriter(fileobj, mtime=1234)
+    writer.add_tree(str(root), [("dev/console", "c", 5, 1), ("dev/sda", "b", 8, 0)])
+    writer.close()
+
+
+def test_tree_round_trips_through_newc_headers(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    make_tree(root)
+    (root / "dev").mkdir()
+    archive = io.BytesIO()
+    write_tree(root, archive)
+    data = archive.getvalue()
+
+    entries, end = parse_newc(data)
+    assert len(data) % CpioWriter.BLOCK_SIZE == 0
+    assert data[end:] == b"\0" * (len(data) - end)
+    by_name = {name: (header, body) for name, header, body in entries}
+    assert [name for name, _, _ in entries] == [
+        "bin",
+        "bin/app",
+        "bin/sh",
+        "dev",
+        "dev/console",
+        "dev/sda",
+        "empty",
+        "etc",
+        "etc/hosts",
+        "etc/hosts.bak",
+    ]
+    for header, _ in by_name.values():
+        assert header["uid"] == header["gid"] == 0
+        assert header["mtime"] == 1234
+
+    header, body = by_name["bin/app"]
+    assert header["mode"] == stat.S_IFREG | 0o755
+    assert body == b"#!/bin/sh\necho hi\n"
+    header, body = by_name["bin/sh"]
+    assert stat.S_ISLNK(header["mode"]) and body == b"app"
+    header, _ = by_name["etc"]
+    assert header["mode"] == stat.S_IFDIR | 0o700
+    assert by_name["empty"][0]["filesize"] == 0
+
+    header, _ = by_name["dev/console"]
+    assert header["mode"] == stat.S_IFCHR | 0o666
+    assert (header["rdevmajor"], header["rdevminor"]) == (5, 1)
+    header, _ = by_name["dev/sda"]
+    assert header["mode"] == stat.S_IFBLK | 0o666
+    assert (header["rdevmajor"], header["rdevminor"]) == (8, 0)
+
+    inos = [header["ino"] for name, header, _ in entries if not name.startswith("etc/")]
+    assert len(set(inos)) == len(inos)
+
+
+def test_hard_links_share_an_inode_and_carry_data_once(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    make_tree(root)
+    archive = io.BytesIO()
+    write_tree(root, archive)
+
+    entries, _ = parse_newc(archive.getvalue())
+    by_name = {name: (header, body) for name, header, body in entries}
+    first, first_body = by_name["etc/hosts"]
+    last, last_body = by_name["etc/hosts.bak"]
+    assert first["ino"] == last["ino"]
+    assert first["nlink"] == last["nlink"] == 2
+    assert first["filesize"] == 0 and first_body == b""
+    assert last_body == b"127.0.0.1 localhost\n"
+    assert first["ino"] != by_name["bin/app"][0]["ino"]
+
+
+def test_file_descriptor_and_buffered_output_match(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    make_tree(root)
+    buffered = io.BytesIO()
+    write_tree(root, buffered)
+    with open(tmp_path / "rootfs.cpio", "wb") as f:
+        write_tree(root, f)
+    assert (tmp_path / "rootfs.cpio").read_bytes() == buffered.getvalue()
@@ -0,0 +1,118 @@
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+import pytest
+
+from msmv.util.downloader import SegmentedDownloader
+
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)")
+PAYLOAD = os.urandom(64 * 1024)
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.encodings.append(self.headers.get("Accept-Encoding"))
+        start, end = 0, len(PAYLOAD) - 1
+        match = RANGE_RE.match(self.headers.get("Range", ""))
+        if match and server.ranges:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+
+        # A one byte probe is always answered in full
+        limit = server.drop_after if end > start else None
+        data = PAYLOAD[start : end + 1]
+        if limit is not None:
+            data = data[:limit]
+            self.close_connection = True
+        self.wfile.write(data)
+        with server.lock:
+            server.served += len(data)
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.encodings = []
+    httpd.served = 0
+    httpd.ranges = True
+    httpd.drop_after = None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/file.bin"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def downloader(**kwargs):
+    options = {
+        "segments": 4,
+        "min_segment_size": 8 * 1024,
+        "chunk_size": 1024,
+        "retry_delay": 0,
+    }
+    return SegmentedDownloader(**{**options, **kwargs})
+
+
+def test_segments_survive_repeated_drops(tmp_path, server):
+    # Every response is cut off after 3K, each 16K segment needs six connections
+    server.drop_after = 3 * 1024
+    dest_path = str(tmp_path / "file.bin")
+
+    assert downloader(retries=2).download([server.url], dest_path, SHA256) == SHA256
+    with open(dest_path, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert not os.path.exists(SegmentedDownloader.state_path(dest_path))
+    assert set(server.encodings) == {"identity"}
+
+
+def test_server_without_range_support(tmp_path, server):
+    server.ranges = False
+    dest_path = str(tmp_path / "file.bin")
+
+    assert downloader().download([server.url], dest_path, SHA256) == SHA256
+    with open(dest_path, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+def test_interrupted_download_resumes(tmp_path, server):
+    server.drop_after = 10 * 1024
+    dest_path = str(tmp_path / "file.bin")
+    with pytest.raises(Exception, match="Could not download"):
+        downloader(segments=1, retries=0).download([server.url], dest_path, SHA256)
+    assert os.path.exists(SegmentedDownloader.state_path(dest_path))
+
+    server.drop_after = None
+    served_before = server.served
+    assert downloader().download([server.url], dest_path, SHA256) == SHA256
+    with open(dest_path, "rb") as f:
+        assert f.read() == PAYLOAD
+    # Only the missing part and the probe were fetched again
+    assert server.served - served_before == len(PAYLOAD) - 10 * 1024 + 1
+
+
+def test_wrong_file_is_discarded(tmp_path, server):
+    dest_path = str(tmp_path / "file.bin")
+    wrong = "0" * 64
+    with pytest.raises(Exception, match="sha256 mismatch"):
+        downloader().download([server.url], dest_path, wrong)
+    assert not os.path.exists(dest_path)
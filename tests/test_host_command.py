@@ -0,0 +1,89 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+from msmv.builders.application import ApplicationBuilder
+from msmv.util.host_command import CommandError, HostCommand, RusagePopen
+from msmv.util.tracer import Tracer
+
+
+def test_logged_command_runs_inside_an_event_loop(tmp_path):
+    log_path = str(tmp_path / "echo.log")
+
+    async def build_step():
+        return HostCommand.run_command(
+            [sys.executable, "-c", "print('hi')"], cwd=str(tmp_path), log_path=log_path
+        )
+
+    assert asyncio.run(build_step()) == (None, None)
+    with open(log_path) as f:
+        assert "hi" in f.read()
+
+
+def test_logged_command_failure_raises_command_error(tmp_path):
+    async def build_step():
+        HostCommand.run_command(
+            [sys.executable, "-c", "import sys; print('boom'); sys.exit(3)"],
+            cwd=str(tmp_path),
+            log_path=str(tmp_path / "fail.log"),
+        )
+
+    with pytest.raises(CommandError) as error:
+        asyncio.run(build_step())
+    assert error.value.exit_code == 3
+    assert error.value.log_tail == ["boom"]
+
+
+def test_missing_executable_is_a_command_error(tmp_path):
+    builder = ApplicationBuilder(
+        {
+            "output_executable_path": "/bin/app --serve",
+            "install_command": "make install",
+        },
+        str(tmp_path / "destdir"),
+        log_dir=str(tmp_path / "logs"),
+    )
+    with pytest.raises(CommandError, match="Application not found at .*bin/app"):
+        builder.check_compiled_app()
+
+
+def test_pipeline_reaps_both_commands_with_rusage(tmp_path, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(
+        Tracer,
+        "record",
+        staticmethod(
+            lambda command, start, end, rusage, exit_code, *_: recorded.append(
+                (command, rusage, exit_code)
+            )
+        ),
+    )
+    output, _ = HostCommand.run_command(
+        [sys.executable, "-c", "print('a'); print('b')"],
+        cwd=str(tmp_path),
+        next_command=[
+            sys.executable,
+            "-c",
+            "import sys; print(len(sys.stdin.readlines()))",
+        ],
+    )
+
+    assert output.strip() == "2"
+    assert len(recorded) == 2
+    # Both commands were reaped through wait4
+    for _, rusage, exit_code in recorded:
+        assert rusage is not None and exit_code == 0
+
+
+def test_poll_and_wait_collect_rusage(tmp_path):
+    process = RusagePopen([sys.executable, "-c", "import sys; sys.exit(4)"])
+    sleeper = RusagePopen([sys.executable, "-c", "import time; time.sleep(5)"])
+    with pytest.raises(subprocess.TimeoutExpired):
+        sleeper.wait(timeout=0.01)
+    sleeper.kill()
+    assert sleeper.wait() == -9
+    assert process.wait() == 4
+    assert process.rusage.ru_utime > 0 or process.rusage.ru_stime > 0
+    assert process.poll() == 4
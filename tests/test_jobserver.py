@@ -0,0 +1,41 @@
+import os
+
+from msmv.util.jobserver import Jobserver
+
+
+def test_make_command_drops_job_counts():
+    command = Jobserver.make_command("make -j 8 V=1 --jobs=3 -j4 -j")
+    assert command == "make V=1"
+    assert Jobserver.make_command("lkmake LLVM=1") == "lkmake LLVM=1"
+
+
+def test_joins_parent_make_jobserver():
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, Jobserver.TOKEN * 2)
+    try:
+        jobserver = Jobserver.inherited(f" -j3 --jobserver-auth={read_fd},{write_fd}")
+        assert jobserver.jobs == 3
+
+        env, pass_fds = jobserver.client_env(
+            {"MAKEFLAGS": "k -j3 --jobserver-auth=9,9"}
+        )
+        assert env["MAKEFLAGS"] == f"k -j3 --jobserver-auth={read_fd},{write_fd}"
+        assert pass_fds == (read_fd, write_fd)
+
+        # Tokens come from and go back to the parent's pipe
+        with jobserver.slot():
+            with jobserver.slot():
+                assert os.get_blocking(read_fd)
+        jobserver.close()
+        assert os.read(read_fd, 2) == Jobserver.TOKEN * 2
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_parent_without_descriptors_is_ignored():
+    read_fd, write_fd = os.pipe()
+    os.close(read_fd)
+    os.close(write_fd)
+    assert Jobserver.inherited(f"-j3 --jobserver-auth={read_fd},{write_fd}") is None
+    assert Jobserver.inherited("-k") is None
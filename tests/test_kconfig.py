@@ -0,0 +1,55 @@
+from msmv.util.kconfig import KConfig
+
+
+def write_config(tmp_path, text):
+    path = tmp_path / ".config"
+    path.write_text(text)
+    return KConfig(str(path))
+
+
+def test_symbol_strips_prefix_before_upper_casing():
+    assert KConfig.symbol("CONFIG_NET") == "CONFIG_NET"
+    assert KConfig.symbol("net") == "CONFIG_NET"
+    assert KConfig.symbol("config_net") == "CONFIG_CONFIG_NET"
+
+
+def test_set_replaces_existing_and_appends_new(tmp_path):
+    config = write_config(tmp_path, "CONFIG_NET=n\n# CONFIG_BLOCK is not set\n")
+    config.enable("NET")
+    config.set_val("LOG_BUF_SHIFT", 14)
+    config.write()
+    assert (tmp_path / ".config").read_text() == (
+        "CONFIG_NET=y\n# CONFIG_BLOCK is not set\nCONFIG_LOG_BUF_SHIFT=14\n"
+    )
+    assert KConfig(str(tmp_path / ".config")).get("LOG_BUF_SHIFT") == "14"
+
+
+def test_unset_marks_every_assignment(tmp_path):
+    config = write_config(tmp_path, "CONFIG_NET=y\nCONFIG_NET=m\n")
+    config.disable("NET")
+    config.disable("BLOCK")
+    assert config.lines == [
+        "# CONFIG_NET is not set",
+        "# CONFIG_NET is not set",
+        "# CONFIG_BLOCK is not set",
+    ]
+    assert config.get("NET") == "n"
+    assert config.get("MISSING") is None
+
+
+def test_module(tmp_path):
+    config = write_config(tmp_path, "# CONFIG_EXT4_FS is not set\n")
+    config.module("EXT4_FS")
+    assert config.lines == ["CONFIG_EXT4_FS=m"]
+
+
+def test_string_quoting(tmp_path):
+    config = write_config(tmp_path, "")
+    config.set_str("CMDLINE", 'console=ttyS0 msg="hi" path=C:\\')
+    assert config.lines == ['CONFIG_CMDLINE="console=ttyS0 msg=\\"hi\\" path=C:\\\\"']
+
+
+def test_apply_options_strips_quotes(tmp_path):
+    config = write_config(tmp_path, "")
+    config.apply_options({"NR_CPUS": 4, "DEFAULT_HOSTNAME": "'\"vm\"'"})
+    assert config.lines == ["CONFIG_NR_CPUS=4", "CONFIG_DEFAULT_HOSTNAME=vm"]
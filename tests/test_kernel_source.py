@@ -0,0 +1,84 @@
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from msmv.builders.kernel import KernelBuilder
+from msmv.util.build_cache import BuildCache
+
+
+def make_tarball(path, members):
+    with tarfile.open(path, "w:xz") as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def kernel_builder(tmp_path, url, sha256):
+    config = {"kernel": {"version": "1.0", "url": url, "sha256": sha256}}
+    return KernelBuilder(config, cache=BuildCache(str(tmp_path / "cache")))
+
+
+def test_downloads_and_extracts_url_with_query(tmp_path, http_server):
+    base_url, serve_dir = http_server
+    sha256 = make_tarball(
+        serve_dir / "linux-1.0.tar.xz", {"linux-1.0/Makefile": b"all:\n"}
+    )
+    builder = kernel_builder(tmp_path, f"{base_url}/linux-1.0.tar.xz?x=1", sha256)
+
+    source_dir = builder.handle_kernel_source(str(tmp_path / "ws"))
+
+    with open(os.path.join(source_dir, "Makefile"), "rb") as f:
+        assert f.read() == b"all:\n"
+
+
+def test_tarball_with_wrong_sha256_is_rejected(tmp_path):
+    kernel_dir = tmp_path / "ws" / "kernel"
+    kernel_dir.mkdir(parents=True)
+    make_tarball(kernel_dir / "linux-1.0.tar.xz", {"linux-1.0/Makefile": b"all:\n"})
+    builder = kernel_builder(tmp_path, "http://127.0.0.1:1/unused.tar.xz", "0" * 64)
+
+    with pytest.raises(Exception, match="Checksum mismatch"):
+        builder.handle_kernel_source(str(tmp_path / "ws"))
+    assert builder.cache.lookup("kernel-source", builder.source_cache_key()) is None
+
+
+def test_member_outside_the_tree_is_rejected(tmp_path, http_server):
+    base_url, serve_dir = http_server
+    sha256 = make_tarball(
+        serve_dir / "linux-1.0.tar.xz",
+        {"linux-1.0/Makefile": b"all:\n", "../escaped": b"x"},
+    )
+    builder = kernel_builder(tmp_path, f"{base_url}/linux-1.0.tar.xz", sha256)
+
+    with pytest.raises(tarfile.FilterError):
+        builder.handle_kernel_source(str(tmp_path / "ws"))
+    assert not list(tmp_path.rglob("escaped"))
+
+
+def test_cache_key_follows_the_compiler_kbuild_runs(tmp_path, monkeypatch):
+    monkeypatch.delenv("LLVM", raising=False)
+    monkeypatch.delenv("CROSS_COMPILE", raising=False)
+    # Kbuild ignores CC from the environment
+    monkeypatch.setenv("CC", "cc")
+    assert KernelBuilder.kernel_compiler() == "gcc"
+    native_key = kernel_builder(tmp_path, None, None).kernel_cache_key()
+
+    monkeypatch.setenv("CROSS_COMPILE", "aarch64-linux-gnu-")
+    assert KernelBuilder.kernel_compiler() == "aarch64-linux-gnu-gcc"
+    cross_key = kernel_builder(tmp_path, None, None).kernel_cache_key()
+    assert cross_key != native_key
+
+    for llvm, compiler in (
+        ("1", "clang"),
+        ("-17", "clang-17"),
+        ("/opt/llvm/", "/opt/llvm/clang"),
+    ):
+        monkeypatch.setenv("LLVM", llvm)
+        assert KernelBuilder.kernel_compiler() == compiler
+    assert kernel_builder(tmp_path, None, None).kernel_cache_key() != cross_key
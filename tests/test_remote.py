@@ -0,0 +1,133 @@
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from msmv.builders.application import ApplicationBuilder
+from msmv.builders.kernel import KernelBuilder
+from msmv.builders.remote import BuildWorker, WorkerPool
+from msmv.util.build_cache import BuildCache
+
+
+def address(worker):
+    return f"127.0.0.1:{worker.server.server_address[1]}"
+
+
+"""Two workers serving on ephemeral ports, sharing a token with the coordinator"""
+
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("MSMV_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv(BuildWorker.TOKEN_ENV, "secret")
+    started = []
+    for index in range(2):
+        worker = BuildWorker("127.0.0.1:0", str(tmp_path / f"worker{index}"))
+        threading.Thread(target=worker.serve, daemon=True).start()
+        started.append(worker)
+    yield started
+    for worker in started:
+        worker.server.shutdown()
+
+
+def test_busy_workers_fall_back_to_local_builds(workers, tmp_path):
+    building = threading.Semaphore(0)
+    release = threading.Event()
+
+    def fake_build_app(worker):
+        def build_app(request):
+            building.release()
+            release.wait(10)
+            path = tmp_path / f"{request['name']}.tar.gz"
+            path.write_bytes(f"{request['name']} built on {address(worker)}".encode())
+            return {"artifacts": {"destdir": worker.publish(str(path))}}
+
+        return build_app
+
+    for worker in workers:
+        worker.build_app = fake_build_app(worker)
+    pool = WorkerPool([address(worker) for worker in workers])
+    assert len(pool.workers) == 2
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = {
+            name: executor.submit(pool.submit, "app", {"name": name}, name)
+            for name in ("first", "second")
+        }
+        assert building.acquire(timeout=10) and building.acquire(timeout=10)
+        # Both workers are building, the third phase is left to the local build
+        assert pool.submit("app", {"name": "third"}, "third") == (None, None)
+        release.set()
+        results = {name: future.result() for name, future in futures.items()}
+
+    assert {url for url, _ in results.values()} == set(pool.workers)
+    for name, (url, body) in results.items():
+        dest_path = tmp_path / f"{name}.fetched"
+        pool.fetch(url, body["artifacts"]["destdir"], str(dest_path))
+        assert dest_path.read_bytes() == (tmp_path / f"{name}.tar.gz").read_bytes()
+
+    # Both workers are idle again
+    url, body = pool.submit("app", {"name": "fourth"}, "fourth")
+    assert url in pool.workers
+
+
+def test_fetch_rejects_sha256_mismatch(workers, tmp_path):
+    sha256 = "0" * 64
+    with open(workers[0].artifact_path(sha256), "wb") as f:
+        f.write(b"not what was asked for")
+    pool = WorkerPool([address(workers[0])])
+
+    with pytest.raises(Exception, match="different sha256"):
+        pool.fetch(pool.workers[0], sha256, str(tmp_path / "artifact"))
+
+
+def test_kernel_with_other_cache_key_is_built_locally(workers, tmp_path):
+    workers[0].build_kernel = lambda request: {
+        "cache_key": "f" * 64,
+        "artifacts": {"image": "0" * 64, "config": "0" * 64},
+    }
+    pool = WorkerPool([address(workers[0])])
+    config = {"kernel": {"version": "1.0"}}
+    kernel_builder = KernelBuilder(config, cache=BuildCache(str(tmp_path / "cache")))
+
+    assert pool.build_kernel(kernel_builder) is False
+    assert kernel_builder.cached_kernel() is None
+
+
+def test_app_built_on_worker_is_cached_here(workers, tmp_path):
+    worker = workers[0]
+    installed = tmp_path / "installed"
+    (installed / "bin").mkdir(parents=True)
+    (installed / "bin" / "hello").write_text("hello")
+    archive_path = tmp_path / ApplicationBuilder.INSTALL_ARCHIVE
+    with tarfile.open(archive_path, "w:gz") as tar:
+        tar.add(installed, arcname=".")
+    worker.build_app = lambda request: {
+        "artifacts": {"destdir": worker.publish(str(archive_path))},
+        "source_sha256": "a" * 64,
+    }
+    pool = WorkerPool([address(worker)])
+    app = {"url": "https://example.com/hello-1.0.tar.gz", "install_command": "true"}
+    app_builder = ApplicationBuilder(
+        app,
+        str(tmp_path / "destdir"),
+        name="hello",
+        cache=BuildCache(str(tmp_path / "coordinator-cache")),
+    )
+
+    # The coordinator never fetched the source, the worker's sha256 keys the install
+    assert app_builder.cached_install() is None
+    assert pool.build_app(app_builder)
+    assert (tmp_path / "destdir" / "bin" / "hello").read_text() == "hello"
+    assert app_builder.cached_install() is not None
+
+
+def test_workers_require_the_token(workers, tmp_path, monkeypatch):
+    monkeypatch.setenv(BuildWorker.TOKEN_ENV, "wrong")
+    assert WorkerPool([address(worker) for worker in workers]).workers == []
+
+    monkeypatch.delenv(BuildWorker.TOKEN_ENV)
+    assert WorkerPool([address(worker) for worker in workers]).workers == []
+    with pytest.raises(Exception, match="without a token"):
+        BuildWorker("0.0.0.0:0", str(tmp_path / "open-worker"))
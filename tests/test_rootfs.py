@@ -0,0 +1,65 @@
+import os
+
+from msmv.builders.rootfs import RootFSBuilder
+from msmv.util.build_cache import BuildCache
+
+
+def make_layer_dir(path, content=b"hello\n"):
+    path.mkdir()
+    (path / "bin").mkdir()
+    (path / "bin" / "app").write_bytes(content)
+    os.symlink("app", path / "bin" / "sh")
+    # Old enough to be remembered by the hash cache
+    os.utime(path / "bin" / "app", (1_000_000, 1_000_000))
+
+
+def test_tree_hash_reuses_hashes_of_unchanged_files(tmp_path, monkeypatch):
+    layer_dir = tmp_path / "layer"
+    make_layer_dir(layer_dir)
+    hash_cache_path = str(tmp_path / "hashes.json")
+
+    first = RootFSBuilder.tree_hash(str(layer_dir), hash_cache_path)
+    assert first == RootFSBuilder.tree_hash(str(layer_dir))
+
+    hashed = []
+    original_hash_file = BuildCache.hash_file
+    monkeypatch.setattr(
+        BuildCache,
+        "hash_file",
+        staticmethod(lambda path: hashed.append(path) or original_hash_file(path)),
+    )
+    assert RootFSBuilder.tree_hash(str(layer_dir), hash_cache_path) == first
+    assert hashed == []
+
+    (layer_dir / "bin" / "app").write_bytes(b"changed\n")
+    assert RootFSBuilder.tree_hash(str(layer_dir), hash_cache_path) != first
+    assert hashed == [str(layer_dir / "bin" / "app")]
+
+
+def test_layered_cpio_reuses_cached_layers(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"))
+    builder = RootFSBuilder(str(tmp_path / "base"), cache=cache)
+    make_layer_dir(tmp_path / "base")
+    make_layer_dir(tmp_path / "app", b"app\n")
+    layers = [("base", str(tmp_path / "base")), ("app", str(tmp_path / "app"))]
+
+    cpio_path = builder.make_layered_cpio(layers, str(tmp_path / "out"))
+    with open(cpio_path, "rb") as f:
+        first = f.read()
+    assert len(cache.entries("layers")) == 2
+
+    assert builder.make_layered_cpio(layers, str(tmp_path / "out")) == cpio_path
+    with open(cpio_path, "rb") as f:
+        assert f.read() == first
+
+
+def test_layers_are_not_evicted_before_concatenation(tmp_path):
+    # Every store prunes down to one byte, only the held locks keep the layers
+    cache = BuildCache(str(tmp_path / "cache"), max_size=1)
+    builder = RootFSBuilder(str(tmp_path / "base"), cache=cache)
+    make_layer_dir(tmp_path / "base")
+    make_layer_dir(tmp_path / "app", b"app\n")
+    layers = [("base", str(tmp_path / "base")), ("app", str(tmp_path / "app"))]
+
+    cpio_path = builder.make_layered_cpio(layers, str(tmp_path / "out"))
+    assert os.path.getsize(cpio_path) > 0
@@ -0,0 +1,93 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from msmv.util.host_command import HostCommand
+from msmv.util.scheduler import BuildScheduler
+
+
+def test_tasks_run_after_their_dependencies():
+    order = []
+    lock = threading.Lock()
+
+    def task(name):
+        def run():
+            with lock:
+                order.append(name)
+            return name.upper()
+
+        return run
+
+    scheduler = BuildScheduler(cpu_budget=4)
+    scheduler.add_task("cpio", task("cpio"), deps=["rootfs", "init"])
+    scheduler.add_task("init", task("init"), deps=["app"])
+    scheduler.add_task("rootfs", task("rootfs"))
+    scheduler.add_task("app", task("app"), deps=["rootfs"])
+    results = scheduler.run()
+
+    assert results == {"cpio": "CPIO", "init": "INIT", "rootfs": "ROOTFS", "app": "APP"}
+    assert order == ["rootfs", "app", "init", "cpio"]
+
+
+def test_running_tasks_stay_within_the_cpu_budget():
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal running, peak
+        with lock:
+            running += 2
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 2
+
+    scheduler = BuildScheduler(cpu_budget=4)
+    for index in range(6):
+        scheduler.add_task(f"compile-{index}", work, cpus=2)
+    # Wider than the budget, runs alone
+    scheduler.add_task("kernel", lambda: peak, cpus=8)
+    scheduler.run()
+
+    assert peak == 4
+
+
+def test_failure_cancels_running_and_dependent_tasks(tmp_path):
+    ran = []
+
+    def fail():
+        time.sleep(0.2)
+        raise RuntimeError("configure failed")
+
+    def long_compile():
+        HostCommand.run_command(
+            [sys.executable, "-c", "import time; time.sleep(30)"], cwd=str(tmp_path)
+        )
+
+    scheduler = BuildScheduler(cpu_budget=4)
+    scheduler.add_task("configure", fail)
+    scheduler.add_task("compile", long_compile)
+    scheduler.add_task("install", lambda: ran.append("install"), deps=["configure"])
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="configure failed"):
+        scheduler.run()
+
+    assert time.monotonic() - start < 10
+    assert ran == []
+    assert scheduler.tasks["install"].result is None
+
+
+def test_rejects_unknown_dependencies_and_cycles():
+    scheduler = BuildScheduler(cpu_budget=1)
+    scheduler.add_task("a", lambda: None, deps=["missing"])
+    with pytest.raises(ValueError, match="unknown task"):
+        scheduler.run()
+
+    scheduler = BuildScheduler(cpu_budget=1)
+    scheduler.add_task("a", lambda: None, deps=["b"])
+    scheduler.add_task("b", lambda: None, deps=["a"])
+    with pytest.raises(ValueError, match="cycle"):
+        scheduler.run()